@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+بنچمارک تاخیر درخواست‌های کاربران هنگام دسترسی همزمان به دیتابیس
+
+«پیش از تغییر» الگوی دسترسی نسخه پایه است: هر فراخوانی یک اتصال تازه
+sqlite3.connect (بدون WAL) باز می‌کند و مستقیم داخل کوروتین هندلر اجرا
+می‌شود. «پس از تغییر» AsyncDatabaseManager با اتصال ماندگار WAL روی نخ
+اختصاصی است.
+
+هر کاربر درخواست‌هایش را در زمان‌های از پیش تعیین‌شده (ورود پواسون با
+میانگین --think-ms) ارسال می‌کند و تاخیر هر درخواست از زمان ورود تا پاسخ
+اندازه‌گیری می‌شود؛ پس زمان انتظار پشت حلقه رویدادِ مسدودشده توسط کاربران
+دیگر هم حساب می‌شود. تاخیر حلقه رویداد کنار آن گزارش می‌شود.
+اجرا:
+    python benchmarks/db_latency.py --users 300 --taps 20 --think-ms 50
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import statistics
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import DatabaseManager, AsyncDatabaseManager  # noqa: E402
+
+LESSON_TEXT = "📘 درس نمونه\n" + ("متن آموزشی نمونه برای بنچمارک. " * 200)
+
+
+class BaselineDatabase:
+    """الگوی دسترسی DatabaseManager نسخه پایه: یک اتصال تازه برای هر فراخوانی"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS lessons_cache (
+                    chapter INTEGER, lesson INTEGER, content TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (chapter, lesson)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS user_progress (
+                    user_id INTEGER PRIMARY KEY, chapter INTEGER DEFAULT 0, lesson INTEGER DEFAULT 0,
+                    section_index INTEGER DEFAULT 0, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+
+    def save_lesson_content(self, chapter: int, lesson: int, content: str):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("INSERT OR REPLACE INTO lessons_cache (chapter, lesson, content) VALUES (?, ?, ?)",
+                         (chapter, lesson, content))
+            conn.commit()
+
+    def get_lesson_content(self, chapter: int, lesson: int):
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT content FROM lessons_cache WHERE chapter=? AND lesson=?",
+                               (chapter, lesson)).fetchone()
+            return row[0] if row else None
+
+    def get_user_progress(self, user_id: int):
+        with sqlite3.connect(self.db_path) as conn:
+            row = conn.execute("SELECT chapter, lesson, section_index FROM user_progress WHERE user_id=?",
+                               (user_id,)).fetchone()
+            return row if row else (0, 0, 0)
+
+    def update_user_progress(self, user_id: int, chapter: int, lesson: int, section_index: int):
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO user_progress (user_id, chapter, lesson, section_index, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            """, (user_id, chapter, lesson, section_index, datetime.now()))
+            conn.commit()
+
+
+def percentile(values, p):
+    """محاسبه صدک p از مقادیر"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def handle_baseline(db: BaselineDatabase, user_id: int):
+    """هندلر نسخه پایه: فراخوانی مستقیم و مسدودکننده دیتابیس"""
+    chapter, lesson, section = db.get_user_progress(user_id)
+    db.get_lesson_content(1, 1)
+    db.update_user_progress(user_id, 1, 1, section + 1)
+
+
+async def handle_async(db: AsyncDatabaseManager, user_id: int):
+    """هندلر فعلی: لایه غیرمسدودکننده"""
+    chapter, lesson, section = await db.get_user_progress(user_id)
+    await db.get_lesson_content(1, 1)
+    await db.update_user_progress(user_id, 1, 1, section + 1)
+
+
+async def simulate_user(handler, db, user_id: int, arrivals: list, latencies: list):
+    """ارسال درخواست‌ها در زمان‌های ورود؛ تاخیر از زمان ورود تا پاسخ"""
+    for arrival in arrivals:
+        wait = arrival - time.perf_counter()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await handler(db, user_id)
+        latencies.append(time.perf_counter() - arrival)
+
+
+async def loop_lag_probe(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    """اندازه‌گیری تاخیر حلقه رویداد (هزینه‌ای که سایر کاربران می‌پردازند)"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_scenario(name: str, users: int, taps: int, think: float, seed: int, baseline: bool):
+    """اجرای یک سناریو و چاپ نتایج"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        if baseline:
+            db = BaselineDatabase(path)
+            db.save_lesson_content(1, 1, LESSON_TEXT)
+            handler = handle_baseline
+        else:
+            storage = DatabaseManager(path)
+            storage.save_lesson_content(1, 1, LESSON_TEXT)
+            db = AsyncDatabaseManager(storage)
+            handler = handle_async
+
+        rng = random.Random(seed)
+        latencies, lags = [], []
+        stop = asyncio.Event()
+        probe = asyncio.create_task(loop_lag_probe(stop, lags))
+        started = time.perf_counter()
+        schedules = []
+        for _ in range(users):
+            at, arrivals = started, []
+            for _ in range(taps):
+                at += rng.expovariate(1 / think)
+                arrivals.append(at)
+            schedules.append(arrivals)
+        await asyncio.gather(*(
+            simulate_user(handler, db, uid, arrivals, latencies)
+            for uid, arrivals in enumerate(schedules, 1)
+        ))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe
+        if not baseline:
+            db.close()
+
+    print(f"[{name}] users={users} taps={taps} think={think * 1000:.0f}ms total={elapsed:.2f}s "
+          f"requests/s={users * taps / elapsed:.0f}")
+    print(f"  end-to-end p50={percentile(latencies, 50) * 1000:.2f}ms "
+          f"p99={percentile(latencies, 99) * 1000:.2f}ms "
+          f"mean={statistics.mean(latencies) * 1000:.2f}ms")
+    if lags:
+        print(f"  loop lag   p50={percentile(lags, 50) * 1000:.2f}ms "
+              f"p99={percentile(lags, 99) * 1000:.2f}ms max={max(lags) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--taps", type=int, default=20)
+    parser.add_argument("--think-ms", type=float, default=50.0, help="میانگین فاصله درخواست‌های هر کاربر")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    think = args.think_ms / 1000
+    asyncio.run(run_scenario("before: per-call connect", args.users, args.taps, think, args.seed, baseline=True))
+    asyncio.run(run_scenario("after: async WAL", args.users, args.taps, think, args.seed, baseline=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+آزمون بار سرتاسری ربات با تلگرام جعلی و سرور جعلی DeepSeek
+
+هزاران کاربر مصنوعی مسیر کامل start → فصل‌ها → فصل → درس → بعدی/قبلی → تمرینات
+(و گاهی درس بعدی) را از طریق هندلرهای واقعی PythonMentorBot طی می‌کنند. درخواست‌های Bot API با یک
+BaseRequest جعلی ثبت و پاسخ داده می‌شوند و /chat/completions از یک سرور محلی
+با تاخیر و نرخ خطای قابل تنظیم پاسخ می‌گیرد.
+
+اجرا:
+    python benchmarks/load_test.py --users 2000 --concurrency 200 --llm-latency 0.5 --llm-failure-rate 0.05
+
+با --max-p99-ms یا --min-throughput در صورت عبور از آستانه کد خروج 1 برمی‌گردد
+(برای تشخیص افت کارایی در CI).
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import ExtBot  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+MAIN_MENU_CHAPTERS = "فصل‌ها 📚"
+
+
+def percentile(values, p):
+    """محاسبه صدک p از مقادیر"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class FakeTelegramRequest(BaseRequest):
+    """جایگزین شبکه Bot API: همه فراخوانی‌ها ثبت و پاسخ موفق ساختگی برگردانده می‌شود"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+        # آخرین کیبورد شیشه‌ای ارسال‌شده برای هر چت (برای زدن دکمه‌های واقعی)
+        self.keyboards = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            chat_id = params.get("chat_id", 0)
+            markup = params.get("reply_markup")
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if markup and "inline_keyboard" in markup:
+                self.keyboards[chat_id] = markup["inline_keyboard"]
+            result = {
+                "message_id": params.get("message_id", self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+async def start_deepseek_stub(latency: float, failure_rate: float, seed: int):
+    """سرور جعلی /chat/completions با تاخیر و نرخ خطای 503 قابل تنظیم"""
+    rng = random.Random(seed)
+    stats = Counter()
+
+    def lesson_text(title: str) -> str:
+        body = "\n".join(f"بند {i}: توضیح مفصل درباره {title}. " * 8 for i in range(40))
+        code = "<q>" + "\n".join(f"x{i} = {i} * 2" for i in range(20)) + "</q>"
+        return f"📘 {title}\n{body}\n{code}\n📝 تمرینات:\n1. تمرین اول\n2. تمرین دوم"
+
+    async def handle(reader, writer):
+        try:
+            head = (await reader.readuntil(b"\r\n\r\n")).decode()
+            length = 0
+            for line in head.split("\r\n"):
+                if line.lower().startswith("content-length:"):
+                    length = int(line.split(":", 1)[1])
+            request = json.loads(await reader.readexactly(length)) if length else {}
+            stats["requests"] += 1
+            await asyncio.sleep(latency)
+
+            if rng.random() < failure_rate:
+                stats["failures"] += 1
+                writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+
+            prompt = request["messages"][-1]["content"]
+            text = lesson_text(prompt.splitlines()[0][:60])
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4}
+            if request.get("stream"):
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n")
+                for i in range(0, len(text), 400):
+                    chunk = {"choices": [{"delta": {"content": text[i:i + 400]}}]}
+                    writer.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    await writer.drain()
+                writer.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\ndata: [DONE]\n\n".encode())
+            else:
+                payload = json.dumps({"choices": [{"message": {"content": text}}], "usage": usage}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             + f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        finally:
+            await writer.drain()
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}", stats
+
+
+class SyntheticUser:
+    """یک کاربر مصنوعی که مسیر کامل یک جلسه را با به‌روزرسانی‌های واقعی تلگرام طی می‌کند"""
+
+    def __init__(self, user_id: int, bot: ExtBot, rng: random.Random, request: FakeTelegramRequest):
+        self.user_id = user_id
+        self.bot = bot
+        self.request = request
+        self.rng = rng
+        self.update_id = user_id * 1000
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"}
+
+    def _message(self, text: str, entities=None):
+        message = {"message_id": 1, "date": 0, "chat": {"id": self.user_id, "type": "private"},
+                   "from": self._user(), "text": text}
+        if entities:
+            message["entities"] = entities
+        return message
+
+    def text_update(self, text: str) -> Update:
+        self.update_id += 1
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else None
+        return Update.de_json({"update_id": self.update_id, "message": self._message(text, entities)}, self.bot)
+
+    def button_update(self, text: str, fallback: str) -> Update:
+        """زدن دکمه‌ای از آخرین کیبورد که متن آن با text شروع می‌شود"""
+        for row in self.request.keyboards.get(self.user_id, []):
+            for button in row:
+                if button["text"].startswith(text):
+                    return self.callback_update(button["callback_data"])
+        return self.callback_update(fallback)
+
+    def callback_update(self, data: str) -> Update:
+        self.update_id += 1
+        return Update.de_json({
+            "update_id": self.update_id,
+            "callback_query": {"id": str(self.update_id), "chat_instance": str(self.user_id), "data": data,
+                               "from": self._user(), "message": self._message("…")},
+        }, self.bot)
+
+
+async def run_session(app_bot: main.PythonMentorBot, user: SyntheticUser, chapters, think_time: float,
+                      next_lesson_rate: float, latencies, errors):
+    """یک جلسه کامل کاربر؛ زمان هر مرحله جداگانه ثبت می‌شود"""
+    rng = user.rng
+    chapter_num = rng.choice(chapters)
+    lesson_count = len(app_bot.curriculum_manager.get_chapter_info(chapter_num)["lessons"])
+    lesson_num = rng.randint(1, lesson_count)
+
+    # آپدیت هر مرحله هنگام اجرا ساخته می‌شود تا دکمه‌های آخرین پیام ربات زده شوند
+    steps = [
+        ("start", app_bot.start_command, lambda: user.text_update("/start")),
+        ("chapters_menu", app_bot.text_message_handler, lambda: user.text_update(MAIN_MENU_CHAPTERS)),
+        ("chapter", app_bot.button_handler, lambda: user.button_update(f"فصل {chapter_num}:", f"chapter_{chapter_num}")),
+        ("lesson", app_bot.button_handler,
+         lambda: user.button_update(f"درس {lesson_num}", f"lesson_{chapter_num}_{lesson_num}")),
+    ]
+    steps += [("next", app_bot.button_handler, lambda: user.button_update("➡️", "next_section"))
+              for _ in range(rng.randint(1, 4))]
+    steps += [("prev", app_bot.button_handler, lambda: user.button_update("⬅️ قبلی", "prev_section"))
+              for _ in range(rng.randint(0, 2))]
+    steps.append(("exercises", app_bot.button_handler, lambda: user.button_update("🎯", "show_exercises")))
+    _, next_lesson = app_bot.curriculum_manager.get_adjacent_lessons(chapter_num, lesson_num)
+    if next_lesson and rng.random() < next_lesson_rate:
+        steps.append(("next_lesson", app_bot.button_handler,
+                      lambda: user.callback_update(f"nav_lesson_{next_lesson[0]}_{next_lesson[1]}")))
+
+    for name, handler, make_update in steps:
+        update = make_update()
+        start = time.perf_counter()
+        try:
+            await handler(update, None)
+        except Exception as e:
+            errors[f"{name}: {type(e).__name__}"] += 1
+        latencies[name].append(time.perf_counter() - start)
+        if think_time:
+            await asyncio.sleep(rng.uniform(0, think_time * 2))
+
+
+async def run(args) -> int:
+    os.chdir(ROOT)
+    rng = random.Random(args.seed)
+    server, stub_url, llm_stats = await start_deepseek_stub(args.llm_latency, args.llm_failure_rate, args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # بقیه تنظیمات (مثلاً SEND_*) همچنان از متغیرهای محیطی قابل تغییرند
+        config = main.BotConfig.from_env(telegram_bot_token="123456:bench", deepseek_api_key="bench",
+                                         metrics_port=0, db_path=os.path.join(tmp, "load.db"),
+                                         deepseek_base_url=stub_url, deepseek_backoff_base=0.05)
+        app_bot = main.PythonMentorBot(config)
+
+        request = FakeTelegramRequest(args.telegram_latency)
+        tg_bot = ExtBot(config.telegram_bot_token, request=request, get_updates_request=FakeTelegramRequest(),
+                        rate_limiter=app_bot.rate_limiter if args.rate_limit else None)
+        await tg_bot.initialize()
+
+        chapters = list(range(1, len(app_bot.curriculum_manager.curriculum["chapters"]) + 1))
+        if args.chapters:
+            chapters = chapters[:args.chapters]
+        latencies = defaultdict(list)
+        errors = Counter()
+        slots = asyncio.Semaphore(args.concurrency)
+        db_ops_before = app_bot.metrics.db_query_latency.count()
+
+        async def session(user_id: int):
+            async with slots:
+                user = SyntheticUser(user_id, tg_bot, random.Random(rng.random()), request)
+                await run_session(app_bot, user, chapters, args.think_time, args.next_lesson_rate,
+                                  latencies, errors)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(session(uid) for uid in range(1, args.users + 1)))
+        elapsed = time.perf_counter() - started
+
+        # تولیدهای پس‌زمینه (ادامه درس‌های جریانی و پیش‌واکشی) پیش از بستن دیتابیس
+        await asyncio.gather(*app_bot.prefetch_tasks, return_exceptions=True)
+        await app_bot.lesson_flights.drain()
+        await app_bot.db_manager.flush_progress()
+        db_ops = app_bot.metrics.db_query_latency.count() - db_ops_before
+        await tg_bot.shutdown()
+        await app_bot.ai_client.client.aclose()
+        app_bot.db_manager.close()
+    server.close()
+
+    steps = sum(len(values) for values in latencies.values())
+    report = {
+        "users": args.users,
+        "elapsed_s": round(elapsed, 3),
+        "sessions_per_s": round(args.users / elapsed, 2),
+        "handler_calls_per_s": round(steps / elapsed, 2),
+        "handlers": {
+            name: {
+                "calls": len(values),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+            }
+            for name, values in latencies.items()
+        },
+        "db_ops_per_session": round(db_ops / args.users, 2),
+        "llm_calls_per_session": round(llm_stats["requests"] / args.users, 4),
+        "llm_requests": llm_stats["requests"],
+        "llm_failures": llm_stats["failures"],
+        "telegram_calls_per_session": round(sum(request.calls.values()) / args.users, 2),
+        "telegram_calls": dict(request.calls),
+        "lesson_cache": app_bot.db_manager.lesson_cache.stats(),
+        "prefetch": app_bot.prefetch_report(),
+        "errors": dict(errors),
+    }
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"users={args.users} concurrency={args.concurrency} total={elapsed:.2f}s "
+              f"sessions/s={report['sessions_per_s']} handler calls/s={report['handler_calls_per_s']}")
+        print(f"{'handler':>14} {'calls':>7} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9}")
+        for name, row in report["handlers"].items():
+            print(f"{name:>14} {row['calls']:>7} {row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} {row['p99_ms']:>9.2f}")
+        print(f"per session: db ops={report['db_ops_per_session']} llm calls={report['llm_calls_per_session']} "
+              f"telegram calls={report['telegram_calls_per_session']}")
+        print(f"llm requests={report['llm_requests']} failures={report['llm_failures']} "
+              f"cache hit ratio={report['lesson_cache']['hit_ratio']:.2f}")
+        prefetch = report["prefetch"]
+        print(f"prefetch: requested={prefetch['requested']} hits={prefetch['hits']} late={prefetch['late']} "
+              f"hit rate={prefetch['hit_rate']:.2f} llm calls={prefetch['llm_calls']}")
+        if errors:
+            print(f"errors: {dict(errors)}")
+
+    failed = bool(errors)
+    if args.max_p99_ms is not None:
+        slow = {name: row["p99_ms"] for name, row in report["handlers"].items()
+                if name != "lesson" and row["p99_ms"] > args.max_p99_ms}
+        if slow:
+            print(f"FAIL: p99 above {args.max_p99_ms}ms: {slow}")
+            failed = True
+    if args.min_throughput is not None and report["handler_calls_per_s"] < args.min_throughput:
+        print(f"FAIL: throughput {report['handler_calls_per_s']} < {args.min_throughput}")
+        failed = True
+    return 1 if failed else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=200, help="حداکثر جلسه همزمان")
+    parser.add_argument("--chapters", type=int, default=0, help="محدود کردن به N فصل اول (0 یعنی همه)")
+    parser.add_argument("--think-time", type=float, default=0.0, help="میانگین مکث کاربر بین مراحل (ثانیه)")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="تاخیر پاسخ DeepSeek جعلی (ثانیه)")
+    parser.add_argument("--llm-failure-rate", type=float, default=0.0, help="نسبت پاسخ‌های 503")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="تاخیر هر فراخوانی Bot API (ثانیه)")
+    parser.add_argument("--rate-limit", action="store_true", help="عبور ارسال‌ها از صف محدودیت نرخ")
+    parser.add_argument("--next-lesson-rate", type=float, default=0.5,
+                        help="نسبت جلسه‌هایی که در پایان به درس بعدی می‌روند")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="خروجی JSON برای مقایسه خودکار")
+    parser.add_argument("--max-p99-ms", type=float, default=None, help="آستانه p99 هندلرها (به جز تولید درس)")
+    parser.add_argument("--min-throughput", type=float, default=None, help="حداقل فراخوانی هندلر در ثانیه")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+میکروبنچمارک ساخت منوهای فصل‌ها و دروس
+
+مقایسه ساخت متن و کیبورد منوها در هر درخواست (روش پیشین با += و دکمه‌های تازه)
+با خواندن منوهای از پیش ساخته‌شده CurriculumManager. زمان تبدیل کیبورد به
+JSON (که در هر دو حالت هنگام ارسال انجام می‌شود) جداگانه گزارش می‌شود.
+اجرا:
+    python benchmarks/menu_rendering.py --iterations 20000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+from main import CurriculumIndex, CurriculumManager  # noqa: E402
+
+
+def legacy_chapters_menu(curriculum):
+    """منوی فصل‌ها به روش پیش از ساخت از پیش"""
+    text = "📚 فصل‌های آموزشی:\n\n"
+    for i, chapter in enumerate(curriculum["chapters"], 1):
+        text += f"{i}. {chapter['title']}\n"
+    buttons = []
+    for i, chapter in enumerate(curriculum["chapters"], 1):
+        buttons.append([InlineKeyboardButton(text=f"فصل {i}: {chapter['title']}", callback_data=f"chapter_{i}")])
+    return text, InlineKeyboardMarkup(buttons)
+
+
+def legacy_lessons_menu(curriculum, chapter_num):
+    """منوی دروس یک فصل به روش پیش از ساخت از پیش"""
+    chapter = curriculum["chapters"][chapter_num - 1]
+    text = f"فصل {chapter_num}: {chapter['title']}\n\n"
+    text += "درس‌های این فصل:\n"
+    for i, lesson in enumerate(chapter["lessons"], 1):
+        text += f"{i}. {lesson['title']}\n"
+    buttons = []
+    row = []
+    for i, _ in enumerate(chapter["lessons"], 1):
+        row.append(InlineKeyboardButton(text=f"درس {i}", callback_data=f"lesson_{chapter_num}_{i}"))
+        if len(row) == 3:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton("⬅️ بازگشت", callback_data="back_to_chapters")])
+    return text, InlineKeyboardMarkup(buttons)
+
+
+def measure(label: str, func, iterations: int):
+    started = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    elapsed = time.perf_counter() - started
+    print(f"{label:>32}: {elapsed / iterations * 1e6:8.2f}us per render")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+    os.chdir(ROOT)
+
+    manager = CurriculumManager("chapters.json")
+    curriculum = manager.curriculum
+    chapters = len(curriculum["chapters"])
+    print(f"chapters={chapters} lessons={len(manager.index.lesson_order)} iterations={args.iterations}")
+
+    measure("legacy chapters menu", lambda i: legacy_chapters_menu(curriculum), args.iterations)
+    measure("precompiled chapters menu",
+            lambda i: (manager.get_chapters_list(), manager.get_chapters_markup()), args.iterations)
+    measure("legacy lessons menu", lambda i: legacy_lessons_menu(curriculum, i % chapters + 1), args.iterations)
+    measure("precompiled lessons menu",
+            lambda i: (manager.get_lessons_text(i % chapters + 1), manager.get_lessons_markup(i % chapters + 1)),
+            args.iterations)
+    measure("adjacent lessons + nav buttons",
+            lambda i: (manager.get_adjacent_lessons(*manager.index.lesson_order[i % len(manager.index.lesson_order)]),
+                       manager.get_nav_buttons(*manager.index.lesson_order[i % len(manager.index.lesson_order)])),
+            args.iterations)
+    measure("lessons markup to_json", lambda i: manager.get_lessons_markup(i % chapters + 1).to_json(),
+            args.iterations)
+
+    started = time.perf_counter()
+    CurriculumIndex.build(curriculum)
+    print(f"{'one-time index build':>32}: {(time.perf_counter() - started) * 1000:8.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+شبیه‌سازی صف ارسال تلگرام با یک Bot جعلی
+
+یک ارسال انبوه به چندین چت همزمان با پاسخ‌های تعاملی کاربران اجرا می‌شود و
+Bot جعلی مانند تلگرام در صورت عبور از محدودیت‌ها خطای RetryAfter می‌دهد.
+اجرا:
+    python benchmarks/send_queue.py --chats 200 --interactive 50
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.error import RetryAfter  # noqa: E402
+from main import OutboundRateLimiter, SEND_PRIORITY_BULK  # noqa: E402
+
+
+class FakeBot:
+    """Bot جعلی که محدودیت‌های سراسری و هر چت تلگرام را اعمال می‌کند"""
+
+    def __init__(self, limiter: OutboundRateLimiter, global_limit: int = 30):
+        self.limiter = limiter
+        self.global_limit = global_limit
+        self.sent_times = []
+        self.last_by_chat = {}
+        self.flood_errors = 0
+
+    async def send_message(self, chat_id: int, text: str, rate_limit_args=None):
+        async def call():
+            now = time.monotonic()
+            recent = sum(1 for t in self.sent_times[-self.global_limit:] if now - t < 1.0)
+            if recent >= self.global_limit:
+                self.flood_errors += 1
+                raise RetryAfter(1)
+            self.sent_times.append(now)
+            self.last_by_chat[chat_id] = now
+            return True
+
+        return await self.limiter.process_request(
+            call, (), {}, "sendMessage", {"chat_id": chat_id, "text": text}, rate_limit_args
+        )
+
+
+async def run(chats: int, interactive: int):
+    limiter = OutboundRateLimiter()
+    await limiter.initialize()
+    bot = FakeBot(limiter)
+
+    interactive_waits = []
+
+    async def user_reply(chat_id: int):
+        start = time.perf_counter()
+        await bot.send_message(chat_id, "reply")
+        interactive_waits.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    broadcast = asyncio.gather(*(
+        bot.send_message(chat_id, "broadcast", SEND_PRIORITY_BULK) for chat_id in range(10_000, 10_000 + chats)
+    ))
+    await asyncio.sleep(0.5)
+    await asyncio.gather(*(user_reply(chat_id) for chat_id in range(1, interactive + 1)))
+    await broadcast
+    elapsed = time.perf_counter() - started
+    await limiter.shutdown()
+
+    print(f"chats={chats} interactive={interactive} total={elapsed:.2f}s flood_errors={bot.flood_errors}")
+    print(f"  interactive wait p50={statistics.median(interactive_waits) * 1000:.1f}ms "
+          f"max={max(interactive_waits) * 1000:.1f}ms")
+    print(f"  limiter: {limiter.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--interactive", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.chats, args.interactive))
+
+
+if __name__ == "__main__":
+    main()
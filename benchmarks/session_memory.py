@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+حافظه جلسه‌های کاربران فعال
+
+حافظه هر جلسه UserSession (با __slots__) با دیکشنری معادل آن مقایسه می‌شود و
+سپس SessionStore با تعداد زیادی کاربر پر می‌شود تا آمار حافظه هر جلسه فعال،
+حذف بر اساس سقف و زمان دسترسی گزارش شود.
+اجرا:
+    python benchmarks/session_memory.py --users 50000 --max-active 20000
+"""
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import SessionStore, UserSession  # noqa: E402
+
+BASE_USER_ID = 5_000_000_000
+
+
+def measure_memory(label: str, factory, count: int):
+    """حافظه تخصیص‌یافته برای count شیء"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    objects = [factory(i) for i in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    # فهرست نگهدارنده اشیا جزو حافظه جلسه‌ها نیست
+    allocated -= sys.getsizeof(objects)
+    print(f"{label:>24}: {allocated / count:7.1f} bytes per session")
+    return objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--max-active", type=int, default=20000)
+    args = parser.parse_args()
+
+    measure_memory("dict session", lambda i: {
+        "user_id": BASE_USER_ID + i, "chapter": 3, "lesson": 4, "section": i % 7,
+        "section_count": 7, "message_id": 100_000 + i, "expires_at": time.monotonic(),
+    }, args.users)
+    measure_memory("UserSession (__slots__)", lambda i: UserSession(
+        BASE_USER_ID + i, 3, 4, i % 7, 7, 100_000 + i, time.monotonic()
+    ), args.users)
+
+    store = SessionStore(ttl=1800, max_sessions=args.max_active)
+    started = time.perf_counter()
+    for i in range(args.users):
+        store.put(UserSession(BASE_USER_ID + i, 3, 4, i % 7, 7, 100_000 + i))
+    put_elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    for i in range(args.users):
+        store.get(BASE_USER_ID + i)
+    get_elapsed = time.perf_counter() - started
+
+    stats = store.stats()
+    print(f"\nstore: users={args.users} max_active={args.max_active} "
+          f"put={put_elapsed / args.users * 1e6:.2f}us get={get_elapsed / args.users * 1e6:.2f}us")
+    print(f"  active={stats['active']} evictions={stats['evictions']} hit_ratio={stats['hit_ratio']:.2f} "
+          f"memory={stats['memory_bytes'] / 1024 / 1024:.1f}MB bytes_per_session={stats['bytes_per_session']:.0f}")
+
+
+if __name__ == "__main__":
+    main()
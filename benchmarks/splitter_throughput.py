@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+بنچمارک سرعت تقسیم پیام: MessageSplitter فعلی در برابر پیاده‌سازی قدیمی
+
+اجرا:
+    python benchmarks/splitter_throughput.py
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import MessageSplitter  # noqa: E402
+
+WORDS = ["پایتون", "متغیر", "تابع", "حلقه", "شرط", "لیست", "🐍", "✨", "print", "value", "۱۲۳"]
+
+
+def legacy_split_message(text: str, max_length: int = 3500):
+    """پیاده‌سازی قدیمی (الحاق رشته‌ای و شمارش با len) برای مقایسه"""
+    lines = text.split('\n')
+    chunks = []
+    current_chunk = ""
+
+    for line in lines:
+        if len(line) > max_length:
+            words = line.split(' ')
+            line_chunk = ""
+            for word in words:
+                if len(line_chunk + word) < max_length:
+                    line_chunk += word + " "
+                else:
+                    if line_chunk:
+                        if len(current_chunk + line_chunk) < max_length:
+                            current_chunk += line_chunk + "\n"
+                        else:
+                            chunks.append(current_chunk.strip())
+                            current_chunk = line_chunk + "\n"
+                    line_chunk = word + " "
+
+            if line_chunk:
+                if len(current_chunk + line_chunk) < max_length:
+                    current_chunk += line_chunk + "\n"
+                else:
+                    chunks.append(current_chunk.strip())
+                    current_chunk = line_chunk + "\n"
+            continue
+
+        if len(current_chunk + line) < max_length:
+            current_chunk += line + "\n"
+        else:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = line + "\n"
+
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+
+    return chunks
+
+
+def synthetic_lesson(size_bytes: int, seed: int = 0) -> str:
+    """ساخت درس مصنوعی با متن فارسی، ایموجی، بلوک‌های کد و خطوط بلند"""
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size_bytes:
+        kind = rng.random()
+        if kind < 0.2:
+            code = "\n".join(f"x{i} = {i} * 2  # {rng.choice(WORDS)}" for i in range(rng.randint(3, 25)))
+            part = f"<q>{code}</q>"
+        elif kind < 0.3:
+            part = " ".join(rng.choices(WORDS, k=rng.randint(500, 3000)))
+        else:
+            part = " ".join(rng.choices(WORDS, k=rng.randint(5, 40)))
+        parts.append(part)
+        total += len(part.encode("utf-8")) + 1
+    return "\n".join(parts)
+
+
+def measure(func, text: str, repeat: int) -> float:
+    """بهترین زمان اجرا در چند تکرار"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'legacy MB/s':>12} {'new MB/s':>10} {'speedup':>8} {'overflows(legacy)':>18}")
+    for size in (10_000, 100_000, 1_000_000):
+        text = synthetic_lesson(size)
+        mb = len(text.encode("utf-8")) / 1_000_000
+        legacy = measure(legacy_split_message, text, args.repeat)
+        new = measure(MessageSplitter.split_message, text, args.repeat)
+        overflows = sum(1 for chunk in legacy_split_message(text) if MessageSplitter.utf16_len(chunk) > 4096)
+        print(f"{size // 1000:>6}KB {mb / legacy:>12.2f} {mb / new:>10.2f} {legacy / new:>7.1f}x {overflows:>18}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+زمان راه‌اندازی سرد ربات
+
+هر اجرا در یک فرایند تازه پایتون و بدون متغیرهای محیطی ربات انجام می‌شود:
+زمان وارد کردن main (در مقایسه با وارد کردن فقط وابستگی‌ها)، ساخت
+PythonMentorBot، ساخت اجزای تنبل و پاسخ به اولین آپدیت (منوی فصل‌ها) با
+تلگرام جعلی آزمون بار اندازه‌گیری و میانه اجراها گزارش می‌شود.
+اجرا:
+    python benchmarks/startup.py --runs 10
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_ENV = ("TELEGRAM_BOT_TOKEN", "DEEPSEEK_API_KEY", "METRICS_PORT")
+
+
+async def first_update(main, mode: str) -> dict:
+    """ساخت ربات و پردازش اولین آپدیت؛ زمان هر مرحله بر حسب میلی‌ثانیه"""
+    from telegram.ext import ExtBot
+    from load_test import FakeTelegramRequest, SyntheticUser, MAIN_MENU_CHAPTERS
+
+    timings = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        started = time.perf_counter()
+        config = main.BotConfig(telegram_bot_token="123456:bench", deepseek_api_key="bench",
+                                db_path=os.path.join(tmp, "startup.db"), metrics_port=0)
+        bot = main.PythonMentorBot(config)
+        timings["construct_ms"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        if mode == "warm":
+            # همان کاری که on_startup پیش از دریافت آپدیت‌ها انجام می‌دهد
+            bot.build_components()
+        timings["components_ms"] = (time.perf_counter() - started) * 1000
+
+        request = FakeTelegramRequest()
+        tg_bot = ExtBot(config.telegram_bot_token, request=request, get_updates_request=FakeTelegramRequest())
+        await tg_bot.initialize()
+        user = SyntheticUser(1, tg_bot, None, request)
+        update = user.text_update(MAIN_MENU_CHAPTERS)
+
+        started = time.perf_counter()
+        await bot.text_message_handler(update, None)
+        timings["first_update_ms"] = (time.perf_counter() - started) * 1000
+
+        await tg_bot.shutdown()
+        await bot.on_shutdown(None)
+    return timings
+
+
+def child(mode: str):
+    """یک اجرای سرد؛ خروجی یک خط JSON"""
+    started = time.perf_counter()
+    if mode == "deps":
+        import httpx  # noqa: F401
+        import dotenv  # noqa: F401
+        import telegram.ext  # noqa: F401
+        print(json.dumps({"import_ms": (time.perf_counter() - started) * 1000}))
+        return
+    sys.path.insert(0, ROOT)
+    import main
+    timings = {"import_ms": (time.perf_counter() - started) * 1000}
+    timings.update(asyncio.run(first_update(main, mode)))
+    print(json.dumps(timings))
+
+
+def run_child(mode: str) -> dict:
+    env = {key: value for key, value in os.environ.items() if key not in BOT_ENV}
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    timings = json.loads(output.strip().splitlines()[-1])
+    timings["process_ms"] = (time.perf_counter() - started) * 1000
+    return timings
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--child", choices=("deps", "lazy", "warm"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    print(f"runs={args.runs} (median of fresh processes, milliseconds)")
+    for mode in ("deps", "lazy", "warm"):
+        runs = [run_child(mode) for _ in range(args.runs)]
+        columns = " ".join(f"{key}={statistics.median(run[key] for run in runs):.1f}" for key in runs[0])
+        print(f"{mode:>5}: {columns}")
+
+
+if __name__ == "__main__":
+    main_cli()
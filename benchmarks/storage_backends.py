@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+مقایسه ذخیره‌سازها و بررسی هماهنگی تولید درس بین چند نمونه ربات
+
+۱. تاخیر عملیات رایج روی MemoryStorage، SQLite و RemoteStorage (با StorageServer محلی)
+۲. چند نمونه PythonMentorBot با یک سرور ذخیره‌ساز مشترک همزمان دروس یکسانی را
+   درخواست می‌کنند؛ هر درس باید فقط یک بار تولید شود.
+
+همه چیز به صورت محلی اجرا می‌شود.
+اجرا:
+    python benchmarks/storage_backends.py --ops 2000 --instances 3
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+PORT = free_port()
+TMP = tempfile.mkdtemp()
+
+import main  # noqa: E402
+
+LESSON_TEXT = "📘 درس نمونه\n" + ("متن آموزشی نمونه برای بنچمارک. " * 400) + "\n📝 تمرینات:\n1. تمرین"
+
+
+class ServerThread:
+    """اجرای StorageServer در نخ و حلقه رویداد جداگانه (کلاینت RemoteStorage همگام است)"""
+
+    def __init__(self, backend: main.StorageBackend, port: int):
+        self.server = main.StorageServer(backend, "127.0.0.1", port)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def measure_backend(name: str, storage: main.StorageBackend, ops: int):
+    """تاخیر عملیات پرتکرار یک ذخیره‌ساز"""
+    storage.save_lesson_content(1, 1, LESSON_TEXT)
+    timings = {"get_user_progress": [], "update_user_progress": [], "get_lesson_section": []}
+    for i in range(ops):
+        user_id = i % 100
+        for op, call in (
+            ("get_user_progress", lambda: storage.get_user_progress(user_id)),
+            ("update_user_progress", lambda: storage.update_user_progress(user_id, 1, 1, i)),
+            ("get_lesson_section", lambda: storage.get_lesson_section(1, 1, i % 3)),
+        ):
+            start = time.perf_counter()
+            call()
+            timings[op].append(time.perf_counter() - start)
+    for op, values in timings.items():
+        print(f"  {name:>7} {op:>22} mean={statistics.mean(values) * 1e6:8.1f}us "
+              f"max={max(values) * 1e6:9.1f}us")
+
+
+async def coordinated_generation(instances: int, lessons):
+    """چند نمونه ربات با ذخیره‌ساز مشترک؛ شمارش فراخوانی‌های تولید درس"""
+    calls = []
+
+    async def fake_generate(chapter_title: str, lesson_title: str):
+        calls.append(lesson_title)
+        await asyncio.sleep(0.3)
+        return main.GenerationResult(content=f"📘 {lesson_title}\n" + LESSON_TEXT, status_code=200)
+
+    config = main.BotConfig(telegram_bot_token="bench", deepseek_api_key="bench", metrics_port=0,
+                            deepseek_streaming=False, storage_backend="remote",
+                            storage_url=f"http://127.0.0.1:{PORT}", generation_lease_poll=0.05)
+    bots = [main.PythonMentorBot(config) for _ in range(instances)]
+    for bot in bots:
+        bot.ai_client.generate_lesson = fake_generate
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        bot.generate_and_cache_lesson(chapter, lesson, bot.curriculum_manager.get_chapter_info(chapter)["title"],
+                                      bot.curriculum_manager.get_lesson_title(chapter, lesson))
+        for bot in bots for chapter, lesson in lessons
+    ))
+    elapsed = time.perf_counter() - started
+    for bot in bots:
+        bot.db_manager.close()
+        await bot.ai_client.client.aclose()
+    return len(calls), elapsed
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--instances", type=int, default=3)
+    args = parser.parse_args()
+    os.chdir(ROOT)
+
+    print("latency per operation:")
+    measure_backend("memory", main.MemoryStorage(), args.ops)
+    sqlite_storage = main.DatabaseManager(os.path.join(TMP, "bench.db"))
+    measure_backend("sqlite", sqlite_storage, args.ops)
+    sqlite_storage.close()
+    with ServerThread(main.DatabaseManager(os.path.join(TMP, "remote_latency.db")), free_port()) as server:
+        remote = main.RemoteStorage(f"http://127.0.0.1:{server.server.port}")
+        measure_backend("remote", remote, args.ops)
+        remote.close()
+
+    lessons = [(2, lesson) for lesson in range(1, 6)]
+    with ServerThread(main.DatabaseManager(os.path.join(TMP, "shared.db")), PORT):
+        generations, elapsed = asyncio.run(coordinated_generation(args.instances, lessons))
+    print(f"\ncoordinated fills: instances={args.instances} lessons={len(lessons)} "
+          f"requests={args.instances * len(lessons)} generations={generations} total={elapsed:.2f}s")
+    if generations != len(lessons):
+        print("FAIL: a lesson was generated more than once")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+بنچمارک توان پردازش آپدیت‌ها با تعداد مختلف پردازشگر همزمان
+
+هر آپدیت یک هندلر با تاخیر I/O ثابت اجرا می‌کند (مثل انتظار برای API یا تلگرام).
+ترتیب اجرای آپدیت‌های هر کاربر نیز بررسی می‌شود.
+اجرا:
+    python benchmarks/update_throughput.py --users 200 --updates 5 --handler-ms 20
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from main import PerUserUpdateProcessor  # noqa: E402
+
+
+def make_update(update_id: int, user_id: int) -> Update:
+    """ساخت آپدیت callback_query ساده برای یک کاربر"""
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "data": "next_section",
+            "from": {"id": user_id, "is_bot": False, "first_name": "u"},
+        },
+    }, None)
+
+
+def make_updates(users: int, per_user: int, seed: int = 0):
+    """آپدیت‌های درهم کاربران؛ ترتیب هر کاربر با شماره آپدیت مشخص است"""
+    rng = random.Random(seed)
+    order = [uid for uid in range(1, users + 1) for _ in range(per_user)]
+    rng.shuffle(order)
+    return [make_update(i, uid) for i, uid in enumerate(order)]
+
+
+async def run_scenario(workers: int, updates, handler_delay: float):
+    """ارسال همه آپدیت‌ها مانند Application (یک تسک برای هر آپدیت)"""
+    processor = PerUserUpdateProcessor(workers)
+    seen = {}
+    violations = 0
+
+    async def handler(update: Update):
+        nonlocal violations
+        await asyncio.sleep(handler_delay)
+        user_id = update.effective_user.id
+        if seen.get(user_id, -1) > update.update_id:
+            violations += 1
+        seen[user_id] = update.update_id
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        asyncio.create_task(processor.process_update(update, handler(update))) for update in updates
+    ))
+    elapsed = time.perf_counter() - started
+    return elapsed, violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--updates", type=int, default=5, help="تعداد آپدیت هر کاربر")
+    parser.add_argument("--handler-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.updates)
+    print(f"users={args.users} updates={len(updates)} handler={args.handler_ms:.0f}ms")
+    print(f"{'workers':>8} {'total(s)':>9} {'updates/s':>10} {'order violations':>17}")
+    for workers in (1, 2, 4, 8, 16, 32, 64):
+        elapsed, violations = asyncio.run(run_scenario(workers, updates, args.handler_ms / 1000))
+        print(f"{workers:>8} {elapsed:>9.2f} {len(updates) / elapsed:>10.1f} {violations:>17}")
+
+
+if __name__ == "__main__":
+    main()
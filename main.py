@@ -5,18 +5,40 @@
 """
 
 import os
+import sys
 import json
+import argparse
 import logging
 import asyncio
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import math
+import signal
+import socket
+import random
 import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
-from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Mapping, Optional, Set, Tuple
+from dataclasses import asdict, dataclass, fields, replace
 
 import httpx
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     MessageHandler,
@@ -24,50 +46,780 @@ from telegram.ext import (
     filters
 )
 
-# بارگذاری متغیرهای محیطی
+# ثابت‌های زیر فقط مقدار پیش‌فرض هستند و وارد کردن ماژول هیچ متغیر محیطی یا
+# فایل .env را نمی‌خواند؛ متغیرهای محیطی هم‌نام فقط در BotConfig.from_env خوانده
+# می‌شوند و تنظیمات هر نمونه ربات با BotConfig به آن داده می‌شود.
 from dotenv import load_dotenv
-load_dotenv()
-
-# بررسی وجود فایل .env و متغیرها
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-
-if not TELEGRAM_BOT_TOKEN or not DEEPSEEK_API_KEY:
-    print("خطا: متغیرهای محیطی یافت نشدند!")
-    print("TELEGRAM_BOT_TOKEN:", TELEGRAM_BOT_TOKEN)
-    print("DEEPSEEK_API_KEY:", DEEPSEEK_API_KEY)
-    exit(1)
-
-# تنظیمات لاگ
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+
 logger = logging.getLogger(__name__)
 
 # تنظیمات کلیدهای API
 DEEPSEEK_BASE_URL = "https://api.deepseek.com/v1"
 
+# نسخه قالب پرامپت تولید درس؛ پرامپت و مدل خودکار در نسخه محتوا لحاظ می‌شوند
+# و افزایش این عدد فقط برای تولید دوباره همه دروس بدون تغییر پرامپت لازم است
+PROMPT_VERSION = 1
+DEEPSEEK_MODEL = "deepseek-chat"
+
+# دریافت جریانی محتوای درس تا اولین بخش زودتر به کاربر برسد
+DEEPSEEK_STREAMING = True
+
+# تلاش مجدد و قطع‌کن مدار برای خطاهای موقت API
+DEEPSEEK_MAX_RETRIES = 3
+DEEPSEEK_BACKOFF_BASE = 1.0
+DEEPSEEK_BACKOFF_MAX = 20.0
+# حداکثر زمان کل یک درخواست به همراه همه تلاش‌های مجدد و انتظارها (ثانیه)
+DEEPSEEK_RETRY_BUDGET = 120.0
+DEEPSEEK_BREAKER_THRESHOLD = 5
+DEEPSEEK_BREAKER_RESET = 30.0
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# سقف درخواست‌های همزمان تولید درس و کلاس‌های اولیت زمان‌بند (عدد کمتر = اولویت بیشتر)
+DEEPSEEK_MAX_CONCURRENCY = 8
+GENERATION_PRIORITY_INTERACTIVE = 0
+GENERATION_PRIORITY_PREFETCH = 1
+GENERATION_PRIORITY_BULK = 2
+GENERATION_PRIORITY_NAMES = {
+    GENERATION_PRIORITY_INTERACTIVE: "interactive",
+    GENERATION_PRIORITY_PREFETCH: "prefetch",
+    GENERATION_PRIORITY_BULK: "bulk",
+}
+
+# انواع خطای تولید درس
+ERROR_HTTP = "http"
+ERROR_TIMEOUT = "timeout"
+ERROR_CONNECTION = "connection"
+ERROR_CIRCUIT_OPEN = "circuit_open"
+ERROR_STREAM_TRUNCATED = "stream_truncated"
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_EMPTY_CONTENT = "empty_content"
+ERROR_MAX_TOKENS = "max_tokens"
+ERROR_UNKNOWN = "unknown"
+
 # مسیر فایل دیتابیس
 DB_PATH = "bot_database.db"
 
+# سطح فشرده‌سازی zlib محتوای دروس در دیتابیس
+LESSON_COMPRESSION_LEVEL = 6
+
+# نوع ذخیره‌ساز: sqlite (فایل محلی)، remote (سرور ذخیره‌ساز مشترک بین چند نمونه) یا memory
+STORAGE_BACKEND = "sqlite"
+STORAGE_URL = "http://127.0.0.1:8700"
+STORAGE_TOKEN = ""
+STORAGE_TIMEOUT = 10.0
+
+# قفل تولید درس بین نمونه‌ها: مدت اعتبار و فاصله بررسی نمونه‌های منتظر (ثانیه)
+GENERATION_LEASE_TTL = 180.0
+GENERATION_LEASE_POLL = 1.0
+
+# ظرفیت کش درون‌حافظه‌ای دروس (تعداد درس و حجم کل بر حسب بایت)
+LESSON_CACHE_MAX_ITEMS = 64
+LESSON_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# نوشتن تاخیری پیشرفت کاربران (فاصله زمانی بر حسب ثانیه و حداکثر ردیف‌های در انتظار)
+PROGRESS_FLUSH_INTERVAL = 2.0
+PROGRESS_FLUSH_MAX_PENDING = 200
+
+# جلسه‌های درون‌حافظه‌ای کاربران فعال: مدت انقضا پس از آخرین استفاده و حداکثر تعداد
+SESSION_TTL = 1800.0
+SESSION_MAX_ACTIVE = 5000
+
+# تعداد آپدیت‌هایی که همزمان پردازش می‌شوند (آپدیت‌های هر کاربر به ترتیب اجرا می‌شوند)
+UPDATE_WORKERS = 16
+
+# محدودیت ارسال به تلگرام: کل ربات و هر چت (پیام در ثانیه و حداکثر انفجار)
+# مجموع نرخ و انفجار سراسری زیر سقف ~۳۰ پیام در هر ثانیه تلگرام می‌ماند
+SEND_GLOBAL_RATE = 25.0
+SEND_GLOBAL_BURST = 5
+SEND_CHAT_RATE = 1.0
+SEND_CHAT_BURST = 3
+SEND_MAX_RETRIES = 3
+
+# اولویت ارسال (عدد کمتر زودتر)؛ ارسال‌های انبوه با rate_limit_args=SEND_PRIORITY_BULK
+SEND_PRIORITY_INTERACTIVE = 0
+SEND_PRIORITY_BULK = 1
+
+# حالت مطالعه: ویرایش همان پیام درس هنگام رفتن به بخش بعدی/قبلی به جای ارسال پیام جدید
+LESSON_EDIT_IN_PLACE = True
+
+# آخرین بخش درسی که تولید جریانی آن پس از نمایش بخشی از متن قطع شده است
+LESSON_STREAM_FAILED_TEXT = (
+    "⚠️ ادامه این درس به دلیل خطا در تولید محتوا دریافت نشد.\n"
+    "چند لحظه دیگر درس را دوباره از فهرست دروس باز کنید تا از ابتدا تولید شود."
+)
+
+# مدت نگه‌داری درس‌های کش‌نشده (تولید ناقص یا محتوای جایگزین) در حافظه تا دکمه‌های
+# پیام نمایش‌داده‌شده کار کنند، و حداکثر تعداد آن‌ها
+UNCACHED_LESSON_TTL = 15 * 60
+UNCACHED_LESSONS_MAX = 256
+
+# پاسخ دکمه‌ای که درس آن پس از بارگذاری دوباره برنامه آموزشی دیگر وجود ندارد
+MENU_OUTDATED_TEXT = "این منو قدیمی است؛ لطفاً درس را دوباره از منوی فصل‌ها انتخاب کنید."
+
+# فایل برنامه آموزشی و فاصله بررسی تغییر آن برای بارگذاری دوباره (0 یعنی غیرفعال)
+CURRICULUM_FILE = "chapters.json"
+CURRICULUM_RELOAD_INTERVAL = 5.0
+
+# کاربرانی که اجازه دستورات مدیریتی (مثل /reload) را دارند
+ADMIN_USER_IDS = frozenset()
+
+# پیش‌واکشی درس بعدی وقتی کاربر از این نسبت بخش‌های درس فعلی عبور کند
+PREFETCH_ENABLED = True
+PREFETCH_SECTION_THRESHOLD = 0.5
+PREFETCH_TRACK_MAX = 10000
+
+# آدرس و پورت محلی نمایش متریک‌ها (پورت 0 یعنی غیرفعال)
+METRICS_LISTEN = "127.0.0.1"
+METRICS_PORT = 9464
+
+# حالت دریافت آپدیت‌ها: polling یا webhook
+BOT_MODE = "polling"
+
+# تنظیمات وب‌هوک (آدرس عمومی، آدرس و پورت شنود، مسیر، توکن مخفی و حداکثر اتصال همزمان)
+WEBHOOK_URL = ""
+WEBHOOK_LISTEN = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_SECRET_TOKEN = ""
+WEBHOOK_MAX_CONNECTIONS = 40
+WEBHOOK_MAX_BODY = 1024 * 1024
+WEBHOOK_IDLE_TIMEOUT = 30.0
+# حداکثر زمان دریافت بدنه یک درخواست پس از سرآیندهای آن
+WEBHOOK_READ_TIMEOUT = 10.0
+
+class ConfigError(ValueError):
+    """مقدار نامعتبر در متغیرهای محیطی تنظیمات ربات"""
+
+@dataclass(frozen=True)
+class BotConfig:
+    """تنظیمات اجرای یک نمونه ربات
+    
+    مقدار پیش‌فرض هر فیلد ثابت متناظر آن است، پس ابزارها، آزمون‌ها و
+    بنچمارک‌ها می‌توانند فقط فیلدهای لازم را تغییر دهند. متغیرهای محیطی فقط
+    در from_env خوانده می‌شوند و نبودن کلیدها تنها هنگام اجرای ربات خطا است.
+    """
+    telegram_bot_token: str = ""
+    deepseek_api_key: str = ""
+    deepseek_base_url: str = DEEPSEEK_BASE_URL
+    deepseek_model: str = DEEPSEEK_MODEL
+    deepseek_streaming: bool = DEEPSEEK_STREAMING
+    deepseek_max_retries: int = DEEPSEEK_MAX_RETRIES
+    deepseek_backoff_base: float = DEEPSEEK_BACKOFF_BASE
+    deepseek_backoff_max: float = DEEPSEEK_BACKOFF_MAX
+    deepseek_retry_budget: float = DEEPSEEK_RETRY_BUDGET
+    deepseek_breaker_threshold: int = DEEPSEEK_BREAKER_THRESHOLD
+    deepseek_breaker_reset: float = DEEPSEEK_BREAKER_RESET
+    deepseek_max_concurrency: int = DEEPSEEK_MAX_CONCURRENCY
+    storage_backend: str = STORAGE_BACKEND
+    db_path: str = DB_PATH
+    storage_url: str = STORAGE_URL
+    storage_token: str = STORAGE_TOKEN
+    storage_timeout: float = STORAGE_TIMEOUT
+    lesson_compression_level: int = LESSON_COMPRESSION_LEVEL
+    generation_lease_ttl: float = GENERATION_LEASE_TTL
+    generation_lease_poll: float = GENERATION_LEASE_POLL
+    lesson_cache_max_items: int = LESSON_CACHE_MAX_ITEMS
+    lesson_cache_max_bytes: int = LESSON_CACHE_MAX_BYTES
+    progress_flush_interval: float = PROGRESS_FLUSH_INTERVAL
+    progress_flush_max_pending: int = PROGRESS_FLUSH_MAX_PENDING
+    session_ttl: float = SESSION_TTL
+    session_max_active: int = SESSION_MAX_ACTIVE
+    send_global_rate: float = SEND_GLOBAL_RATE
+    send_global_burst: int = SEND_GLOBAL_BURST
+    send_chat_rate: float = SEND_CHAT_RATE
+    send_chat_burst: int = SEND_CHAT_BURST
+    send_max_retries: int = SEND_MAX_RETRIES
+    lesson_edit_in_place: bool = LESSON_EDIT_IN_PLACE
+    curriculum_file: str = CURRICULUM_FILE
+    curriculum_reload_interval: float = CURRICULUM_RELOAD_INTERVAL
+    admin_user_ids: frozenset = ADMIN_USER_IDS
+    prefetch_enabled: bool = PREFETCH_ENABLED
+    prefetch_section_threshold: float = PREFETCH_SECTION_THRESHOLD
+    update_workers: int = UPDATE_WORKERS
+    metrics_listen: str = METRICS_LISTEN
+    metrics_port: int = METRICS_PORT
+    bot_mode: str = BOT_MODE
+    webhook_url: str = WEBHOOK_URL
+    webhook_listen: str = WEBHOOK_LISTEN
+    webhook_port: int = WEBHOOK_PORT
+    webhook_path: str = WEBHOOK_PATH
+    webhook_secret_token: str = WEBHOOK_SECRET_TOKEN
+    webhook_max_connections: int = WEBHOOK_MAX_CONNECTIONS
+    
+    @classmethod
+    def from_env(cls, environ: Optional[Mapping[str, str]] = None, **overrides) -> "BotConfig":
+        """تنظیمات از متغیرهای محیطی به همراه مقادیر جایگزین
+        
+        نام متغیر هر فیلد همان نام فیلد با حروف بزرگ است (مثلاً METRICS_PORT) و
+        مقدار خالی یعنی مقدار پیش‌فرض. برای مقادیر نامعتبر ConfigError با نام
+        همه متغیرهای نادرست برگردانده می‌شود.
+        """
+        environ = os.environ if environ is None else environ
+        values: Dict[str, Any] = {}
+        invalid = []
+        for field in fields(cls):
+            raw = environ.get(field.name.upper(), "").strip()
+            if field.name in overrides or not raw:
+                continue
+            try:
+                values[field.name] = cls._parse(raw, field.default)
+            except ValueError:
+                invalid.append(f"{field.name.upper()}={raw!r}")
+        if invalid:
+            raise ConfigError(f"مقدار نامعتبر برای متغیرهای محیطی: {', '.join(invalid)}")
+        values.update(overrides)
+        return cls(**values)
+    
+    @staticmethod
+    def _parse(raw: str, default: Any) -> Any:
+        """تبدیل مقدار متنی متغیر محیطی به نوع مقدار پیش‌فرض فیلد"""
+        if isinstance(default, bool):
+            if raw.lower() in ("1", "true", "yes", "on"):
+                return True
+            if raw.lower() in ("0", "false", "no", "off"):
+                return False
+            raise ValueError(raw)
+        if isinstance(default, frozenset):
+            # شناسه‌ها با فاصله یا ویرگول جدا می‌شوند
+            return frozenset(int(uid) for uid in raw.replace(",", " ").split())
+        return type(default)(raw)
+    
+    def missing(self, *names: str) -> List[str]:
+        """نام متغیرهای محیطی لازمی که مقدار ندارند"""
+        return [name.upper() for name in names if not getattr(self, name)]
+
+def configure_logging(level: int = logging.INFO):
+    """تنظیم لاگ سراسری؛ فقط نقطه ورود برنامه آن را صدا می‌زند"""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=level
+    )
+
+# مرزهای پیش‌فرض هیستوگرام‌های زمان (ثانیه)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    """قالب‌بندی برچسب‌ها به صورت {name="value",...}"""
+    parts = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{name}="{escaped}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    """شمارنده افزایشی با برچسب (ایمن برای استفاده از چند نخ)"""
+    
+    TYPE = "counter"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labelnames), 0)
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+class Histogram:
+    """هیستوگرام تجمعی با برچسب (ایمن برای استفاده از چند نخ)"""
+    
+    TYPE = "histogram"
+    
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # برای هر مجموعه برچسب: [شمارش هر بازه..., مجموع، تعداد]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+    
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """اندازه‌گیری زمان اجرای بلوک with"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+    
+    def count(self) -> int:
+        """تعداد کل مشاهدات در همه برچسب‌ها"""
+        with self._lock:
+            return sum(int(series[-1]) for series in self._series.values())
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        lines = []
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {series[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+class MetricsRegistry:
+    """مجموعه متریک‌ها و تبدیل آن‌ها به قالب متنی Prometheus
+    
+    علاوه بر Counter و Histogram، آمار stats() اجزای موجود (کش، صف ارسال و ...)
+    با register_stats به صورت gauge صادر می‌شود تا شمارنده‌ها دوباره نگهداری نشوند.
+    """
+    
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._stats: Dict[str, Callable[[], Dict[str, Any]]] = {}
+    
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+    
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def register_stats(self, prefix: str, stats: Callable[[], Dict[str, Any]]):
+        """صدور مقادیر عددی یک تابع stats() به صورت gauge با پیشوند prefix"""
+        self._stats[prefix] = stats
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.samples())
+        for prefix, stats in self._stats.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error(f"خطا در خواندن آمار {prefix}: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{prefix}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+class BotMetrics(MetricsRegistry):
+    """متریک‌های یک نمونه ربات
+    
+    هر ربات مجموعه جداگانه خود را دارد و آن را به اجزایش (لایه دیتابیس، کلاینت
+    DeepSeek و زمان‌بند تولید) می‌دهد، پس چند ربات در یک فرایند (آزمون‌ها و
+    بنچمارک‌ها) شمارنده‌ها و آمار یکدیگر را تغییر نمی‌دهند. اجزایی که بدون
+    ربات ساخته می‌شوند مجموعه مستقل خود را می‌سازند.
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.handler_latency = self.histogram(
+            "bot_handler_duration_seconds", "Handler latency by handler and button branch", ("handler",))
+        self.deepseek_latency = self.histogram(
+            "deepseek_request_duration_seconds", "Lesson generation latency including retries", ("outcome",))
+        self.deepseek_responses = self.counter(
+            "deepseek_responses_total", "DeepSeek attempts by HTTP status or error kind", ("status",))
+        self.deepseek_tokens = self.counter(
+            "deepseek_tokens_total", "Tokens reported in the usage field", ("kind",))
+        self.generation_queue_wait = self.histogram(
+            "generation_queue_wait_seconds", "Time lesson generations wait for a DeepSeek slot", ("priority",))
+        self.db_query_latency = self.histogram(
+            "db_query_duration_seconds", "SQLite operation time on the DB worker thread", ("operation",),
+            buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+
 @dataclass
 class LessonContent:
     """ساختار محتوای درس"""
     title: str
     sections: List[str]
 
-class DatabaseManager:
+@dataclass
+class LessonSection:
+    """یک بخش از درس به همراه اطلاعات فهرست بخش‌ها"""
+    index: int
+    text: Optional[str]
+    total: int
+    exercise_index: Optional[int]
+    # در درس‌های در حال تولید، total فقط تعداد بخش‌های آماده تا این لحظه است
+    complete: bool = True
+
+@dataclass
+class GenerationResult:
+    """نتیجه یک درخواست تولید درس به همراه وضعیت، زمان و مصرف توکن"""
+    content: Optional[str] = None
+    status_code: Optional[int] = None
+    latency: float = 0.0
+    attempts: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    error_kind: Optional[str] = None
+    error_message: Optional[str] = None
+    retry_after: Optional[float] = None
+    # پاسخ کامل دریافت شده است (در حالت جریانی: [DONE] یا finish_reason دیده شده)
+    complete: bool = True
+    # دلیل پایان تولید از پاسخ API؛ "length" یعنی متن در سقف max_tokens بریده شده است
+    finish_reason: Optional[str] = None
+    
+    @property
+    def ok(self) -> bool:
+        """موفقیت فقط با محتوای غیرخالی و پاسخ کامل؛ در غیر این صورت درس ذخیره نمی‌شود"""
+        return self.error_kind is None and self.complete and bool(self.content and self.content.strip())
+    
+    @property
+    def retryable(self) -> bool:
+        """خطاهای موقتی که ارزش تلاش دوباره دارند"""
+        if self.error_kind in (ERROR_TIMEOUT, ERROR_CONNECTION, ERROR_STREAM_TRUNCATED, ERROR_EMPTY_CONTENT):
+            return True
+        return self.error_kind == ERROR_HTTP and self.status_code in RETRYABLE_STATUS_CODES
+    
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+@dataclass(frozen=True)
+class CachedLesson:
+    """درس تقسیم‌شده نگهداری‌شده در حافظه"""
+    sections: Tuple[str, ...]
+    exercise_index: Optional[int]
+    size_bytes: int
+    
+    def section(self, index: int) -> LessonSection:
+        """ساخت LessonSection برای یک بخش"""
+        text = self.sections[index] if 0 <= index < len(self.sections) else None
+        return LessonSection(index, text, len(self.sections), self.exercise_index)
+
+class LessonCache:
+    """کش LRU درون‌حافظه‌ای دروس پرتکرار با محدودیت تعداد و حجم"""
+    
+    def __init__(self, max_items: int, max_bytes: int):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[int, int], CachedLesson]" = OrderedDict()
+        self.total_bytes = 0
+        # با هر باطل‌سازی افزایش می‌یابد تا خواندن‌های قدیمی دوباره کش نشوند
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return key in self._entries
+    
+    def get(self, key: Tuple[int, int]) -> Optional[CachedLesson]:
+        """دریافت درس و انتقال آن به انتهای صف LRU"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+    
+    def put(self, key: Tuple[int, int], sections: List[str], exercise_index: Optional[int],
+            epoch: Optional[int] = None) -> CachedLesson:
+        """افزودن درس؛ اگر از زمان خواندن باطل‌سازی رخ داده باشد کش نمی‌شود"""
+        size_bytes = sum(len(section.encode("utf-8")) for section in sections)
+        entry = CachedLesson(tuple(sections), exercise_index, size_bytes)
+        if epoch is not None and epoch != self.epoch:
+            return entry
+        if size_bytes > self.max_bytes:
+            return entry
+        
+        self._remove(key)
+        self._entries[key] = entry
+        self.total_bytes += size_bytes
+        while len(self._entries) > self.max_items or self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.size_bytes
+            self.evictions += 1
+        return entry
+    
+    def invalidate(self, key: Tuple[int, int]):
+        """حذف صریح درس پس از نوشتن محتوای جدید"""
+        self.epoch += 1
+        if self._remove(key):
+            self.invalidations += 1
+    
+    def _remove(self, key: Tuple[int, int]) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry.size_bytes
+        return True
+    
+    def stats(self) -> Dict[str, float]:
+        """آمار کش برای تنظیم ظرفیت"""
+        lookups = self.hits + self.misses
+        return {
+            "items": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+class UserSession:
+    """وضعیت فعلی یک کاربر فعال
+    
+    با __slots__ هر نمونه دیکشنری ویژگی ندارد و حافظه آن ثابت و کم است.
+    """
+    __slots__ = ("user_id", "chapter", "lesson", "section", "section_count", "message_id", "expires_at")
+    
+    def __init__(self, user_id: int, chapter: int = 0, lesson: int = 0, section: int = 0,
+                 section_count: int = 0, message_id: Optional[int] = None, expires_at: float = 0.0):
+        self.user_id = user_id
+        self.chapter = chapter
+        self.lesson = lesson
+        self.section = section
+        self.section_count = section_count
+        self.message_id = message_id
+        self.expires_at = expires_at
+    
+    def size_bytes(self) -> int:
+        """حجم تقریبی نمونه و مقادیر غیرمشترک آن"""
+        size = sys.getsizeof(self)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            # اعداد کوچک (-5 تا 256) و None بین همه مشترک هستند
+            if isinstance(value, (int, float)) and not -5 <= value <= 256:
+                size += sys.getsizeof(value)
+        return size
+
+class SessionStore:
+    """جلسه‌های کاربران فعال با انقضای TTL و سقف تعداد
+    
+    ترتیب OrderedDict ترتیب آخرین استفاده است و انقضا با هر استفاده تمدید
+    می‌شود، پس جلسه‌های منقضی همیشه در ابتدای صف هستند و با هر put حذف
+    می‌شوند. جلسه فقط کش است؛ پیشرفت کاربر جداگانه در دیتابیس نوشته می‌شود
+    و جلسه حذف‌شده در استفاده بعدی از دیتابیس ساخته می‌شود.
+    """
+    
+    def __init__(self, ttl: float = SESSION_TTL, max_sessions: int = SESSION_MAX_ACTIVE):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[int, UserSession]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+    
+    def __len__(self) -> int:
+        return len(self._sessions)
+    
+    def get(self, user_id: int) -> Optional[UserSession]:
+        """دریافت جلسه فعال و تمدید انقضای آن"""
+        session = self._sessions.get(user_id)
+        now = time.monotonic()
+        if session is None or session.expires_at <= now:
+            if session is not None:
+                del self._sessions[user_id]
+                self.expired += 1
+            self.misses += 1
+            return None
+        session.expires_at = now + self.ttl
+        self._sessions.move_to_end(user_id)
+        self.hits += 1
+        return session
+    
+    def put(self, session: UserSession):
+        """افزودن یا تمدید جلسه و حذف جلسه‌های منقضی و قدیمی‌ترین‌ها"""
+        now = time.monotonic()
+        session.expires_at = now + self.ttl
+        self._sessions[session.user_id] = session
+        self._sessions.move_to_end(session.user_id)
+        self.expire(now)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+    
+    def expire(self, now: Optional[float] = None) -> int:
+        """حذف جلسه‌های منقضی از ابتدای صف"""
+        now = time.monotonic() if now is None else now
+        removed = 0
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.expires_at > now:
+                break
+            self._sessions.popitem(last=False)
+            removed += 1
+        self.expired += removed
+        return removed
+    
+    def memory_bytes(self) -> int:
+        """حجم تقریبی جلسه‌ها به همراه جدول OrderedDict"""
+        return sys.getsizeof(self._sessions) + sum(session.size_bytes() for session in self._sessions.values())
+    
+    def stats(self) -> Dict[str, float]:
+        """آمار جلسه‌ها و حافظه هر جلسه فعال برای برنامه‌ریزی ظرفیت"""
+        lookups = self.hits + self.misses
+        memory = self.memory_bytes()
+        return {
+            "active": len(self._sessions),
+            "max_active": self.max_sessions,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "memory_bytes": memory,
+            "bytes_per_session": memory / len(self._sessions) if self._sessions else 0.0,
+        }
+
+class StorageUnavailable(Exception):
+    """ذخیره‌ساز (مثلاً سرور ذخیره‌ساز مشترک) در دسترس نیست
+    
+    به جای مقدار پیش‌فرض برگردانده می‌شود تا قطعی ذخیره‌ساز با «کاربر بدون
+    پیشرفت» یا «درس کش‌نشده» اشتباه نشود.
+    """
+
+class StorageBackend(ABC):
+    """رابط ذخیره‌سازی کش دروس و پیشرفت کاربران
+    
+    متدها همگام هستند و AsyncDatabaseManager آن‌ها را روی نخ اختصاصی اجرا
+    می‌کند. پیاده‌سازی‌ها: DatabaseManager (SQLite محلی)، RemoteStorage (سرور
+    ذخیره‌ساز مشترک بین چند نمونه ربات) و MemoryStorage (برای آزمایش).
+    
+    claim_generation یک قفل زمان‌دار برای تولید درس است تا نمونه‌هایی که
+    ذخیره‌ساز مشترک دارند یک درس را همزمان تولید نکنند.
+    """
+    
+    @abstractmethod
+    def get_lesson_content(self, chapter: int, lesson: int) -> Optional[str]:
+        ...
+    
+    @abstractmethod
+    def save_lesson_content(self, chapter: int, lesson: int, content: str, sections: Optional[List[str]] = None,
+                            version: Optional[str] = None):
+        ...
+    
+    @abstractmethod
+    def get_lesson_sections(self, chapter: int, lesson: int) -> Optional[Tuple[List[str], Optional[int]]]:
+        ...
+    
+    def get_lesson_section(self, chapter: int, lesson: int, section_index: int) -> Optional[LessonSection]:
+        loaded = self.get_lesson_sections(chapter, lesson)
+        if loaded is None:
+            return None
+        sections, exercise_index = loaded
+        text = sections[section_index] if 0 <= section_index < len(sections) else None
+        return LessonSection(section_index, text, len(sections), exercise_index)
+    
+    def has_lesson(self, chapter: int, lesson: int) -> bool:
+        return self.get_lesson_content(chapter, lesson) is not None
+    
+    @abstractmethod
+    def get_user_progress(self, user_id: int) -> Tuple[int, int, int]:
+        ...
+    
+    def update_user_progress(self, user_id: int, chapter: int, lesson: int, section_index: int):
+        self.update_user_progress_many([(user_id, chapter, lesson, section_index, datetime.now())])
+    
+    @abstractmethod
+    def update_user_progress_many(self, rows: List[Tuple[int, int, int, int, datetime]]):
+        ...
+    
+    @abstractmethod
+    def claim_generation(self, chapter: int, lesson: int, owner: str, ttl: float) -> bool:
+        """گرفتن قفل تولید درس؛ اگر نمونه دیگری قفل معتبر داشته باشد False"""
+    
+    @abstractmethod
+    def release_generation(self, chapter: int, lesson: int, owner: str):
+        ...
+    
+    @abstractmethod
+    def delete_stale_lessons(self, expected: List[Tuple[int, int, str]]) -> List[Tuple[int, int]]:
+        """حذف دروسی که نسخه ذخیره‌شده آن‌ها با نسخه مورد انتظار فرق دارد"""
+    
+    @abstractmethod
+    def lesson_storage_stats(self) -> Dict[str, Any]:
+        """حجم دروس ذخیره‌شده پیش و پس از فشرده‌سازی"""
+    
+    def close(self):
+        pass
+
+def compress_text(text: str, level: int = LESSON_COMPRESSION_LEVEL) -> bytes:
+    """فشرده‌سازی متن درس برای ذخیره در دیتابیس"""
+    return zlib.compress(text.encode("utf-8"), level)
+
+def decompress_text(value) -> Optional[str]:
+    """بازگردانی متن درس (ردیف‌های قدیمی به صورت متن خام ذخیره شده‌اند)"""
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode("utf-8")
+    return value
+
+class DatabaseManager(StorageBackend):
     """مدیریت دیتابیس SQLite"""
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, compression_level: int = LESSON_COMPRESSION_LEVEL):
         self.db_path = db_path
+        self.compression_level = compression_level
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
         self.init_db()
     
+    def _connect(self) -> sqlite3.Connection:
+        """دریافت اتصال ماندگار با تنظیمات بهینه SQLite"""
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            # حالت WAL اجازه خواندن همزمان با نوشتن را می‌دهد
+            conn.execute("PRAGMA journal_mode=WAL")
+            # در حالت WAL، سطح NORMAL بدون fsync در هر commit ایمن است
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-8000")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._conn = conn
+        return self._conn
+    
+    def close(self):
+        """بستن اتصال دیتابیس"""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+    
     def init_db(self):
         """ایجاد جداول دیتابیس"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
+            with self._lock, self._connect() as conn:
                 cursor = conn.cursor()
                 
                 # جدول کش دروس
@@ -81,6 +833,29 @@ class DatabaseManager:
                     )
                 ''')
                 
+                # ستون‌های فهرست بخش‌ها برای دیتابیس‌های قدیمی
+                columns = {row[1] for row in cursor.execute("PRAGMA table_info(lessons_cache)")}
+                if "section_count" not in columns:
+                    cursor.execute("ALTER TABLE lessons_cache ADD COLUMN section_count INTEGER")
+                if "exercise_index" not in columns:
+                    cursor.execute("ALTER TABLE lessons_cache ADD COLUMN exercise_index INTEGER")
+                if "version" not in columns:
+                    cursor.execute("ALTER TABLE lessons_cache ADD COLUMN version TEXT")
+                # حجم خام محتوا و بخش‌ها تا آمار ذخیره‌سازی بدون باز کردن فشرده‌سازی خوانده شود
+                if "raw_size" not in columns:
+                    cursor.execute("ALTER TABLE lessons_cache ADD COLUMN raw_size INTEGER")
+                
+                # جدول بخش‌های از پیش تقسیم‌شده دروس
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS lesson_sections (
+                        chapter INTEGER,
+                        lesson INTEGER,
+                        section_index INTEGER,
+                        content TEXT,
+                        PRIMARY KEY (chapter, lesson, section_index)
+                    ) WITHOUT ROWID
+                ''')
+                
                 # جدول پیشرفت کاربران
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS user_progress (
@@ -92,44 +867,162 @@ class DatabaseManager:
                     )
                 ''')
                 
-                conn.commit()
+                # قفل‌های تولید درس بین فرایندهایی که این فایل را مشترک دارند
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS generation_leases (
+                        chapter INTEGER,
+                        lesson INTEGER,
+                        owner TEXT,
+                        expires_at REAL,
+                        PRIMARY KEY (chapter, lesson)
+                    )
+                ''')
+                
+                if "raw_size" not in columns:
+                    self._backfill_raw_size(conn)
         except Exception as e:
             logger.error(f"خطا در ایجاد دیتابیس: {e}")
     
+    @staticmethod
+    def _backfill_raw_size(conn: sqlite3.Connection):
+        """محاسبه یک‌باره حجم خام دروسی که پیش از وجود ستون raw_size ذخیره شده‌اند"""
+        rows = conn.execute("SELECT chapter, lesson, content FROM lessons_cache").fetchall()
+        for chapter, lesson, content in rows:
+            raw = len((decompress_text(content) or "").encode("utf-8"))
+            for (section,) in conn.execute(
+                "SELECT content FROM lesson_sections WHERE chapter=? AND lesson=?", (chapter, lesson)
+            ):
+                raw += len((decompress_text(section) or "").encode("utf-8"))
+            conn.execute("UPDATE lessons_cache SET raw_size=? WHERE chapter=? AND lesson=?", (raw, chapter, lesson))
+    
     def get_lesson_content(self, chapter: int, lesson: int) -> Optional[str]:
         """دریافت محتوای کش شده درس"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
+            with self._lock:
+                cursor = self._connect().execute(
                     "SELECT content FROM lessons_cache WHERE chapter=? AND lesson=?",
                     (chapter, lesson)
                 )
                 result = cursor.fetchone()
-                return result[0] if result else None
+                return decompress_text(result[0]) if result else None
         except Exception as e:
             logger.error(f"خطا در خواندن کش درس: {e}")
             return None
     
-    def save_lesson_content(self, chapter: int, lesson: int, content: str):
-        """ذخیره محتوای درس در کش"""
+    def save_lesson_content(self, chapter: int, lesson: int, content: str, sections: Optional[List[str]] = None,
+                            version: Optional[str] = None):
+        """ذخیره محتوای درس در کش به همراه فهرست بخش‌ها و نسخه محتوا"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT OR REPLACE INTO lessons_cache (chapter, lesson, content) VALUES (?, ?, ?)",
-                    (chapter, lesson, content)
-                )
-                conn.commit()
+            if sections is None:
+                sections = MessageSplitter.split_message(content)
+            with self._lock, self._connect() as conn:
+                self._write_lesson(conn, chapter, lesson, content, sections, version)
         except Exception as e:
             logger.error(f"خطا در ذخیره کش درس: {e}")
     
+    def _write_lesson(self, conn: sqlite3.Connection, chapter: int, lesson: int, content: str, sections: List[str],
+                      version: Optional[str]):
+        """نوشتن محتوا و بخش‌های فشرده درس در یک تراکنش"""
+        conn.execute(
+            "INSERT OR REPLACE INTO lessons_cache "
+            "(chapter, lesson, content, section_count, exercise_index, version, raw_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (chapter, lesson, compress_text(content, self.compression_level), len(sections),
+             MessageSplitter.find_exercise_index(sections), version,
+             len(content.encode("utf-8")) + sum(len(section.encode("utf-8")) for section in sections))
+        )
+        conn.execute("DELETE FROM lesson_sections WHERE chapter=? AND lesson=?", (chapter, lesson))
+        conn.executemany(
+            "INSERT INTO lesson_sections (chapter, lesson, section_index, content) VALUES (?, ?, ?, ?)",
+            [(chapter, lesson, i, compress_text(section, self.compression_level)) for i, section in enumerate(sections)]
+        )
+    
+    def get_lesson_section(self, chapter: int, lesson: int, section_index: int) -> Optional[LessonSection]:
+        """دریافت فقط یک بخش از درس کش شده
+        
+        اگر درس در کش نباشد None برمی‌گرداند؛ اگر شماره بخش خارج از محدوده
+        باشد، text برابر None است اما تعداد بخش‌ها معتبر است.
+        """
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute('''
+                    SELECT c.section_count, c.exercise_index, s.content
+                    FROM lessons_cache c
+                    LEFT JOIN lesson_sections s
+                        ON s.chapter = c.chapter AND s.lesson = c.lesson AND s.section_index = ?
+                    WHERE c.chapter = ? AND c.lesson = ?
+                ''', (section_index, chapter, lesson)).fetchone()
+                if not row:
+                    return None
+                
+                section_count, exercise_index, text = row
+                if section_count is None:
+                    sections = self._index_legacy_lesson(conn, chapter, lesson)
+                    section_count = len(sections)
+                    exercise_index = MessageSplitter.find_exercise_index(sections)
+                    text = sections[section_index] if 0 <= section_index < section_count else None
+                
+                return LessonSection(section_index, decompress_text(text), section_count, exercise_index)
+        except Exception as e:
+            logger.error(f"خطا در خواندن بخش درس: {e}")
+            return None
+    
+    def get_lesson_sections(self, chapter: int, lesson: int) -> Optional[Tuple[List[str], Optional[int]]]:
+        """دریافت همه بخش‌های درس به ترتیب به همراه شماره بخش تمرینات"""
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT section_count, exercise_index FROM lessons_cache WHERE chapter=? AND lesson=?",
+                    (chapter, lesson)
+                ).fetchone()
+                if not row:
+                    return None
+                
+                section_count, exercise_index = row
+                if section_count is None:
+                    sections = self._index_legacy_lesson(conn, chapter, lesson)
+                    return sections, MessageSplitter.find_exercise_index(sections)
+                
+                rows = conn.execute(
+                    "SELECT content FROM lesson_sections WHERE chapter=? AND lesson=? ORDER BY section_index",
+                    (chapter, lesson)
+                ).fetchall()
+                return [decompress_text(r[0]) for r in rows], exercise_index
+        except Exception as e:
+            logger.error(f"خطا در خواندن بخش‌های درس: {e}")
+            return None
+    
+    def _index_legacy_lesson(self, conn: sqlite3.Connection, chapter: int, lesson: int) -> List[str]:
+        """ساخت فهرست بخش‌ها برای درس‌هایی که پیش از وجود آن ذخیره شده‌اند"""
+        content, version = conn.execute(
+            "SELECT content, version FROM lessons_cache WHERE chapter=? AND lesson=?",
+            (chapter, lesson)
+        ).fetchone()
+        content = decompress_text(content) or ""
+        sections = MessageSplitter.split_message(content)
+        with conn:
+            self._write_lesson(conn, chapter, lesson, content, sections, version)
+        return sections
+    
+    def has_lesson(self, chapter: int, lesson: int) -> bool:
+        """بررسی وجود درس در کش بدون خواندن محتوای آن"""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT 1 FROM lessons_cache WHERE chapter=? AND lesson=?",
+                    (chapter, lesson)
+                ).fetchone()
+                return row is not None
+        except Exception as e:
+            logger.error(f"خطا در خواندن کش درس: {e}")
+            return False
+    
     def get_user_progress(self, user_id: int) -> Tuple[int, int, int]:
         """دریافت پیشرفت کاربر"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
+            with self._lock:
+                cursor = self._connect().execute(
                     "SELECT chapter, lesson, section_index FROM user_progress WHERE user_id=?",
                     (user_id,)
                 )
@@ -139,79 +1032,702 @@ class DatabaseManager:
             logger.error(f"خطا در خواندن پیشرفت کاربر: {e}")
             return (0, 0, 0)
     
-    def update_user_progress(self, user_id: int, chapter: int, lesson: int, section_index: int):
-        """به‌روزرسانی پیشرفت کاربر"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                    INSERT OR REPLACE INTO user_progress 
-                    (user_id, chapter, lesson, section_index, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (user_id, chapter, lesson, section_index, datetime.now()))
-                conn.commit()
-        except Exception as e:
-            logger.error(f"خطا در به‌روزرسانی پیشرفت کاربر: {e}")
+    def update_user_progress(self, user_id: int, chapter: int, lesson: int, section_index: int):
+        """به‌روزرسانی پیشرفت کاربر"""
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO user_progress 
+                    (user_id, chapter, lesson, section_index, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (user_id, chapter, lesson, section_index, datetime.now()))
+        except Exception as e:
+            logger.error(f"خطا در به‌روزرسانی پیشرفت کاربر: {e}")
+    
+    def update_user_progress_many(self, rows: List[Tuple[int, int, int, int, datetime]]):
+        """به‌روزرسانی پیشرفت چند کاربر در یک تراکنش"""
+        try:
+            with self._lock, self._connect() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO user_progress 
+                    (user_id, chapter, lesson, section_index, updated_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', rows)
+        except Exception as e:
+            logger.error(f"خطا در به‌روزرسانی دسته‌ای پیشرفت کاربران: {e}")
+    
+    def claim_generation(self, chapter: int, lesson: int, owner: str, ttl: float) -> bool:
+        """گرفتن یا تمدید قفل تولید درس (قفل منقضی‌شده قابل تصاحب است)"""
+        now = time.time()
+        try:
+            with self._lock, self._connect() as conn:
+                cursor = conn.execute('''
+                    INSERT INTO generation_leases (chapter, lesson, owner, expires_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (chapter, lesson) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                    WHERE generation_leases.expires_at < ? OR generation_leases.owner = excluded.owner
+                ''', (chapter, lesson, owner, now + ttl, now))
+                return cursor.rowcount == 1
+        except Exception as e:
+            # بدون دسترسی به قفل، تولید محلی بهتر از منتظر ماندن است
+            logger.error(f"خطا در گرفتن قفل تولید درس: {e}")
+            return True
+    
+    def release_generation(self, chapter: int, lesson: int, owner: str):
+        """آزاد کردن قفل تولید درس"""
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute(
+                    "DELETE FROM generation_leases WHERE chapter=? AND lesson=? AND owner=?",
+                    (chapter, lesson, owner)
+                )
+        except Exception as e:
+            logger.error(f"خطا در آزاد کردن قفل تولید درس: {e}")
+    
+    def delete_stale_lessons(self, expected: List[Tuple[int, int, str]]) -> List[Tuple[int, int]]:
+        """حذف دروس با نسخه قدیمی (یا بدون نسخه) از هر دو جدول"""
+        versions = {(chapter, lesson): version for chapter, lesson, version in expected}
+        try:
+            with self._lock, self._connect() as conn:
+                stale = [
+                    (chapter, lesson)
+                    for chapter, lesson, version in conn.execute("SELECT chapter, lesson, version FROM lessons_cache")
+                    if (chapter, lesson) in versions and versions[(chapter, lesson)] != version
+                ]
+                conn.executemany("DELETE FROM lessons_cache WHERE chapter=? AND lesson=?", stale)
+                conn.executemany("DELETE FROM lesson_sections WHERE chapter=? AND lesson=?", stale)
+                return stale
+        except Exception as e:
+            logger.error(f"خطا در حذف نسخه‌های قدیمی دروس: {e}")
+            return []
+    
+    def lesson_storage_stats(self) -> Dict[str, Any]:
+        """حجم خام و فشرده محتوا و بخش‌های دروس ذخیره‌شده
+        
+        فقط ستون raw_size و طول مقادیر ذخیره‌شده خوانده می‌شود و هیچ درسی از
+        حالت فشرده خارج نمی‌شود. در صورت خطای دیتابیس دیکشنری خالی برمی‌گردد.
+        """
+        try:
+            with self._lock:
+                conn = self._connect()
+                # ردیف‌های قدیمی به صورت متن خام ذخیره شده‌اند و طولشان بر حسب بایت محاسبه می‌شود
+                lessons, versioned, raw, stored = conn.execute('''
+                    SELECT COUNT(*), COUNT(version), COALESCE(SUM(raw_size), 0),
+                           COALESCE(SUM(CASE typeof(content) WHEN 'text' THEN length(CAST(content AS BLOB))
+                                                             ELSE length(content) END), 0)
+                    FROM lessons_cache
+                ''').fetchone()
+                stored += conn.execute("SELECT COALESCE(SUM(length(content)), 0) FROM lesson_sections").fetchone()[0]
+        except sqlite3.Error as e:
+            logger.error(f"خطا در خواندن آمار ذخیره‌سازی دروس: {e}")
+            return {}
+        return {
+            "lessons": lessons,
+            "versioned": versioned,
+            "raw_bytes": raw,
+            "stored_bytes": stored,
+            "saved_bytes": raw - stored,
+            "ratio": stored / raw if raw else 1.0,
+        }
+
+class MemoryStorage(StorageBackend):
+    """ذخیره‌ساز درون‌حافظه‌ای برای آزمایش‌ها و بنچمارک‌ها"""
+    
+    def __init__(self):
+        self._lessons: Dict[Tuple[int, int], Tuple[str, List[str], Optional[int], Optional[str]]] = {}
+        self._progress: Dict[int, Tuple[int, int, int]] = {}
+        self._leases: Dict[Tuple[int, int], Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+    
+    def get_lesson_content(self, chapter: int, lesson: int) -> Optional[str]:
+        entry = self._lessons.get((chapter, lesson))
+        return entry[0] if entry else None
+    
+    def save_lesson_content(self, chapter: int, lesson: int, content: str, sections: Optional[List[str]] = None,
+                            version: Optional[str] = None):
+        if sections is None:
+            sections = MessageSplitter.split_message(content)
+        with self._lock:
+            self._lessons[(chapter, lesson)] = (
+                content, list(sections), MessageSplitter.find_exercise_index(sections), version
+            )
+    
+    def get_lesson_sections(self, chapter: int, lesson: int) -> Optional[Tuple[List[str], Optional[int]]]:
+        entry = self._lessons.get((chapter, lesson))
+        return (list(entry[1]), entry[2]) if entry else None
+    
+    def get_user_progress(self, user_id: int) -> Tuple[int, int, int]:
+        return self._progress.get(user_id, (0, 0, 0))
+    
+    def update_user_progress_many(self, rows: List[Tuple[int, int, int, int, datetime]]):
+        with self._lock:
+            for user_id, chapter, lesson, section_index, _ in rows:
+                self._progress[user_id] = (chapter, lesson, section_index)
+    
+    def claim_generation(self, chapter: int, lesson: int, owner: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            current = self._leases.get((chapter, lesson))
+            if current is not None and current[0] != owner and current[1] >= now:
+                return False
+            self._leases[(chapter, lesson)] = (owner, now + ttl)
+            return True
+    
+    def release_generation(self, chapter: int, lesson: int, owner: str):
+        with self._lock:
+            current = self._leases.get((chapter, lesson))
+            if current is not None and current[0] == owner:
+                del self._leases[(chapter, lesson)]
+    
+    def delete_stale_lessons(self, expected: List[Tuple[int, int, str]]) -> List[Tuple[int, int]]:
+        versions = {(chapter, lesson): version for chapter, lesson, version in expected}
+        with self._lock:
+            stale = [key for key, entry in self._lessons.items() if key in versions and versions[key] != entry[3]]
+            for key in stale:
+                del self._lessons[key]
+        return stale
+    
+    def lesson_storage_stats(self) -> Dict[str, Any]:
+        # در حافظه فشرده‌سازی انجام نمی‌شود
+        raw = sum(len(entry[0].encode("utf-8")) + sum(len(s.encode("utf-8")) for s in entry[1])
+                  for entry in list(self._lessons.values()))
+        return {
+            "lessons": len(self._lessons),
+            "versioned": sum(1 for entry in list(self._lessons.values()) if entry[3] is not None),
+            "raw_bytes": raw,
+            "stored_bytes": raw,
+            "saved_bytes": 0,
+            "ratio": 1.0,
+        }
+
+class RemoteStorage(StorageBackend):
+    """ذخیره‌ساز شبکه‌ای: فراخوانی متدهای StorageBackend روی StorageServer
+    
+    چند نمونه ربات با یک STORAGE_URL مشترک، کش دروس، پیشرفت کاربران و
+    قفل‌های تولید درس را به اشتراک می‌گذارند. فراخوانی‌ها همگام هستند و
+    مانند SQLite روی نخ دیتابیس AsyncDatabaseManager اجرا می‌شوند.
+    """
+    
+    def __init__(self, url: str = STORAGE_URL, token: str = STORAGE_TOKEN, timeout: float = STORAGE_TIMEOUT):
+        headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.client = httpx.Client(base_url=url, headers=headers, timeout=timeout)
+    
+    def _call(self, method: str, *args):
+        """یک فراخوانی RPC؛ هر خطای شبکه یا سرور StorageUnavailable می‌شود"""
+        try:
+            response = self.client.post("/rpc", json={"method": method, "args": list(args)})
+            response.raise_for_status()
+            return response.json()["result"]
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.error(f"خطا در فراخوانی ذخیره‌ساز شبکه‌ای ({method}): {e}")
+            raise StorageUnavailable(f"{method}: {e}") from e
+    
+    def get_lesson_content(self, chapter: int, lesson: int) -> Optional[str]:
+        return self._call("get_lesson_content", chapter, lesson)
+    
+    def save_lesson_content(self, chapter: int, lesson: int, content: str, sections: Optional[List[str]] = None,
+                            version: Optional[str] = None):
+        self._call("save_lesson_content", chapter, lesson, content, sections, version)
+    
+    def get_lesson_sections(self, chapter: int, lesson: int) -> Optional[Tuple[List[str], Optional[int]]]:
+        result = self._call("get_lesson_sections", chapter, lesson)
+        return (result[0], result[1]) if result else None
+    
+    def get_lesson_section(self, chapter: int, lesson: int, section_index: int) -> Optional[LessonSection]:
+        result = self._call("get_lesson_section", chapter, lesson, section_index)
+        return LessonSection(**result) if result else None
+    
+    def has_lesson(self, chapter: int, lesson: int) -> bool:
+        return bool(self._call("has_lesson", chapter, lesson))
+    
+    def get_user_progress(self, user_id: int) -> Tuple[int, int, int]:
+        return tuple(self._call("get_user_progress", user_id))
+    
+    def update_user_progress_many(self, rows: List[Tuple[int, int, int, int, datetime]]):
+        # زمان به همان قالب متنی ذخیره‌شده در SQLite ارسال می‌شود
+        self._call("update_user_progress_many", [list(row[:4]) + [str(row[4])] for row in rows])
+    
+    def claim_generation(self, chapter: int, lesson: int, owner: str, ttl: float) -> bool:
+        # اگر سرور در دسترس نباشد تولید محلی انجام می‌شود
+        try:
+            return bool(self._call("claim_generation", chapter, lesson, owner, ttl))
+        except StorageUnavailable:
+            return True
+    
+    def release_generation(self, chapter: int, lesson: int, owner: str):
+        # قفل آزادنشده پس از ttl خودبه‌خود منقضی می‌شود
+        with contextlib.suppress(StorageUnavailable):
+            self._call("release_generation", chapter, lesson, owner)
+    
+    def delete_stale_lessons(self, expected: List[Tuple[int, int, str]]) -> List[Tuple[int, int]]:
+        result = self._call("delete_stale_lessons", [list(item) for item in expected])
+        return [tuple(item) for item in result]
+    
+    def lesson_storage_stats(self) -> Dict[str, Any]:
+        return self._call("lesson_storage_stats")
+    
+    def close(self):
+        self.client.close()
+
+def create_storage(config: BotConfig) -> StorageBackend:
+    """ساخت ذخیره‌ساز بر اساس تنظیمات"""
+    kind = config.storage_backend
+    if kind == "sqlite":
+        return DatabaseManager(config.db_path, config.lesson_compression_level)
+    if kind == "remote":
+        return RemoteStorage(config.storage_url, config.storage_token, config.storage_timeout)
+    if kind == "memory":
+        return MemoryStorage()
+    raise ValueError(f"نوع ذخیره‌ساز نامعتبر: {kind}")
+
+class AsyncDatabaseManager:
+    """لایه غیرمسدودکننده دیتابیس برای استفاده در حلقه asyncio
+    
+    تمام عملیات روی یک نخ اختصاصی و با اتصال ماندگار اجرا می‌شوند
+    تا fsync یا قفل دیتابیس هیچ‌وقت حلقه رویداد را متوقف نکند.
+    """
+    
+    def __init__(self, db_manager: StorageBackend, lesson_cache: Optional[LessonCache] = None,
+                 flush_interval: float = PROGRESS_FLUSH_INTERVAL, flush_max_pending: int = PROGRESS_FLUSH_MAX_PENDING,
+                 metrics: Optional[BotMetrics] = None):
+        self.db_manager = db_manager
+        self.metrics = metrics or BotMetrics()
+        self.lesson_cache = lesson_cache or LessonCache(LESSON_CACHE_MAX_ITEMS, LESSON_CACHE_MAX_BYTES)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-worker")
+        
+        # آخرین موقعیت کاربرانی که هنوز در دیتابیس نوشته نشده‌اند
+        self.flush_interval = flush_interval
+        self.flush_max_pending = flush_max_pending
+        self._pending_progress: Dict[int, Tuple[int, int, int, int, datetime]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.progress_updates = 0
+        self.progress_flushes = 0
+        self.progress_rows_written = 0
+    
+    async def _run(self, func, *args):
+        """اجرای یک عملیات دیتابیس روی نخ اختصاصی"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._timed, func, args)
+    
+    def _timed(self, func, args):
+        with self.metrics.db_query_latency.time(operation=func.__name__):
+            return func(*args)
+    
+    async def get_lesson_content(self, chapter: int, lesson: int) -> Optional[str]:
+        """دریافت محتوای کش شده درس"""
+        return await self._run(self.db_manager.get_lesson_content, chapter, lesson)
+    
+    async def save_lesson_content(self, chapter: int, lesson: int, content: str, sections: Optional[List[str]] = None,
+                                  version: Optional[str] = None):
+        """ذخیره محتوای درس در کش"""
+        await self._run(self.db_manager.save_lesson_content, chapter, lesson, content, sections, version)
+        self.lesson_cache.invalidate((chapter, lesson))
+    
+    async def delete_stale_lessons(self, expected: List[Tuple[int, int, str]]) -> List[Tuple[int, int]]:
+        """حذف دروس با نسخه قدیمی از ذخیره‌ساز و کش درون‌حافظه‌ای"""
+        stale = await self._run(self.db_manager.delete_stale_lessons, expected)
+        for key in stale:
+            self.lesson_cache.invalidate(tuple(key))
+        return stale
+    
+    async def lesson_storage_stats(self) -> Dict[str, Any]:
+        """آمار حجم دروس ذخیره‌شده"""
+        return await self._run(self.db_manager.lesson_storage_stats)
+    
+    async def get_lesson_section(self, chapter: int, lesson: int, section_index: int) -> Optional[LessonSection]:
+        """دریافت یک بخش از درس؛ دروس پرتکرار از حافظه خوانده می‌شوند"""
+        key = (chapter, lesson)
+        cached = self.lesson_cache.get(key)
+        if cached is None:
+            epoch = self.lesson_cache.epoch
+            loaded = await self._run(self.db_manager.get_lesson_sections, chapter, lesson)
+            if loaded is None:
+                return None
+            sections, exercise_index = loaded
+            cached = self.lesson_cache.put(key, sections, exercise_index, epoch=epoch)
+        return cached.section(section_index)
+    
+    async def has_lesson(self, chapter: int, lesson: int) -> bool:
+        """بررسی وجود درس در کش"""
+        if (chapter, lesson) in self.lesson_cache:
+            return True
+        return await self._run(self.db_manager.has_lesson, chapter, lesson)
+    
+    async def get_lesson_sections(self, chapter: int, lesson: int) -> Optional[Tuple[List[str], Optional[int]]]:
+        """دریافت همه بخش‌های درس"""
+        cached = self.lesson_cache.get((chapter, lesson))
+        if cached is not None:
+            return list(cached.sections), cached.exercise_index
+        return await self._run(self.db_manager.get_lesson_sections, chapter, lesson)
+    
+    async def claim_generation(self, chapter: int, lesson: int, owner: str, ttl: float = GENERATION_LEASE_TTL) -> bool:
+        """گرفتن قفل تولید درس در ذخیره‌ساز"""
+        return await self._run(self.db_manager.claim_generation, chapter, lesson, owner, ttl)
+    
+    async def release_generation(self, chapter: int, lesson: int, owner: str):
+        """آزاد کردن قفل تولید درس"""
+        await self._run(self.db_manager.release_generation, chapter, lesson, owner)
+    
+    async def get_user_progress(self, user_id: int) -> Tuple[int, int, int]:
+        """دریافت پیشرفت کاربر؛ مقادیر نوشته‌نشده از حافظه خوانده می‌شوند"""
+        pending = self._pending_progress.get(user_id)
+        if pending is not None:
+            return pending[1:4]
+        # دسته‌های در حال نوشتن پیش از این خواندن در صف نخ دیتابیس قرار گرفته‌اند
+        return await self._run(self.db_manager.get_user_progress, user_id)
+    
+    async def update_user_progress(self, user_id: int, chapter: int, lesson: int, section_index: int):
+        """ثبت پیشرفت کاربر در حافظه و نوشتن دسته‌ای آن در دیتابیس"""
+        self._pending_progress[user_id] = (user_id, chapter, lesson, section_index, datetime.now())
+        self.progress_updates += 1
+        if len(self._pending_progress) >= self.flush_max_pending:
+            await self.flush_progress()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+    
+    async def _delayed_flush(self):
+        """نوشتن پیشرفت‌های در انتظار پس از فاصله زمانی تنظیم‌شده"""
+        try:
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            self._flush_task = None
+        await self.flush_progress()
+    
+    async def flush_progress(self):
+        """نوشتن همه پیشرفت‌های در انتظار در یک تراکنش"""
+        if not self._pending_progress:
+            return
+        rows = list(self._pending_progress.values())
+        self._pending_progress = {}
+        try:
+            await self._run(self.db_manager.update_user_progress_many, rows)
+        except StorageUnavailable:
+            # ردیف‌ها دوباره در صف قرار می‌گیرند مگر موقعیت جدیدتری برای همان کاربر ثبت شده باشد
+            for row in rows:
+                self._pending_progress.setdefault(row[0], row)
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+            logger.warning(f"ذخیره‌ساز در دسترس نیست؛ {len(rows)} پیشرفت در انتظار نوشتن باقی ماند")
+            return
+        self.progress_flushes += 1
+        self.progress_rows_written += len(rows)
+    
+    def progress_stats(self) -> Dict[str, int]:
+        """آمار نوشتن تاخیری پیشرفت کاربران"""
+        return {
+            "updates": self.progress_updates,
+            "flushes": self.progress_flushes,
+            "rows_written": self.progress_rows_written,
+            "pending": len(self._pending_progress),
+        }
+    
+    def close(self):
+        """اتمام کارهای در صف، نوشتن پیشرفت‌های باقی‌مانده و بستن اتصال"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._executor.shutdown(wait=True)
+        if self._pending_progress:
+            try:
+                self.db_manager.update_user_progress_many(list(self._pending_progress.values()))
+                self.progress_flushes += 1
+                self.progress_rows_written += len(self._pending_progress)
+                self._pending_progress = {}
+            except StorageUnavailable:
+                logger.error(f"ذخیره‌ساز در دسترس نیست؛ {len(self._pending_progress)} پیشرفت نوشته نشد")
+        logger.info(f"آمار کش درون‌حافظه‌ای دروس: {self.lesson_cache.stats()}")
+        logger.info(f"آمار نوشتن پیشرفت کاربران: {self.progress_stats()}")
+        self.db_manager.close()
+
+# قالب داده دکمه‌ها: "<نسخه قالب>|<عمل>|<آرگومان‌ها>" (حداکثر ۶۴ بایت در تلگرام)
+CALLBACK_FORMAT_VERSION = "1"
+CB_CHAPTER = "c"
+CB_LESSON = "l"
+CB_NAV_LESSON = "n"
+CB_BACK = "b"
+CB_NEXT = ">"
+CB_PREV = "<"
+CB_EXERCISES = "x"
+
+# نام هر عمل در متریک‌ها (همان نام‌های داده‌های قدیمی)
+CALLBACK_ROUTE_NAMES = {
+    CB_CHAPTER: "chapter",
+    CB_LESSON: "lesson",
+    CB_NAV_LESSON: "nav_lesson",
+    CB_BACK: "back_to_chapters",
+    CB_NEXT: "next_section",
+    CB_PREV: "prev_section",
+    CB_EXERCISES: "show_exercises",
+}
+
+class CallbackData:
+    """ساخت و خواندن داده فشرده دکمه‌های شیشه‌ای
+    
+    دکمه‌های بخش‌های درس فصل، درس، شماره بخش، نسخه درس و شناسه پایدار
+    درس را با خود دارند تا بدون خواندن پیشرفت کاربر پاسخ داده شوند و
+    دکمه‌های قدیمی در تاریخچه چت حتی پس از جابه‌جایی دروس به همان درس اشاره
+    کنند. دکمه‌های دروس هم شناسه درس را دارند. داده‌های قالب پیشین
+    (chapter_1، next_section و ...) هم برای پیام‌های قدیمی خوانده می‌شوند.
+    """
+    
+    SEPARATOR = "|"
+    LEGACY = {
+        "back_to_chapters": CB_BACK,
+        "next_section": CB_NEXT,
+        "prev_section": CB_PREV,
+        "show_exercises": CB_EXERCISES,
+    }
+    LEGACY_PREFIXES = (("nav_lesson_", CB_NAV_LESSON), ("chapter_", CB_CHAPTER), ("lesson_", CB_LESSON))
+    
+    @classmethod
+    def encode(cls, action: str, *args) -> str:
+        """ساخت داده دکمه برای یک عمل"""
+        return cls.SEPARATOR.join((CALLBACK_FORMAT_VERSION, action) + tuple(str(arg) for arg in args))
+    
+    @classmethod
+    def decode(cls, data: str) -> Tuple[Optional[str], List[str]]:
+        """عمل و آرگومان‌های داده دکمه؛ برای داده ناشناخته (None, [])"""
+        parts = data.split(cls.SEPARATOR)
+        if len(parts) >= 2 and parts[0] == CALLBACK_FORMAT_VERSION:
+            return parts[1], parts[2:]
+        if data in cls.LEGACY:
+            return cls.LEGACY[data], []
+        for prefix, action in cls.LEGACY_PREFIXES:
+            if data.startswith(prefix):
+                return action, data[len(prefix):].split("_")
+        return None, []
+    
+    @staticmethod
+    def parse_section(args: List[str]) -> Optional[Tuple[int, int, int, str, Optional[str]]]:
+        """خواندن موقعیت بخش، نسخه و شناسه درس از آرگومان‌ها؛ دکمه‌های قدیمی موقعیت ندارند
+        
+        دکمه‌های ساخته‌شده پیش از افزودن شناسه درس چهار آرگومان دارند (شناسه None).
+        """
+        if len(args) not in (4, 5):
+            return None
+        try:
+            return int(args[0]), int(args[1]), int(args[2]), args[3], (args[4] if len(args) == 5 else None)
+        except ValueError:
+            return None
+    
+    @staticmethod
+    def parse_lesson(args: List[str]) -> Optional[Tuple[int, int, Optional[str]]]:
+        """خواندن فصل، درس و شناسه درس (در دکمه‌های قدیمی None) از آرگومان‌ها"""
+        if len(args) not in (2, 3):
+            return None
+        try:
+            return int(args[0]), int(args[1]), (args[2] if len(args) == 3 else None)
+        except ValueError:
+            return None
+
+LessonKey = Tuple[int, int]
+
+@dataclass(frozen=True)
+class CurriculumIndex:
+    """منوها و فهرست‌های از پیش ساخته‌شده برنامه آموزشی
+    
+    یک بار هنگام بارگذاری chapters.json ساخته می‌شود و پس از آن فقط خوانده
+    می‌شود؛ اشیای InlineKeyboardMarkup تلگرام تغییرناپذیرند و بین همه
+    پاسخ‌ها مشترک هستند.
+    """
+    chapters_text: str
+    chapters_markup: Optional[InlineKeyboardMarkup]
+    lessons_text: Dict[int, str]
+    lessons_markup: Dict[int, InlineKeyboardMarkup]
+    # ترتیب خطی همه دروس و موقعیت هر درس در آن
+    lesson_order: Tuple[LessonKey, ...]
+    lesson_position: Dict[LessonKey, int]
+    nav_buttons: Dict[LessonKey, Tuple[InlineKeyboardButton, ...]]
+    # شناسه پایدار هر درس (مستقل از موقعیت) و موقعیت فعلی هر شناسه
+    lesson_refs: Dict[LessonKey, str]
+    ref_position: Dict[str, LessonKey]
+    
+    @staticmethod
+    def lesson_ref(chapter_title: str, lesson_title: str) -> str:
+        """شناسه کوتاه درس بر اساس عنوان فصل و درس برای داده دکمه‌ها"""
+        return hashlib.sha256(f"{chapter_title}\n{lesson_title}".encode("utf-8")).hexdigest()[:8]
+    
+    @classmethod
+    def build(cls, curriculum: Dict[str, Any]) -> "CurriculumIndex":
+        chapters = curriculum.get("chapters") or []
+        lesson_refs: Dict[LessonKey, str] = {
+            (chapter_num, lesson_num): cls.lesson_ref(chapter["title"], lesson["title"])
+            for chapter_num, chapter in enumerate(chapters, 1)
+            for lesson_num, lesson in enumerate(chapter.get("lessons", []), 1)
+        }
+        ref_position: Dict[str, LessonKey] = {}
+        for key, ref in lesson_refs.items():
+            # برای عنوان‌های تکراری اولین درس انتخاب می‌شود
+            ref_position.setdefault(ref, key)
+        
+        chapters_text = "📚 فصل‌های آموزشی:\n\n" + "".join(
+            f"{i}. {chapter['title']}\n" for i, chapter in enumerate(chapters, 1)
+        ) if chapters else "❌ فایل فصل‌ها یافت نشد."
+        chapters_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(text=f"فصل {i}: {chapter['title']}", callback_data=CallbackData.encode(CB_CHAPTER, i))]
+            for i, chapter in enumerate(chapters, 1)
+        ]) if chapters else None
+        
+        lessons_text: Dict[int, str] = {}
+        lessons_markup: Dict[int, InlineKeyboardMarkup] = {}
+        lesson_order: List[LessonKey] = []
+        back_button = InlineKeyboardButton("⬅️ بازگشت", callback_data=CallbackData.encode(CB_BACK))
+        for chapter_num, chapter in enumerate(chapters, 1):
+            lessons = chapter.get("lessons", [])
+            lessons_text[chapter_num] = f"فصل {chapter_num}: {chapter['title']}\n\nدرس‌های این فصل:\n" + "".join(
+                f"{i}. {lesson['title']}\n" for i, lesson in enumerate(lessons, 1)
+            )
+            buttons = [
+                InlineKeyboardButton(text=f"درس {i}", callback_data=CallbackData.encode(
+                    CB_LESSON, chapter_num, i, lesson_refs[(chapter_num, i)]))
+                for i in range(1, len(lessons) + 1)
+            ]
+            # 3 دکمه در هر ردیف و دکمه بازگشت در انتها
+            rows = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+            rows.append([back_button])
+            lessons_markup[chapter_num] = InlineKeyboardMarkup(rows)
+            lesson_order.extend((chapter_num, i) for i in range(1, len(lessons) + 1))
+        
+        nav_buttons: Dict[LessonKey, Tuple[InlineKeyboardButton, ...]] = {}
+        for position, key in enumerate(lesson_order):
+            buttons = []
+            if position > 0:
+                buttons.append(InlineKeyboardButton(
+                    "⏮ درس قبلی", callback_data=CallbackData.encode(
+                        CB_NAV_LESSON, *lesson_order[position - 1], lesson_refs[lesson_order[position - 1]])))
+            if position < len(lesson_order) - 1:
+                buttons.append(InlineKeyboardButton(
+                    "درس بعدی ⏭", callback_data=CallbackData.encode(
+                        CB_NAV_LESSON, *lesson_order[position + 1], lesson_refs[lesson_order[position + 1]])))
+            nav_buttons[key] = tuple(buttons)
+        
+        return cls(
+            chapters_text=chapters_text,
+            chapters_markup=chapters_markup,
+            lessons_text=lessons_text,
+            lessons_markup=lessons_markup,
+            lesson_order=tuple(lesson_order),
+            lesson_position={key: position for position, key in enumerate(lesson_order)},
+            nav_buttons=nav_buttons,
+            lesson_refs=lesson_refs,
+            ref_position=ref_position,
+        )
+
+@dataclass
+class CurriculumDiff:
+    """تفاوت دو نسخه برنامه آموزشی بر حسب موقعیت دروس"""
+    changed: List[LessonKey]
+    added: List[LessonKey]
+    removed: List[LessonKey]
+    
+    @staticmethod
+    def titles(curriculum: Dict[str, Any]) -> Dict[LessonKey, Tuple[str, str]]:
+        """عنوان فصل و درس در هر موقعیت"""
+        return {
+            (chapter_num, lesson_num): (chapter["title"], lesson["title"])
+            for chapter_num, chapter in enumerate(curriculum.get("chapters") or [], 1)
+            for lesson_num, lesson in enumerate(chapter.get("lessons", []), 1)
+        }
+    
+    @classmethod
+    def between(cls, old: Dict[str, Any], new: Dict[str, Any]) -> "CurriculumDiff":
+        """دروسی که عنوانشان عوض شده یا جابه‌جا شده‌اند (عنوان دیگری در همان موقعیت)"""
+        old_titles, new_titles = cls.titles(old), cls.titles(new)
+        return cls(
+            changed=sorted(key for key in old_titles.keys() & new_titles.keys() if old_titles[key] != new_titles[key]),
+            added=sorted(new_titles.keys() - old_titles.keys()),
+            removed=sorted(old_titles.keys() - new_titles.keys()),
+        )
 
 class CurriculumManager:
-    """مدیریت منوها و دروس آموزشی"""
+    """مدیریت منوها و دروس آموزشی
+    
+    منوها، کیبوردها و ترتیب دروس هنگام بارگذاری در CurriculumIndex ساخته
+    می‌شوند و هندلرها فقط آن‌ها را می‌خوانند. با reload فایل دوباره خوانده و
+    برنامه و فهرست جدید بدون await در میانه جایگزین می‌شوند، پس هر هندلر
+    یا نسخه قبلی یا نسخه جدید را کامل می‌بیند.
+    """
     
     def __init__(self, curriculum_file: str):
+        self.curriculum_file = curriculum_file
+        self.reloads = 0
+        self.file_stamp = self._stamp()
         try:
-            with open(curriculum_file, 'r', encoding='utf-8') as f:
-                self.curriculum = json.load(f)
+            self.curriculum = self._load()
         except Exception as e:
             logger.error(f"خطا در خواندن فایل chapters.json: {e}")
             self.curriculum = {"chapters": []}
+        self.index = CurriculumIndex.build(self.curriculum)
+    
+    def _stamp(self) -> Optional[Tuple[int, int]]:
+        """زمان تغییر و اندازه فایل برای تشخیص تغییر"""
+        try:
+            stat = os.stat(self.curriculum_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    def _load(self) -> Dict[str, Any]:
+        """خواندن و بررسی ساختار فایل برنامه آموزشی"""
+        with open(self.curriculum_file, 'r', encoding='utf-8') as f:
+            curriculum = json.load(f)
+        for chapter in curriculum.get("chapters") or []:
+            if not isinstance(chapter["title"], str):
+                raise ValueError("عنوان فصل باید متن باشد")
+            for lesson in chapter.get("lessons", []):
+                if not isinstance(lesson["title"], str):
+                    raise ValueError("عنوان درس باید متن باشد")
+        return curriculum
+    
+    def changed_on_disk(self) -> bool:
+        """آیا فایل پس از آخرین بارگذاری تغییر کرده است"""
+        return self._stamp() != self.file_stamp
+    
+    def reload(self) -> Optional[CurriculumDiff]:
+        """بارگذاری دوباره فایل؛ در صورت خطا برنامه فعلی حفظ و None برگردانده می‌شود"""
+        stamp = self._stamp()
+        try:
+            curriculum = self._load()
+            index = CurriculumIndex.build(curriculum)
+        except Exception as e:
+            logger.error(f"خطا در بارگذاری دوباره فایل chapters.json (برنامه قبلی حفظ شد): {e}")
+            # تا تغییر بعدی فایل دوباره تلاش نمی‌شود
+            self.file_stamp = stamp
+            return None
+        
+        diff = CurriculumDiff.between(self.curriculum, curriculum)
+        self.curriculum, self.index, self.file_stamp = curriculum, index, stamp
+        self.reloads += 1
+        logger.info(
+            f"برنامه آموزشی دوباره بارگذاری شد: {len(diff.changed)} درس تغییر کرده، "
+            f"{len(diff.added)} درس جدید، {len(diff.removed)} درس حذف‌شده"
+        )
+        return diff
     
     def get_chapters_list(self) -> str:
         """دریافت لیست فصل‌ها"""
-        if not self.curriculum.get("chapters"):
-            return "❌ فایل فصل‌ها یافت نشد."
-        
-        result = "📚 فصل‌های آموزشی:\n\n"
-        for i, chapter in enumerate(self.curriculum["chapters"], 1):
-            result += f"{i}. {chapter['title']}\n"
-        return result
+        return self.index.chapters_text
+    
+    def get_chapters_markup(self) -> Optional[InlineKeyboardMarkup]:
+        """کیبورد فصل‌ها (برای برنامه خالی None)"""
+        return self.index.chapters_markup
     
     def get_chapters_buttons(self) -> List[List[InlineKeyboardButton]]:
         """دریافت دکمه‌های فصل‌ها"""
-        if not self.curriculum.get("chapters"):
-            return []
-        
-        buttons = []
-        for i, chapter in enumerate(self.curriculum["chapters"], 1):
-            button = InlineKeyboardButton(
-                text=f"فصل {i}: {chapter['title']}", 
-                callback_data=f"chapter_{i}"
-            )
-            buttons.append([button])
-        return buttons
+        markup = self.index.chapters_markup
+        return [list(row) for row in markup.inline_keyboard] if markup else []
+    
+    def get_lessons_text(self, chapter_num: int) -> Optional[str]:
+        """متن فهرست دروس فصل"""
+        return self.index.lessons_text.get(chapter_num)
+    
+    def get_lessons_markup(self, chapter_num: int) -> Optional[InlineKeyboardMarkup]:
+        """کیبورد دروس فصل به همراه دکمه بازگشت"""
+        return self.index.lessons_markup.get(chapter_num)
     
     def get_lessons_buttons(self, chapter_num: int) -> List[List[InlineKeyboardButton]]:
         """دریافت دکمه‌های دروس فصل"""
-        chapter = self.get_chapter_info(chapter_num)
-        if not chapter:
-            return []
-        
-        buttons = []
-        row = []
-        for i, lesson in enumerate(chapter["lessons"], 1):
-            button = InlineKeyboardButton(
-                text=f"درس {i}", 
-                callback_data=f"lesson_{chapter_num}_{i}"
-            )
-            row.append(button)
-            if len(row) == 3:  # 3 دکمه در هر ردیف
-                buttons.append(row)
-                row = []
-        
-        if row:
-            buttons.append(row)
-        
-        # دکمه بازگشت
-        buttons.append([InlineKeyboardButton("⬅️ بازگشت", callback_data="back_to_chapters")])
-        return buttons
+        markup = self.index.lessons_markup.get(chapter_num)
+        return [list(row) for row in markup.inline_keyboard] if markup else []
     
     def get_chapter_info(self, chapter_num: int) -> Optional[Dict]:
         """دریافت اطلاعات فصل"""
@@ -226,12 +1742,19 @@ class CurriculumManager:
             return chapter["lessons"][lesson_num - 1]["title"]
         return None
     
+    def resolve_lesson(self, chapter_num: int, lesson_num: int, ref: Optional[str]) -> Optional[LessonKey]:
+        """موقعیت فعلی درسی که دکمه با شناسه ref برای آن ساخته شده است
+        
+        اگر درس پس از ساخت دکمه جابه‌جا شده باشد موقعیت جدید آن و اگر حذف شده
+        باشد None برگردانده می‌شود. دکمه‌های قدیمی بدون شناسه همان موقعیت را دارند.
+        """
+        if ref is None or self.index.lesson_refs.get((chapter_num, lesson_num)) == ref:
+            return chapter_num, lesson_num
+        return self.index.ref_position.get(ref)
+    
     def validate_lesson_request(self, chapter_num: int, lesson_num: int) -> bool:
         """اعتبارسنجی درخواست درس"""
-        chapter = self.get_chapter_info(chapter_num)
-        if not chapter:
-            return False
-        return 1 <= lesson_num <= len(chapter.get("lessons", []))
+        return (chapter_num, lesson_num) in self.index.lesson_position
     
     def get_adjacent_chapters(self, current_chapter: int) -> Tuple[Optional[int], Optional[int]]:
         """دریافت فصل قبلی و بعدی"""
@@ -240,55 +1763,109 @@ class CurriculumManager:
         next_chapter = current_chapter + 1 if current_chapter < total_chapters else None
         return prev_chapter, next_chapter
     
-    def get_adjacent_lessons(self, chapter_num: int, lesson_num: int) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
-        """دریافت درس قبلی و بعدی"""
-        chapter = self.get_chapter_info(chapter_num)
-        if not chapter:
+    def get_adjacent_lessons(self, chapter_num: int, lesson_num: int) -> Tuple[Optional[LessonKey], Optional[LessonKey]]:
+        """دریافت درس قبلی و بعدی (درس آخر فصل قبلی و درس اول فصل بعدی هم در نظر گرفته می‌شوند)"""
+        position = self.index.lesson_position.get((chapter_num, lesson_num))
+        if position is None:
             return None, None
-        
-        total_lessons = len(chapter.get("lessons", []))
-        
-        # درس قبلی
-        if lesson_num > 1:
-            prev_lesson = (chapter_num, lesson_num - 1)
-        elif chapter_num > 1:
-            # درس آخر فصل قبلی
-            prev_chapter = self.get_chapter_info(chapter_num - 1)
-            if prev_chapter:
-                prev_lesson = (chapter_num - 1, len(prev_chapter.get("lessons", [])))
-            else:
-                prev_lesson = None
-        else:
-            prev_lesson = None
-        
-        # درس بعدی
-        if lesson_num < total_lessons:
-            next_lesson = (chapter_num, lesson_num + 1)
-        elif chapter_num < len(self.curriculum.get("chapters", [])):
-            # درس اول فصل بعدی
-            next_lesson = (chapter_num + 1, 1)
-        else:
-            next_lesson = None
-        
+        order = self.index.lesson_order
+        prev_lesson = order[position - 1] if position > 0 else None
+        next_lesson = order[position + 1] if position < len(order) - 1 else None
         return prev_lesson, next_lesson
+    
+    def get_nav_buttons(self, chapter_num: int, lesson_num: int) -> List[InlineKeyboardButton]:
+        """دکمه‌های درس قبلی و بعدی"""
+        return list(self.index.nav_buttons.get((chapter_num, lesson_num), ()))
+
+class CircuitBreaker:
+    """قطع‌کن مدار برای توقف سریع درخواست‌ها هنگام از دسترس خارج بودن سرویس
+    
+    پس از failure_threshold خطای پیاپی باز می‌شود، پس از reset_timeout ثانیه
+    یک درخواست آزمایشی را عبور می‌دهد و با موفقیت آن دوباره بسته می‌شود.
+    """
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+    
+    @property
+    def state(self) -> str:
+        """وضعیت فعلی: closed، open یا half_open"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+    
+    def allow(self) -> bool:
+        """آیا درخواست جدید مجاز است"""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+    
+    def record_success(self):
+        """ثبت موفقیت و بستن مدار"""
+        if self.opened_at is not None:
+            logger.info("قطع‌کن مدار API بسته شد")
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+    
+    def cancel_probe(self):
+        """آزاد کردن درخواست آزمایشی لغوشده تا درخواست دیگری جای آن را بگیرد"""
+        self._probe_in_flight = False
+    
+    def record_failure(self):
+        """ثبت خطا و باز کردن مدار در صورت رسیدن به آستانه"""
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning(f"قطع‌کن مدار API پس از {self.failures} خطای پیاپی باز شد")
+            self.opened_at = time.monotonic()
 
 class DeepSeekClient:
     """کلاینت اتصال به API هوش مصنوعی DeepSeek"""
     
-    def __init__(self, api_key: str, base_url: str):
+    def __init__(self, api_key: str, base_url: str, max_retries: int = DEEPSEEK_MAX_RETRIES,
+                 backoff_base: float = DEEPSEEK_BACKOFF_BASE, backoff_max: float = DEEPSEEK_BACKOFF_MAX,
+                 breaker: Optional[CircuitBreaker] = None, retry_budget: float = DEEPSEEK_RETRY_BUDGET,
+                 transport: Optional[httpx.AsyncBaseTransport] = None, model: str = DEEPSEEK_MODEL,
+                 metrics: Optional[BotMetrics] = None):
         self.api_key = api_key
         self.base_url = base_url
+        self.model = model
+        self.metrics = metrics or BotMetrics()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self.breaker = breaker or CircuitBreaker(DEEPSEEK_BREAKER_THRESHOLD, DEEPSEEK_BREAKER_RESET)
+        self.requests = 0
+        self.successes = 0
+        self.errors: Dict[str, int] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
         self.client = httpx.AsyncClient(
             headers={
                 "Authorization": f"Bearer {self.api_key}",
                 "Content-Type": "application/json"
             },
-            timeout=60.0  # افزایش تایم‌اوت
+            timeout=60.0,  # افزایش تایم‌اوت
+            transport=transport
         )
     
-    async def generate_lesson(self, chapter_title: str, lesson_title: str) -> str:
-        """تولید محتوای درس با استفاده از AI"""
-        prompt = f"""
+    @staticmethod
+    def build_prompt(chapter_title: str, lesson_title: str) -> str:
+        """ساخت پرامپت تولید درس"""
+        return f"""
 شما یک مربی بسیار سختگیر و با تجربه برای آموزش پایتون هستید. 
 در زبان فارسی به صورت حرفه‌ای توضیح دهید:
 
@@ -306,89 +1883,769 @@ class DeepSeekClient:
 8. تمام کدهای پایتون را داخل تگ <q> قرار بده تا در تلگرام قابل کپی باشند
 9. مطمئن شو که تمام کدهای پایتون داخل تگ مناسب قرار گرفته‌اند
 """.strip()
+    
+    def _request_body(self, chapter_title: str, lesson_title: str, stream: bool = False) -> Dict[str, Any]:
+        """بدنه درخواست chat/completions"""
+        body = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": self.build_prompt(chapter_title, lesson_title)}],
+            "temperature": 0.7,
+            "max_tokens": 2000
+        }
+        if stream:
+            body["stream"] = True
+            body["stream_options"] = {"include_usage": True}
+        return body
+    
+    def content_version(self, chapter_title: str, lesson_title: str) -> str:
+        """نسخه محتوای درس: هش پرامپت، مدل، پارامترهای تولید و عنوان‌ها"""
+        payload = json.dumps([PROMPT_VERSION, self._request_body(chapter_title, lesson_title)],
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+    
+    async def generate_lesson(self, chapter_title: str, lesson_title: str) -> GenerationResult:
+        """تولید محتوای درس با استفاده از AI"""
+        logger.info(f"در حال ارسال درخواست به API برای: {chapter_title} - {lesson_title}")
+        return await self._with_retries(lambda: self._attempt_lesson(chapter_title, lesson_title))
+    
+    async def generate_lesson_streaming(self, chapter_title: str, lesson_title: str,
+                                        on_delta: Callable[[str], None]) -> GenerationResult:
+        """تولید محتوای درس به صورت جریانی (SSE)
         
-        try:
-            logger.info(f"در حال ارسال درخواست به API برای: {chapter_title} - {lesson_title}")
+        هر تکه دریافتی به on_delta داده می‌شود و در پایان نتیجه کامل مانند
+        generate_lesson برگردانده می‌شود. پس از دریافت اولین تکه دیگر
+        تلاش مجدد انجام نمی‌شود چون بخشی از متن به کاربر رسیده است.
+        """
+        parts: List[str] = []
+        logger.info(f"در حال ارسال درخواست جریانی به API برای: {chapter_title} - {lesson_title}")
+        return await self._with_retries(
+            lambda: self._attempt_lesson_stream(chapter_title, lesson_title, on_delta, parts),
+            can_retry=lambda: not parts
+        )
+    
+    async def _with_retries(self, attempt: Callable[[], Awaitable[GenerationResult]],
+                            can_retry: Callable[[], bool] = lambda: True) -> GenerationResult:
+        """اجرای درخواست با تلاش مجدد، عقب‌نشینی نمایی تصادفی و قطع‌کن مدار"""
+        started = time.perf_counter()
+        self.requests += 1
+        if not self.breaker.allow():
+            logger.warning("قطع‌کن مدار API باز است؛ درخواست ارسال نشد")
+            result = GenerationResult(
+                error_kind=ERROR_CIRCUIT_OPEN,
+                error_message="سرویس تولید محتوا موقتاً در دسترس نیست"
+            )
+            self.metrics.deepseek_responses.inc(status=ERROR_CIRCUIT_OPEN)
+            return self._record(result, started, 0)
+        
+        for attempt_num in range(self.max_retries + 1):
+            try:
+                result = await attempt()
+            except asyncio.CancelledError:
+                # مثلاً کار پس‌زمینه‌ای که زمان‌بند برای درخواست تعاملی متوقف کرده است
+                self.breaker.cancel_probe()
+                raise
+            self.metrics.deepseek_responses.inc(status=result.status_code or result.error_kind)
+            if result.ok:
+                self.breaker.record_success()
+                break
+            if not result.retryable:
+                # خطاهای غیرقابل تکرار (مثل 400) نه سلامت سرویس را نشان می‌دهند نه خرابی آن را
+                self.breaker.cancel_probe()
+                break
             
+            self.breaker.record_failure()
+            if attempt_num == self.max_retries or not can_retry() or not self.breaker.allow():
+                break
+            delay = self.backoff_delay(attempt_num, result.retry_after)
+            if time.perf_counter() - started + delay > self.retry_budget:
+                # تلاش زودتر از Retry-After فقط دوباره به محدودیت نرخ می‌خورد
+                if result.retry_after is not None:
+                    result = GenerationResult(
+                        status_code=result.status_code,
+                        error_kind=ERROR_RATE_LIMITED,
+                        error_message=f"محدودیت نرخ API؛ تلاش دوباره پس از {result.retry_after:.0f} ثانیه",
+                        retry_after=result.retry_after
+                    )
+                # درخواست آزمایشی ارسال نمی‌شود، پس مدار برای درخواست‌های دیگر آزاد می‌ماند
+                self.breaker.cancel_probe()
+                logger.warning(f"بودجه زمانی تلاش مجدد ({self.retry_budget:.0f} ثانیه) کافی نیست؛ توقف تلاش‌ها")
+                break
+            logger.warning(f"تلاش مجدد {attempt_num + 1} از {self.max_retries} پس از {delay:.1f} ثانیه")
+            await asyncio.sleep(delay)
+        return self._record(result, started, attempt_num + 1)
+    
+    def _record(self, result: GenerationResult, started: float, attempts: int) -> GenerationResult:
+        """تکمیل زمان و تعداد تلاش‌ها و به‌روزرسانی آمار"""
+        result.latency = time.perf_counter() - started
+        result.attempts = attempts
+        self.metrics.deepseek_latency.observe(result.latency, outcome="ok" if result.ok else result.error_kind)
+        if result.ok:
+            self.successes += 1
+            self.prompt_tokens += result.prompt_tokens
+            self.completion_tokens += result.completion_tokens
+            self.metrics.deepseek_tokens.inc(result.prompt_tokens, kind="prompt")
+            self.metrics.deepseek_tokens.inc(result.completion_tokens, kind="completion")
+        else:
+            self.errors[result.error_kind] = self.errors.get(result.error_kind, 0) + 1
+        return result
+    
+    def stats(self) -> Dict[str, Any]:
+        """آمار درخواست‌های تولید درس"""
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "errors": dict(self.errors),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "breaker_state": self.breaker.state,
+        }
+    
+    def backoff_delay(self, attempt_num: int, retry_after: Optional[float] = None) -> float:
+        """زمان انتظار پیش از تلاش بعدی (Retry-After سرور به طور کامل رعایت می‌شود)"""
+        if retry_after is not None:
+            return retry_after
+        # full jitter: عددی تصادفی بین صفر و سقف نمایی
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt_num)))
+    
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """تبدیل هدر Retry-After (ثانیه یا تاریخ HTTP) به ثانیه"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (when - datetime.now(when.tzinfo)).total_seconds())
+    
+    def _status_error(self, response: httpx.Response, body: str) -> GenerationResult:
+        """نتیجه یک پاسخ ناموفق"""
+        logger.error(f"خطا در API: {response.status_code} - {body}")
+        return GenerationResult(
+            status_code=response.status_code,
+            error_kind=ERROR_HTTP,
+            error_message=f"خطای API: {response.status_code}",
+            retry_after=self.parse_retry_after(response.headers.get("Retry-After"))
+        )
+    
+    @staticmethod
+    def _exception_result(e: Exception) -> GenerationResult:
+        """نتیجه یک خطای اتصال یا خطای نامشخص"""
+        if isinstance(e, httpx.TimeoutException):
+            logger.error("تایم‌اوت در اتصال به API")
+            return GenerationResult(error_kind=ERROR_TIMEOUT, error_message="زمان اتصال به API به پایان رسید")
+        if isinstance(e, httpx.RequestError):
+            logger.error(f"خطا در اتصال به API: {e}")
+            return GenerationResult(error_kind=ERROR_CONNECTION, error_message=f"خطای اتصال به API: {e}")
+        logger.error(f"خطای نامشخص در تولید درس: {e}")
+        return GenerationResult(error_kind=ERROR_UNKNOWN, error_message=f"خطای نامشخص: {e}")
+    
+    @staticmethod
+    def _check_content(result: GenerationResult) -> GenerationResult:
+        """تبدیل پاسخ ناقص، بریده‌شده در سقف طول یا خالی به خطا"""
+        if result.error_kind is not None:
+            return result
+        if result.finish_reason == "length":
+            # تکرار با همان max_tokens معمولاً دوباره بریده می‌شود، پس خطا قابل تکرار نیست
+            logger.error("پاسخ API در سقف max_tokens بریده شد")
+            result.error_kind = ERROR_MAX_TOKENS
+            result.error_message = "پاسخ API به سقف طول رسید و ناقص است"
+        elif not result.complete:
+            logger.error("جریان پاسخ API پیش از پایان قطع شد")
+            result.error_kind = ERROR_STREAM_TRUNCATED
+            result.error_message = "پاسخ API ناقص دریافت شد"
+        elif not result.content:
+            logger.error("پاسخ API محتوای خالی داشت")
+            result.error_kind = ERROR_EMPTY_CONTENT
+            result.error_message = "پاسخ API خالی بود"
+        return result
+    
+    @staticmethod
+    def _apply_usage(result: GenerationResult, usage: Optional[Dict[str, Any]]):
+        """ثبت مصرف توکن از فیلد usage پاسخ"""
+        if usage:
+            result.prompt_tokens = usage.get("prompt_tokens", 0) or 0
+            result.completion_tokens = usage.get("completion_tokens", 0) or 0
+    
+    async def _attempt_lesson(self, chapter_title: str, lesson_title: str) -> GenerationResult:
+        """یک تلاش برای تولید درس"""
+        try:
             response = await self.client.post(
                 f"{self.base_url}/chat/completions",
-                json={
-                    "model": "deepseek-chat",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.7,
-                    "max_tokens": 2000
-                }
+                json=self._request_body(chapter_title, lesson_title)
             )
             
             logger.info(f"وضعیت پاسخ API: {response.status_code}")
             
-            if response.status_code == 200:
-                data = response.json()
-                content = data["choices"][0]["message"]["content"].strip()
+            if response.status_code != 200:
+                return self._status_error(response, response.text)
+            
+            data = response.json()
+            choice = data["choices"][0]
+            result = GenerationResult(
+                content=(choice["message"]["content"] or "").strip(),
+                status_code=response.status_code,
+                finish_reason=choice.get("finish_reason")
+            )
+            self._apply_usage(result, data.get("usage"))
+            if self._check_content(result).ok:
                 logger.info("تولید محتوای درس با موفقیت انجام شد")
-                return content
-            else:
-                logger.error(f"خطا در API: {response.status_code} - {response.text}")
-                return f"❌ خطای API: {response.status_code}. لطفاً بعداً تلاش کنید."
+            return result
+        except Exception as e:
+            return self._exception_result(e)
+    
+    async def _attempt_lesson_stream(self, chapter_title: str, lesson_title: str,
+                                     on_delta: Callable[[str], None], parts: List[str]) -> GenerationResult:
+        """یک تلاش برای تولید جریانی درس"""
+        try:
+            async with self.client.stream(
+                "POST",
+                f"{self.base_url}/chat/completions",
+                json=self._request_body(chapter_title, lesson_title, stream=True)
+            ) as response:
+                logger.info(f"وضعیت پاسخ API: {response.status_code}")
                 
-        except httpx.TimeoutException:
-            logger.error("تایم‌اوت در اتصال به API")
-            return "❌ زمان اتصال به API به پایان رسید. لطفاً بعداً تلاش کنید."
-        except httpx.RequestError as e:
-            logger.error(f"خطا در اتصال به API: {e}")
-            return f"❌ خطای اتصال به API: {str(e)}. لطفاً بعداً تلاش کنید."
+                if response.status_code != 200:
+                    body = (await response.aread()).decode("utf-8", errors="replace")
+                    return self._status_error(response, body)
+                
+                # تا دیدن [DONE] یا finish_reason پاسخ ناقص حساب می‌شود
+                result = GenerationResult(status_code=response.status_code, complete=False)
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        result.complete = True
+                        break
+                    chunk = json.loads(payload)
+                    # آخرین رویداد فقط شامل usage است و choices ندارد
+                    self._apply_usage(result, chunk.get("usage"))
+                    choices = chunk.get("choices") or [{}]
+                    if choices[0].get("finish_reason"):
+                        result.complete = True
+                        result.finish_reason = choices[0]["finish_reason"]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        parts.append(delta)
+                        on_delta(delta)
+            
+            result.content = "".join(parts).strip()
+            if self._check_content(result).ok:
+                logger.info("تولید جریانی محتوای درس با موفقیت انجام شد")
+            return result
         except Exception as e:
-            logger.error(f"خطای نامشخص در تولید درس: {e}")
-            return f"❌ خطای نامشخص: {str(e)}. لطفاً بعداً تلاش کنید."
+            return self._exception_result(e)
 
-class MessageSplitter:
-    """تقسیم پیام‌های طولانی به بخش‌های کوچک"""
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """پردازش همزمان آپدیت‌ها با حفظ ترتیب آپدیت‌های هر کاربر
+    
+    آپدیت‌های کاربران مختلف به صورت موازی (حداکثر max_concurrent_updates)
+    اجرا می‌شوند. اگر برای کاربری آپدیتی در حال اجرا باشد، آپدیت جدید او
+    در صف همان کاربر قرار می‌گیرد و پس از آن اجرا می‌شود؛ بنابراین ضربه‌های
+    پشت‌سرهم «بعدی/قبلی» روی پیشرفت کاربر مسابقه نمی‌دهند و آپدیت‌های در صف
+    جای پردازش کاربران دیگر را اشغال نمی‌کنند.
+    """
+    
+    def __init__(self, max_concurrent_updates: int = UPDATE_WORKERS):
+        super().__init__(max_concurrent_updates)
+        self._queues: Dict[Hashable, Deque[Awaitable[Any]]] = {}
+        self.queued = 0
     
     @staticmethod
-    def split_message(text: str, max_length: int = 3500) -> List[str]:
-        """تقسیم متن به بخش‌های کوچکتر"""
-        lines = text.split('\n')
-        chunks = []
-        current_chunk = ""
-        
-        for line in lines:
-            # اگر خط خیلی بلند باشد، تقسیمش می‌کنیم
-            if len(line) > max_length:
-                words = line.split(' ')
-                line_chunk = ""
-                for word in words:
-                    if len(line_chunk + word) < max_length:
-                        line_chunk += word + " "
-                    else:
-                        if line_chunk:
-                            if len(current_chunk + line_chunk) < max_length:
-                                current_chunk += line_chunk + "\n"
-                            else:
-                                chunks.append(current_chunk.strip())
-                                current_chunk = line_chunk + "\n"
-                        line_chunk = word + " "
-                
-                if line_chunk:
-                    if len(current_chunk + line_chunk) < max_length:
-                        current_chunk += line_chunk + "\n"
-                    else:
-                        chunks.append(current_chunk.strip())
-                        current_chunk = line_chunk + "\n"
-                continue
+    def update_key(update: object) -> Optional[Hashable]:
+        """کلید ترتیب: کاربر، و در نبود کاربر، چت"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        return None
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.update_key(update)
+        if key is None:
+            await coroutine
+            return
+        
+        queue = self._queues.get(key)
+        if queue is not None:
+            # کار قبلی همین کاربر هنوز تمام نشده؛ همان اجراکننده این را هم اجرا می‌کند
+            queue.append(coroutine)
+            self.queued += 1
+            return
+        
+        self._queues[key] = queue = deque()
+        try:
+            await self._run(coroutine)
+            while queue:
+                await self._run(queue.popleft())
+        finally:
+            del self._queues[key]
+            # در صورت لغو، کوروتین‌های اجرانشده بسته می‌شوند
+            for pending in queue:
+                pending.close()
+    
+    @staticmethod
+    async def _run(coroutine: Awaitable[Any]):
+        try:
+            await coroutine
+        except Exception as e:
+            logger.error(f"خطا در پردازش آپدیت: {e}")
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+class LessonStream:
+    """درسی که در حال تولید است و بخش‌های آن به‌تدریج آماده می‌شوند"""
+    
+    def __init__(self):
+        self.sections: List[str] = []
+        self.exercise_index: Optional[int] = None
+        self.done = False
+        # بخش‌ها در ذخیره‌ساز هم هستند؛ در غیر این صورت (تولید ناقص یا محتوای
+        # جایگزین) فقط همین stream آن‌ها را دارد
+        self.cached = False
+        self._changed = asyncio.Event()
+    
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def add_sections(self, sections: List[str]):
+        """افزودن بخش‌های قطعی‌شده"""
+        if sections:
+            self.sections.extend(sections)
+            self._notify()
+    
+    def finish(self, sections: List[str]):
+        """ثبت فهرست نهایی بخش‌ها و بیدار کردن همه منتظرها"""
+        self.sections = list(sections)
+        self.exercise_index = MessageSplitter.find_exercise_index(self.sections)
+        self.done = True
+        self._notify()
+    
+    async def wait_for_section(self, index: int) -> Optional[LessonSection]:
+        """انتظار تا آماده شدن بخش index یا پایان تولید"""
+        while not self.done and len(self.sections) <= index:
+            await self._changed.wait()
+        text = self.sections[index] if 0 <= index < len(self.sections) else None
+        return LessonSection(index, text, len(self.sections), self.exercise_index, complete=self.done)
+    
+    async def wait_until_done(self):
+        """انتظار تا پایان تولید درس"""
+        while not self.done:
+            await self._changed.wait()
+
+class SingleFlight:
+    """ادغام درخواست‌های همزمان یکسان در یک اجرای واحد
+    
+    اولین درخواست برای یک کلید کار را شروع می‌کند و درخواست‌های بعدی
+    تا پایان آن منتظر همان نتیجه می‌مانند.
+    """
+    
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[Hashable, int] = {}
+        self.generations = 0
+        self.total_waiters = 0
+        self.max_waiters = 0
+    
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """اجرای func برای کلید یا پیوستن به اجرای در جریان"""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t, k=key: self._finish(k))
+        self._waiters[key] += 1
+        # لغو یک درخواست‌کننده نباید اجرای مشترک را لغو کند
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: Hashable):
+        """ثبت آمار پس از پایان یک اجرا"""
+        self._inflight.pop(key, None)
+        waiters = self._waiters.pop(key, 0)
+        self.generations += 1
+        self.total_waiters += waiters
+        self.max_waiters = max(self.max_waiters, waiters)
+        logger.info(f"تولید {key} به {waiters} درخواست‌کننده پاسخ داد")
+    
+    async def drain(self):
+        """انتظار تا پایان همه اجراهای در جریان"""
+        while self._inflight:
+            await asyncio.gather(*self._inflight.values(), return_exceptions=True)
+    
+    def stats(self) -> Dict[str, float]:
+        """آمار ادغام درخواست‌ها"""
+        return {
+            "generations": self.generations,
+            "total_waiters": self.total_waiters,
+            "max_waiters": self.max_waiters,
+            "avg_waiters": self.total_waiters / self.generations if self.generations else 0.0,
+            "in_flight": len(self._inflight),
+        }
+
+@dataclass
+class GenerationJob:
+    """یک درخواست تولید در زمان‌بند"""
+    priority: int
+    seq: int
+    key: Optional[Hashable] = None
+    preemptible: bool = False
+    enqueued: float = 0.0
+    future: Optional[asyncio.Future] = None
+    task: Optional[asyncio.Task] = None
+    preempted: bool = False
+
+class GenerationScheduler:
+    """زمان‌بند اولویت‌دار درخواست‌های تولید درس با سقف همزمانی سراسری
+    
+    همه فراخوانی‌های DeepSeek از این زمان‌بند می‌گذرند تا تولیدهای پس‌زمینه
+    (پیش‌واکشی و تولید انبوه) سهمیه API را از کاربران تعاملی نگیرند. هر
+    ظرفیت آزاد به کاری با کمترین اولویت و سپس قدیمی‌ترین ورود داده می‌شود.
+    اگر درخواست تعاملی منتظر بماند، یکی از کارهای پس‌زمینه در حال اجرا لغو
+    و با همان جایگاه به صف برگردانده می‌شود تا بعداً از ابتدا اجرا شود.
+    """
+    
+    def __init__(self, max_concurrent: int = DEEPSEEK_MAX_CONCURRENCY, metrics: Optional[BotMetrics] = None):
+        self.max_concurrent = max(1, max_concurrent)
+        self.metrics = metrics or BotMetrics()
+        self._waiting: List[GenerationJob] = []
+        self._running: List[GenerationJob] = []
+        self._seq = 0
+        self.max_depth = 0
+        self.preemptions = 0
+        self.completed: Dict[str, int] = {name: 0 for name in GENERATION_PRIORITY_NAMES.values()}
+        self.total_wait: Dict[str, float] = {name: 0.0 for name in GENERATION_PRIORITY_NAMES.values()}
+        self.max_wait: Dict[str, float] = {name: 0.0 for name in GENERATION_PRIORITY_NAMES.values()}
+    
+    async def run(self, func: Callable[[], Awaitable[Any]], priority: int = GENERATION_PRIORITY_INTERACTIVE,
+                  key: Optional[Hashable] = None) -> Any:
+        """اجرای func پس از گرفتن نوبت؛ کارهای غیرتعاملی قابل توقف و اجرای دوباره هستند"""
+        self._seq += 1
+        job = GenerationJob(priority, self._seq, key, preemptible=priority > GENERATION_PRIORITY_INTERACTIVE)
+        while True:
+            await self._acquire(job)
+            job.task = asyncio.ensure_future(func())
+            try:
+                await asyncio.wait((job.task,))
+            except asyncio.CancelledError:
+                job.task.cancel()
+                raise
+            finally:
+                self._release(job)
             
-            # اضافه کردن خط به چانک فعلی یا ایجاد چانک جدید
-            if len(current_chunk + line) < max_length:
-                current_chunk += line + "\n"
+            if job.preempted and job.task.cancelled():
+                logger.info(f"تولید {key} برای درخواست تعاملی متوقف شد و دوباره در صف قرار گرفت")
+                job.preempted = False
+                job.task = None
+                continue
+            return job.task.result()
+    
+    def promote(self, key: Hashable, priority: int = GENERATION_PRIORITY_INTERACTIVE):
+        """افزایش اولویت کار در صف یا در حال اجرا (مثلاً وقتی کاربری منتظر درس پیش‌واکشی است)"""
+        for job in self._waiting + self._running:
+            if job.key == key and priority < job.priority:
+                job.priority = priority
+                job.preemptible = job.preemptible and priority > GENERATION_PRIORITY_INTERACTIVE
+        self._preempt()
+    
+    async def _acquire(self, job: GenerationJob):
+        """انتظار تا گرفتن یکی از ظرفیت‌های اجرا"""
+        loop = asyncio.get_running_loop()
+        job.enqueued = loop.time()
+        if not self._waiting and len(self._running) < self.max_concurrent:
+            # مسیر سریع: ظرفیت آزاد و صف خالی
+            self._start(job, loop.time())
+            return
+        
+        job.future = loop.create_future()
+        self._waiting.append(job)
+        self.max_depth = max(self.max_depth, len(self._waiting))
+        self._preempt()
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            if job in self._waiting:
+                self._waiting.remove(job)
             else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = line + "\n"
+                self._release(job)
+            raise
+    
+    def _start(self, job: GenerationJob, now: float):
+        """ثبت شروع اجرا و زمان انتظار در صف"""
+        self._running.append(job)
+        name = GENERATION_PRIORITY_NAMES.get(job.priority, str(job.priority))
+        waited = now - job.enqueued
+        self.completed[name] = self.completed.get(name, 0) + 1
+        self.total_wait[name] = self.total_wait.get(name, 0.0) + waited
+        self.max_wait[name] = max(self.max_wait.get(name, 0.0), waited)
+        self.metrics.generation_queue_wait.observe(waited, priority=name)
+    
+    def _release(self, job: GenerationJob):
+        """آزاد کردن ظرفیت و دادن آن به کار بعدی صف"""
+        if job in self._running:
+            self._running.remove(job)
+        now = asyncio.get_running_loop().time()
+        while self._waiting and len(self._running) < self.max_concurrent:
+            nxt = min(self._waiting, key=lambda j: (j.priority, j.seq))
+            self._waiting.remove(nxt)
+            if nxt.future.done():
+                continue
+            self._start(nxt, now)
+            nxt.future.set_result(None)
+    
+    def _preempt(self):
+        """لغو کارهای پس‌زمینه به تعداد درخواست‌های تعاملی که ظرفیت ندارند"""
+        free = self.max_concurrent - len(self._running)
+        pending = sum(1 for job in self._running if job.preempted)
+        needed = sum(1 for job in self._waiting if job.priority == GENERATION_PRIORITY_INTERACTIVE) - free - pending
+        victims = sorted(
+            (job for job in self._running if job.preemptible and not job.preempted and job.task is not None),
+            key=lambda j: (j.priority, j.seq), reverse=True
+        )
+        for job in victims[:max(0, needed)]:
+            job.preempted = job.task.cancel()
+            if job.preempted:
+                self.preemptions += 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """طول صف، اجرای جاری و زمان انتظار هر کلاس اولویت"""
+        stats: Dict[str, Any] = {
+            "queue_depth": len(self._waiting),
+            "max_queue_depth": self.max_depth,
+            "running": len(self._running),
+            "preemptions": self.preemptions,
+        }
+        for name, count in self.completed.items():
+            stats[f"{name}_started"] = count
+            stats[f"{name}_avg_wait"] = self.total_wait[name] / count if count else 0.0
+            stats[f"{name}_max_wait"] = self.max_wait[name]
+        return stats
+
+# علامت‌های بلوک کد در محتوای دروس
+CODE_OPEN = "<q>"
+CODE_CLOSE = "</q>"
+
+class _MessageChunker:
+    """موتور تک‌گذره تقسیم متن که توسط MessageSplitter استفاده می‌شود"""
+    
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.chunks: List[str] = []
+        self.buf: List[str] = []
+        self.size = 0
+        self.has_content = False
+        self.in_code = False
+        # مرزهای پایدار: (شماره بخش بعدی، شماره خطی که بخش با آن شروع می‌شود)
+        self.line_no = 0
+        self.boundaries: List[Tuple[int, int]] = []
+    
+    @staticmethod
+    def code_state(piece: str, in_code: bool) -> bool:
+        """وضعیت داخل/خارج بلوک کد پس از این قطعه"""
+        open_pos = piece.rfind(CODE_OPEN)
+        close_pos = piece.rfind(CODE_CLOSE)
+        if open_pos == close_pos:  # هیچ‌کدام وجود ندارد
+            return in_code
+        return open_pos > close_pos
+    
+    def fits_fresh(self, piece: str, piece_size: int) -> bool:
+        """آیا قطعه در یک بخش تازه جا می‌شود"""
+        prefix = len(CODE_OPEN) if self.in_code else 0
+        suffix = len(CODE_CLOSE) if self.code_state(piece, self.in_code) else 0
+        return prefix + piece_size + suffix <= self.max_length
+    
+    def flush(self, final: bool = False, boundary: bool = False):
+        """بستن بخش فعلی؛ بلوک کد باز بسته و در بخش بعد دوباره باز می‌شود
         
-        # اضافه کردن آخرین چانک
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-            
-        return chunks
+        boundary یعنی بخش بعدی از ابتدای خط فعلی و خارج از بلوک کد شروع
+        می‌شود و متن بعدی تاثیری روی بخش‌های قبلی ندارد.
+        """
+        if self.has_content:
+            if self.in_code and not final:
+                self.buf.append(CODE_CLOSE)
+            chunk = "".join(self.buf).strip()
+            if chunk:
+                self.chunks.append(chunk)
+            if boundary and not final and not self.in_code:
+                self.boundaries.append((len(self.chunks), self.line_no))
+        self.buf = []
+        self.size = 0
+        self.has_content = False
+        if self.in_code and not final:
+            self.buf.append(CODE_OPEN)
+            self.size = len(CODE_OPEN)
+    
+    def add(self, piece: str, piece_size: int, sep: str, line_start: bool = False):
+        """افزودن قطعه به بخش فعلی یا شروع بخش جدید"""
+        in_code_after = self.code_state(piece, self.in_code)
+        if self.has_content:
+            needed = len(sep) + piece_size + (len(CODE_CLOSE) if in_code_after else 0)
+            if self.size + needed > self.max_length:
+                self.flush(boundary=line_start)
+        if self.has_content:
+            self.buf.append(sep)
+            self.size += len(sep)
+        self.buf.append(piece)
+        self.size += piece_size
+        self.has_content = True
+        self.in_code = in_code_after
+    
+    @staticmethod
+    def rfind_space(data: bytes, start: int, end: int) -> int:
+        """آخرین فاصله در بازه واحدهای [start, end] متن UTF-16 یا -1"""
+        if end < start:
+            return -1
+        found = data.rfind(b" \x00", 2 * start, 2 * end + 2)
+        # فقط تطابق‌های هم‌تراز با مرز واحدها معتبرند
+        while found != -1 and found % 2:
+            found = data.rfind(b" \x00", 2 * start, found + 1)
+        return found // 2 if found != -1 else -1
+    
+    def add_long_line(self, line: str):
+        """تقسیم خطی که در یک بخش جا نمی‌شود با برش مستقیم روی فاصله‌ها"""
+        data = line.encode("utf-16-le")
+        units = len(data) // 2
+        pos = 0
+        sep = "\n"
+        while pos < units:
+            # جای بستن بلوک کد همیشه رزرو می‌شود
+            room = self.max_length - self.size - len(CODE_CLOSE) - (len(sep) if self.has_content else 0)
+            if units - pos <= room:
+                self.add(data[2 * pos:].decode("utf-16-le"), units - pos, sep)
+                return
+            cut = self.rfind_space(data, pos, pos + room)
+            if cut <= pos:
+                if self.has_content:
+                    self.flush()
+                    continue
+                # کلمه‌ای بلندتر از یک بخش کامل: برش اجباری بدون شکستن جفت‌های جانشین
+                cut = pos + max(1, room)
+                if cut - 1 > pos and 0xDC <= data[2 * cut + 1] <= 0xDF:
+                    cut -= 1
+                self.add(data[2 * pos:2 * cut].decode("utf-16-le"), cut - pos, sep)
+                pos = cut
+                sep = ""
+                continue
+            self.add(data[2 * pos:2 * cut].decode("utf-16-le"), cut - pos, sep)
+            pos = cut + 1
+            sep = " "
+    
+    def add_line(self, line: str, line_size: int):
+        """افزودن یک خط؛ خطوط بلند روی فاصله‌ها تقسیم می‌شوند"""
+        if line_size + len(CODE_OPEN) + len(CODE_CLOSE) <= self.max_length or self.fits_fresh(line, line_size):
+            self.add(line, line_size, "\n", line_start=True)
+        else:
+            self.add_long_line(line)
+    
+    def run(self, text: str) -> List[str]:
+        """تقسیم کامل متن در یک گذر"""
+        lines = text.split("\n")
+        sizes = [MessageSplitter.utf16_len(line) for line in lines]
+        
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            self.line_no = i
+            if not self.in_code and CODE_OPEN in line and self.code_state(line, False):
+                # شروع بلوک کد چندخطی: در صورت امکان کل بلوک در یک بخش بماند
+                end = i
+                while end + 1 < len(lines) and self.code_state(lines[end], end > i):
+                    end += 1
+                block_size = sum(sizes[i:end + 1]) + (end - i)
+                if self.has_content and block_size <= self.max_length < self.size + 1 + block_size:
+                    # تصمیم فقط وقتی پایدار است که پایان بلوک دیده شده باشد
+                    self.flush(boundary=not self.code_state(lines[end], end > i))
+            self.add_line(line, sizes[i])
+            i += 1
+        
+        self.flush(final=True)
+        return self.chunks
+
+class IncrementalSplitter:
+    """تقسیم تدریجی متنی که تکه‌تکه دریافت می‌شود
+    
+    هر بخش فقط وقتی برگردانده می‌شود که متن بعدی دیگر نتواند آن را تغییر
+    دهد؛ بخش‌هایی که یک بار برگردانده شده‌اند بعداً عوض نمی‌شوند.
+    """
+    
+    def __init__(self, max_length: int = 3500):
+        self.max_length = max_length
+        self._tail: List[str] = []
+        self._tail_units = 0
+        self._started = False
+    
+    def feed(self, delta: str) -> List[str]:
+        """افزودن تکه جدید و دریافت بخش‌هایی که قطعی شده‌اند"""
+        if not self._started:
+            # مانند strip روی کل متن
+            delta = delta.lstrip()
+            if not delta:
+                return []
+            self._started = True
+        self._tail.append(delta)
+        self._tail_units += MessageSplitter.utf16_len(delta)
+        if "\n" not in delta or self._tail_units <= self.max_length:
+            return []
+        
+        tail = "".join(self._tail)
+        complete = tail[:tail.rfind("\n")]
+        chunker = _MessageChunker(self.max_length)
+        chunks = chunker.run(complete)
+        if not chunker.boundaries:
+            self._tail = [tail]
+            return []
+        
+        ready, line_no = chunker.boundaries[-1]
+        offset = 0
+        for _ in range(line_no):
+            offset = tail.index("\n", offset) + 1
+        rest = tail[offset:]
+        self._tail = [rest]
+        self._tail_units = MessageSplitter.utf16_len(rest)
+        return chunks[:ready]
+    
+    def finish(self) -> List[str]:
+        """تقسیم باقی‌مانده متن پس از پایان دریافت"""
+        tail = "".join(self._tail).rstrip()
+        self._tail = []
+        self._tail_units = 0
+        return _MessageChunker(self.max_length).run(tail)
+
+class MessageSplitter:
+    """تقسیم پیام‌های طولانی به بخش‌های کوچک
+    
+    طول بخش‌ها بر حسب واحدهای UTF-16 (معیار محدودیت طول پیام تلگرام)
+    شمرده می‌شود و بلوک‌های کد <q>...</q> تا حد امکان شکسته نمی‌شوند.
+    """
+    
+    @staticmethod
+    def utf16_len(text: str) -> int:
+        """طول متن بر حسب واحدهای UTF-16"""
+        return len(text.encode("utf-16-le")) // 2
+    
+    @staticmethod
+    def split_message(text: str, max_length: int = 3500) -> List[str]:
+        """تقسیم متن به بخش‌های کوچکتر در زمان خطی"""
+        return _MessageChunker(max_length).run(text)
+    
+    @staticmethod
+    def find_exercise_index(sections: List[str]) -> Optional[int]:
+        """شماره بخش تمرینات (آخرین بخش در صورت داشتن تمرین)"""
+        if sections and ("تمرین" in sections[-1] or "exercise" in sections[-1].lower()):
+            return len(sections) - 1
+        return None
 
 class ContentProvider:
     """ارائه محتوای پیش‌فرض برای درس‌های خاص"""
@@ -488,7 +2745,7 @@ print("سلام دنیا!")</q>
 ۱. **ترکیب متن و متغیرها**:
 <q>name = "علی"
 age = 25
-print(f"سلام {name}، شما {age} سال دارید")</q>
+print(f"سلام {{name}}، شما {{age}} سال دارید")</q>
 
 ۲. **چاپ چند خطی**:
 <q>print("خط اول")
@@ -547,38 +2804,570 @@ age_int = int(age_str)
 number = 123
 number_str = str(number)
 
-# تبدیل عدد صحیح به اعشاری
-int_num = 42
-float_num = float(int_num)</q>
+# تبدیل عدد صحیح به اعشاری
+int_num = 42
+float_num = float(int_num)</q>
+
+📝 تمرینات:
+۱. برنامه‌ای بنویسید که میانگین ۳ عدد را حساب کند
+۲. برنامه‌ای بنویسید که یک رشته را از کاربر بگیرد و طول آن را چاپ کند
+۳. برنامه‌ای بنویسید که یک عدد را از کاربر بگیرد و نوع آن را تغییر دهد
+"""
+        
+        # برای سایر درس‌ها محتوای پیش‌فرض ساده
+        else:
+            return f"""📘 فصل {chapter_num}: {chapter_title}
+📝 درس {lesson_num}: {lesson_title}
+
+در حال حاضر محتوای این درس در دسترس نیست. لطفاً بعداً دوباره تلاش کنید.
+
+می‌توانید به درس‌های قبلی بازگردید یا درس‌های دیگر را امتحان کنید.
+"""
+
+class TokenBucket:
+    """سطل توکن ساده بر اساس ساعت یکنواخت حلقه رویداد"""
+    
+    def __init__(self, rate: float, capacity: int, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now: float) -> float:
+        """زمان باقی‌مانده تا در دسترس بودن یک توکن"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutboundRateLimiter(BaseRateLimiter):
+    """صف مرکزی ارسال به تلگرام با سطل توکن سراسری و سطل هر چت
+    
+    همه درخواست‌های Bot API که chat_id دارند (reply_text، edit_message_text و ...)
+    از این صف عبور می‌کنند؛ بقیه (مثل getUpdates و answerCallbackQuery) مستقیم
+    ارسال می‌شوند. در هر لحظه درخواستی با کمترین اولویت که چتش توکن دارد
+    مجوز می‌گیرد، پس پاسخ‌های تعاملی جلوتر از ارسال‌های انبوه می‌روند. در صورت
+    خطای RetryAfter کل صف به اندازه زمان اعلام‌شده متوقف و درخواست تکرار می‌شود.
+    
+    صف انتظار یک heap بر اساس (اولویت، ترتیب ورود) است. درخواست‌های چتی که
+    توکن ندارد تا زمان پر شدن توکن آن چت کنار گذاشته می‌شوند، پس هر مجوز
+    هزینه O(log n) دارد و چت‌های محدودشده در هر دور دوباره بررسی نمی‌شوند.
+    سطل چت‌ها در یک OrderedDict به ترتیب آخرین استفاده نگه داشته می‌شوند و
+    سطل چت‌های بیکار (پر) با ساخت هر سطل جدید از ابتدای آن حذف می‌شوند.
+    """
+    
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, global_burst: int = SEND_GLOBAL_BURST,
+                 chat_rate: float = SEND_CHAT_RATE, chat_burst: int = SEND_CHAT_BURST,
+                 max_retries: int = SEND_MAX_RETRIES):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global: Optional[TokenBucket] = None
+        self._chats: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        # heap از (اولویت، ترتیب ورود، chat_id، future)
+        self._waiting: List[Tuple[int, int, Hashable, asyncio.Future]] = []
+        # درخواست‌های کنارگذاشته هر چت بدون توکن و heap از (زمان پر شدن توکن، chat_id)
+        self._blocked: Dict[Hashable, List[Tuple[int, int, Hashable, asyncio.Future]]] = {}
+        self._unblock_at: List[Tuple[float, int, Hashable]] = []
+        self._depth = 0
+        self._seq = 0
+        self._paused_until = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.grants = 0
+        self.sent = 0
+        self.retries = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_depth = 0
+    
+    async def initialize(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._global = TokenBucket(self.global_rate, self.global_burst, loop.time())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+    
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for entries in [self._waiting, *self._blocked.values()]:
+            for _, _, _, future in entries:
+                future.cancel()
+        self._waiting.clear()
+        self._blocked.clear()
+        self._unblock_at.clear()
+        self._depth = 0
+    
+    def _chat_bucket(self, chat_id: Hashable, now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        # سطل پر یعنی چت بیکار است و حذف آن محدودیتی را از بین نمی‌برد؛ سطل‌های
+        # نیمه‌خالی هرگز حذف نمی‌شوند تا چت پرترافیک دوباره انفجار کامل نگیرد
+        while self._chats and next(iter(self._chats.values())).is_full(now):
+            self._chats.popitem(last=False)
+        bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+    
+    def _try_grant(self, now: float) -> float:
+        """دادن مجوز به درخواست‌های آماده؛ برگشت: زمان انتظار تا بررسی بعدی"""
+        # بازگرداندن درخواست‌های چت‌هایی که توکنشان پر شده است
+        while self._unblock_at and self._unblock_at[0][0] <= now:
+            chat_id = heapq.heappop(self._unblock_at)[2]
+            for entry in self._blocked.pop(chat_id, ()):
+                heapq.heappush(self._waiting, entry)
+        
+        while self._waiting:
+            if now < self._paused_until:
+                return self._paused_until - now
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return global_wait
+            
+            entry = heapq.heappop(self._waiting)
+            chat_id, future = entry[2], entry[3]
+            if future.done():
+                self._depth -= 1
+                continue
+            if chat_id in self._blocked:
+                self._blocked[chat_id].append(entry)
+                continue
+            bucket = self._chat_bucket(chat_id, now)
+            wait = bucket.wait_time(now)
+            if wait > 0:
+                self._blocked[chat_id] = [entry]
+                self._seq += 1
+                heapq.heappush(self._unblock_at, (now + wait, self._seq, chat_id))
+                continue
+            self._global.consume(now)
+            bucket.consume(now)
+            self._depth -= 1
+            future.set_result(None)
+        return self._unblock_at[0][0] - now if self._unblock_at else 0.0
+    
+    async def _dispatch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            delay = self._try_grant(loop.time())
+            self._wakeup.clear()
+            if not self._waiting and not self._blocked:
+                await self._wakeup.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def _acquire(self, chat_id: Hashable, priority: int):
+        """انتظار تا نوبت ارسال برای این چت برسد"""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if not self._depth and now >= self._paused_until and self._global.wait_time(now) == 0 \
+                and self._chat_bucket(chat_id, now).wait_time(now) == 0:
+            # مسیر سریع: صف خالی است و توکن موجود
+            self._global.consume(now)
+            self._chats[chat_id].consume(now)
+            return
+        
+        future = loop.create_future()
+        self._seq += 1
+        heapq.heappush(self._waiting, (priority, self._seq, chat_id, future))
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+        self._wakeup.set()
+        await future
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        priority = SEND_PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        
+        loop = asyncio.get_running_loop()
+        for attempt_num in range(self.max_retries + 1):
+            enqueued = loop.time()
+            await self._acquire(chat_id, priority)
+            waited = loop.time() - enqueued
+            self.grants += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt_num == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning(f"محدودیت ارسال تلگرام ({endpoint})؛ توقف صف به مدت {e.retry_after} ثانیه")
+                self._paused_until = max(self._paused_until, loop.time() + e.retry_after)
+                # پس از توقف، درخواست با اولویت تعاملی دوباره وارد صف می‌شود
+                priority = SEND_PRIORITY_INTERACTIVE
+    
+    def stats(self) -> Dict[str, Any]:
+        """طول صف و زمان انتظار ارسال‌ها"""
+        return {
+            "queue_depth": self._depth,
+            "max_queue_depth": self.max_depth,
+            "sent": self.sent,
+            "retries": self.retries,
+            "avg_wait": self.total_wait / self.grants if self.grants else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+class AsyncHTTPServer(ABC):
+    """سرور HTTP/1.1 ناهمگام و سبک بر پایه asyncio (پایه سرور وب‌هوک و متریک‌ها)
+    
+    زیرکلاس‌ها فقط _dispatch را پیاده‌سازی می‌کنند. تعداد درخواست‌های در حال
+    پردازش به max_connections محدود است و اتصال‌های keep-alive بیکار پس از
+    WEBHOOK_IDLE_TIMEOUT بسته می‌شوند. اتصالی که بدنه اعلام‌شده را در
+    WEBHOOK_READ_TIMEOUT نفرستد هم بسته می‌شود.
+    """
+    
+    NAME = "سرور HTTP"
+    CONTENT_TYPE = "text/plain; charset=utf-8"
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+               405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+    
+    def __init__(self, listen: str, port: int, max_connections: int):
+        self.listen = listen
+        self.port = port
+        self.max_connections = max_connections
+        self._slots = asyncio.Semaphore(max_connections)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: set = set()
+    
+    async def start(self):
+        """شروع گوش دادن روی آدرس و پورت تعیین‌شده"""
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        # پورت واقعی (برای حالت port=0 در آزمایش‌ها)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"{self.NAME} روی {self.listen}:{self.port} آماده است")
+    
+    async def stop(self):
+        """توقف پذیرش اتصال جدید و بستن اتصال‌های باز"""
+        if self._server is None:
+            return
+        self._server.close()
+        for task in list(self._connections):
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        logger.info(f"{self.NAME} متوقف شد")
+    
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """پردازش درخواست‌های یک اتصال (با پشتیبانی از keep-alive)"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+    
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        """خواندن یک درخواست HTTP و پاسخ به آن؛ مقدار برگشتی یعنی اتصال باز بماند"""
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), WEBHOOK_IDLE_TIMEOUT)
+        lines = head.decode("latin-1").split("\r\n")
+        method, target, version = (lines[0].split(" ") + ["", "", ""])[:3]
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            await self._respond(writer, 400, False)
+            return False
+        if length > WEBHOOK_MAX_BODY:
+            await self._respond(writer, 413, False)
+            return False
+        body = await asyncio.wait_for(reader.readexactly(length), WEBHOOK_READ_TIMEOUT) if length else b""
+        
+        async with self._slots:
+            status, payload = await self._dispatch(method, target.split("?", 1)[0], headers, body)
+        await self._respond(writer, status, keep_alive, payload)
+        return keep_alive
+    
+    @abstractmethod
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+        """پردازش درخواست؛ برگشت: کد وضعیت و بدنه پاسخ"""
+    
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool, payload: bytes = b""):
+        """ارسال پاسخ"""
+        connection = "keep-alive" if keep_alive else "close"
+        writer.write(
+            f"HTTP/1.1 {status} {self.REASONS[status]}\r\n"
+            f"Content-Type: {self.CONTENT_TYPE}\r\nContent-Length: {len(payload)}\r\n"
+            f"Connection: {connection}\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
 
-📝 تمرینات:
-۱. برنامه‌ای بنویسید که میانگین ۳ عدد را حساب کند
-۲. برنامه‌ای بنویسید که یک رشته را از کاربر بگیرد و طول آن را چاپ کند
-۳. برنامه‌ای بنویسید که یک عدد را از کاربر بگیرد و نوع آن را تغییر دهد
-"""
+class WebhookServer(AsyncHTTPServer):
+    """سرور وب‌هوک برای دریافت آپدیت‌های تلگرام
+    
+    فقط درخواست‌های POST به مسیر تعیین‌شده با هدر توکن مخفی صحیح پذیرفته
+    می‌شوند و سرور بدون توکن مخفی ساخته نمی‌شود، چون هر کسی که آدرس را
+    بداند می‌تواند آپدیت جعلی بفرستد. بدنه JSON هر آپدیت به on_update داده می‌شود و پاسخ 200 بلافاصله
+    برگردانده می‌شود. برای آزمایش محلی کافی است JSON یک آپدیت ضبط‌شده را به
+    همین مسیر POST کنید.
+    """
+    
+    NAME = "سرور وب‌هوک"
+    SECRET_HEADER = "x-telegram-bot-api-secret-token"
+    
+    def __init__(self, on_update: Callable[[Dict[str, Any]], Awaitable[None]],
+                 listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret_token: str = WEBHOOK_SECRET_TOKEN, max_connections: int = WEBHOOK_MAX_CONNECTIONS):
+        if not secret_token:
+            raise ValueError("برای حالت وب‌هوک متغیر WEBHOOK_SECRET_TOKEN لازم است")
+        super().__init__(listen, port, max_connections)
+        self.on_update = on_update
+        self.path = path
+        self.secret_token = secret_token
+        self.accepted = 0
+        self.rejected = 0
+    
+    async def stop(self):
+        await super().stop()
+        logger.info(f"آمار وب‌هوک (پذیرفته: {self.accepted}، رد شده: {self.rejected})")
+    
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+        """اعتبارسنجی درخواست و تحویل آپدیت"""
+        if path != self.path:
+            return 404, b""
+        if method != "POST":
+            return 405, b""
+        if not hmac.compare_digest(headers.get(self.SECRET_HEADER, "").encode(), self.secret_token.encode()):
+            self.rejected += 1
+            logger.warning("درخواست وب‌هوک با توکن مخفی نامعتبر رد شد")
+            return 403, b""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.rejected += 1
+            return 400, b""
+        if not isinstance(data, dict):
+            self.rejected += 1
+            return 400, b""
         
-        # برای سایر درس‌ها محتوای پیش‌فرض ساده
-        else:
-            return f"""📘 فصل {chapter_num}: {chapter_title}
-📝 درس {lesson_num}: {lesson_title}
+        self.accepted += 1
+        await self.on_update(data)
+        return 200, b""
 
-در حال حاضر محتوای این درس در دسترس نیست. لطفاً بعداً دوباره تلاش کنید.
+class MetricsServer(AsyncHTTPServer):
+    """نمایش متریک‌ها در قالب متنی Prometheus روی GET /metrics"""
+    
+    NAME = "سرور متریک‌ها"
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+    
+    def __init__(self, registry: "MetricsRegistry", listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        super().__init__(listen, port, max_connections=4)
+        self.registry = registry
+    
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+        if path != "/metrics":
+            return 404, b""
+        if method != "GET":
+            return 405, b""
+        return 200, self.registry.render().encode("utf-8")
 
-می‌توانید به درس‌های قبلی بازگردید یا درس‌های دیگر را امتحان کنید.
-"""
+class StorageServer(AsyncHTTPServer):
+    """سرور ذخیره‌ساز مشترک: متدهای یک StorageBackend را روی POST /rpc ارائه می‌دهد
+    
+    فراخوانی‌ها روی یک نخ اختصاصی و به ترتیب اجرا می‌شوند (مانند AsyncDatabaseManager)
+    تا قفل‌های تولید درس بین نمونه‌ها اتمیک باشند.
+    """
+    
+    NAME = "سرور ذخیره‌ساز"
+    CONTENT_TYPE = "application/json"
+    METHODS = ("get_lesson_content", "save_lesson_content", "get_lesson_sections", "get_lesson_section",
+               "has_lesson", "get_user_progress", "update_user_progress", "update_user_progress_many",
+               "claim_generation", "release_generation", "delete_stale_lessons", "lesson_storage_stats")
+    
+    def __init__(self, backend: StorageBackend, listen: str = "127.0.0.1", port: int = 8700,
+                 token: str = STORAGE_TOKEN, max_connections: int = 64):
+        super().__init__(listen, port, max_connections)
+        self.backend = backend
+        self.token = token
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-worker")
+    
+    async def stop(self):
+        await super().stop()
+        self._executor.shutdown(wait=True)
+        self.backend.close()
+    
+    async def _dispatch(self, method: str, path: str, headers: Dict[str, str], body: bytes) -> Tuple[int, bytes]:
+        if path != "/rpc":
+            return 404, b""
+        if method != "POST":
+            return 405, b""
+        if self.token and not hmac.compare_digest(
+                headers.get("authorization", "").encode(), f"Bearer {self.token}".encode()):
+            return 403, b""
+        try:
+            request = json.loads(body)
+            name, args = request["method"], request.get("args", [])
+        except (ValueError, KeyError, TypeError):
+            return 400, b""
+        if name not in self.METHODS:
+            return 404, b""
+        
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._executor, lambda: getattr(self.backend, name)(*args))
+        except Exception as e:
+            # خطای ذخیره‌ساز به کلاینت گزارش می‌شود و اتصال باز می‌ماند
+            logger.error(f"خطا در اجرای {name} در سرور ذخیره‌ساز: {e}")
+            return 500, json.dumps({"error": f"{type(e).__name__}: {e}"}, ensure_ascii=False).encode("utf-8")
+        if isinstance(result, LessonSection):
+            result = asdict(result)
+        return 200, json.dumps({"result": result}, ensure_ascii=False).encode("utf-8")
 
 class PythonMentorBot:
-    """کلاس اصلی ربات مربی پایتون"""
+    """کلاس اصلی ربات مربی پایتون
     
-    def __init__(self):
-        self.db_manager = DatabaseManager(DB_PATH)
-        self.curriculum_manager = CurriculumManager("chapters.json")
-        self.ai_client = DeepSeekClient(DEEPSEEK_API_KEY, DEEPSEEK_BASE_URL)
+    ساخت ربات هیچ فایل، اتصال یا کلاینت HTTP ایجاد نمی‌کند؛ دیتابیس، کلاینت
+    DeepSeek و برنامه آموزشی در اولین استفاده (یا در on_startup پیش از اولین
+    آپدیت) ساخته می‌شوند تا ابزارها و بنچمارک‌ها فقط هزینه اجزای لازم را بپردازند.
+    """
+    
+    def __init__(self, config: Optional[BotConfig] = None, metrics: Optional[BotMetrics] = None):
+        self.config = config = config or BotConfig.from_env()
+        # متریک‌های این نمونه (جدا از ربات‌های دیگر همین فرایند)
+        self.metrics = metrics or BotMetrics()
+        # شناسه این نمونه برای قفل‌های تولید درس در ذخیره‌ساز مشترک
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.generation_scheduler = GenerationScheduler(config.deepseek_max_concurrency, self.metrics)
         self.message_splitter = MessageSplitter()
         self.content_provider = ContentProvider()
+        self.lesson_flights = SingleFlight()
+        self.lesson_streams: Dict[Tuple[int, int], LessonStream] = {}
+        # درس‌های نمایش‌داده‌شده‌ای که در کش نیستند: (زمان انقضا، stream)
+        self.uncached_lessons: Dict[Tuple[int, int], Tuple[float, LessonStream]] = {}
+        self.edit_stats = {"edited": 0, "skipped": 0, "sent": 0}
+        self.rate_limiter = OutboundRateLimiter(config.send_global_rate, config.send_global_burst,
+                                                config.send_chat_rate, config.send_chat_burst,
+                                                config.send_max_retries)
+        # آخرین آمار حجم دروس ذخیره‌شده (پس از هر پاک‌سازی نسخه‌های قدیمی به‌روز می‌شود)
+        self.storage_stats: Dict[str, Any] = {}
+        self.invalidation_task: Optional[asyncio.Task] = None
+        self.curriculum_watch_task: Optional[asyncio.Task] = None
+        self.curriculum_lock = asyncio.Lock()
+        self.curriculum_stats = {"reloads": 0, "failed_reloads": 0, "invalidated": 0}
+        # دروس پیش‌واکشی‌شده‌ای که هنوز کاربری آن‌ها را باز نکرده است
+        self.prefetched: Dict[Tuple[int, int], bool] = {}
+        self.prefetch_tasks: Set[asyncio.Task] = set()
+        self.prefetch_stats = {"requested": 0, "generated": 0, "warmed": 0, "failed": 0, "hits": 0, "late": 0}
+        # موقعیت فعلی کاربران فعال (پیشرفت ماندگار در دیتابیس است)
+        self.sessions = SessionStore(config.session_ttl, config.session_max_active)
+        # نسخه کوتاه محتوای هر درس برای داده دکمه‌ها (بر اساس عنوان‌ها)
+        self._callback_versions: Dict[Tuple[int, int, str, str], str] = {}
+        
+        # جدول مسیرهای دکمه‌های شیشه‌ای
+        self.callback_routes: Dict[str, Callable[[Any, Any, List[str]], Awaitable[None]]] = {
+            CB_CHAPTER: self.chapter_callback,
+            CB_LESSON: self.lesson_callback,
+            CB_NAV_LESSON: self.nav_lesson_callback,
+            CB_BACK: self.back_callback,
+            CB_NEXT: self.next_section_callback,
+            CB_PREV: self.prev_section_callback,
+            CB_EXERCISES: self.show_exercises_callback,
+        }
+        
+        # متریک‌ها: آمار اجزای موجود به صورت gauge و سرور محلی /metrics
+        # (آمار اجزای تنبل تا پیش از ساخت آن‌ها خالی است و خواندن متریک‌ها آن‌ها را نمی‌سازد)
+        self.metrics.register_stats("lesson_cache",
+                                    lambda: self.db_manager.lesson_cache.stats() if self.built("db_manager") else {})
+        self.metrics.register_stats("progress_buffer",
+                                    lambda: self.db_manager.progress_stats() if self.built("db_manager") else {})
+        self.metrics.register_stats("lesson_flights", self.lesson_flights.stats)
+        self.metrics.register_stats("deepseek_client",
+                                    lambda: self.ai_client.stats() if self.built("ai_client") else {})
+        self.metrics.register_stats("generation_queue", self.generation_scheduler.stats)
+        self.metrics.register_stats("telegram_send", self.rate_limiter.stats)
+        self.metrics.register_stats("lesson_display", lambda: self.edit_stats)
+        self.metrics.register_stats("lesson_storage", lambda: self.storage_stats)
+        self.metrics.register_stats("prefetch", self.prefetch_report)
+        self.metrics.register_stats("curriculum", lambda: self.curriculum_stats)
+        self.metrics.register_stats("user_sessions", self.sessions.stats)
+        self.metrics_server = (
+            MetricsServer(self.metrics, config.metrics_listen, config.metrics_port)
+            if config.metrics_port else None
+        )
+    
+    @functools.cached_property
+    def db_manager(self) -> AsyncDatabaseManager:
+        """لایه غیرمسدودکننده ذخیره‌ساز (در اولین استفاده ساخته می‌شود)"""
+        config = self.config
+        return AsyncDatabaseManager(
+            create_storage(config),
+            LessonCache(config.lesson_cache_max_items, config.lesson_cache_max_bytes),
+            config.progress_flush_interval,
+            config.progress_flush_max_pending,
+            self.metrics,
+        )
+    
+    @functools.cached_property
+    def curriculum_manager(self) -> CurriculumManager:
+        """برنامه آموزشی (در اولین استفاده خوانده می‌شود)"""
+        return CurriculumManager(self.config.curriculum_file)
+    
+    @functools.cached_property
+    def ai_client(self) -> DeepSeekClient:
+        """کلاینت DeepSeek (در اولین استفاده ساخته می‌شود)"""
+        config = self.config
+        return DeepSeekClient(
+            config.deepseek_api_key, config.deepseek_base_url,
+            max_retries=config.deepseek_max_retries,
+            backoff_base=config.deepseek_backoff_base,
+            backoff_max=config.deepseek_backoff_max,
+            breaker=CircuitBreaker(config.deepseek_breaker_threshold, config.deepseek_breaker_reset),
+            retry_budget=config.deepseek_retry_budget,
+            model=config.deepseek_model,
+            metrics=self.metrics,
+        )
+    
+    def built(self, name: str) -> bool:
+        """آیا جزء تنبل name تا کنون ساخته شده است"""
+        return name in self.__dict__
+    
+    def build_components(self):
+        """ساخت همه اجزای تنبل (برنامه آموزشی، ذخیره‌ساز و کلاینت DeepSeek)"""
+        for name in ("curriculum_manager", "db_manager", "ai_client"):
+            getattr(self, name)
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """مدیریت دستور /start"""
+        with self.metrics.handler_latency.time(handler="start"):
+            await self.send_welcome(update)
+    
+    async def send_welcome(self, update: Update):
+        """ارسال پیام خوش‌آمد و کیبورد اصلی"""
         welcome_text = """🎓 به ربات مربی پایتون خوش آمدید!
 
 من یک مربی سختگیرم که به شما کمک می‌کنم به صورت گام به گام پایتون یاد بگیرید."""
@@ -595,83 +3384,505 @@ class PythonMentorBot:
     
     async def show_chapters_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """نمایش منوی فصل‌ها"""
-        chapters_text = self.curriculum_manager.get_chapters_list()
-        chapters_buttons = self.curriculum_manager.get_chapters_buttons()
+        reply_markup = self.curriculum_manager.get_chapters_markup()
         
-        if not chapters_buttons:
+        if reply_markup is None:
             await update.message.reply_text("❌ فایل فصل‌ها یافت نشد. لطفاً فایل chapters.json را بررسی کنید.")
             return
             
-        reply_markup = InlineKeyboardMarkup(chapters_buttons)
-        await update.message.reply_text(chapters_text, reply_markup=reply_markup)
+        await update.message.reply_text(self.curriculum_manager.get_chapters_list(), reply_markup=reply_markup)
+    
+    @staticmethod
+    def callback_branch(data: str) -> str:
+        """نام شاخه هندلر دکمه برای متریک‌ها (بدون شماره فصل و درس)"""
+        return CALLBACK_ROUTE_NAMES.get(CallbackData.decode(data)[0], "unknown")
     
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """مدیریت دکمه‌های کیبورد و دکمه‌های شیشه‌ای"""
         query = update.callback_query
+        with self.metrics.handler_latency.time(handler="button:" + self.callback_branch(query.data or "")):
+            await self.handle_button(query, context)
+    
+    async def handle_button(self, query, context):
+        """اجرای هندلر مربوط به عمل داده دکمه از جدول مسیرها"""
         await query.answer()
         
-        data = query.data
+        action, args = CallbackData.decode(query.data or "")
+        route = self.callback_routes.get(action)
+        if route is None:
+            logger.warning(f"داده دکمه ناشناخته: {query.data!r}")
+            return
+        await route(query, context, args)
+    
+    async def chapter_callback(self, query, context, args: List[str]):
+        """نمایش درس‌های فصل انتخاب‌شده"""
+        await self.show_chapter_lessons(query, context, int(args[0]))
+    
+    async def lesson_callback(self, query, context, args: List[str]):
+        """شروع درس انتخاب‌شده از منوی فصل"""
+        key = await self.resolve_lesson_button(query, args)
+        if key is not None:
+            await self.start_lesson_by_numbers(query, context, *key)
+    
+    async def nav_lesson_callback(self, query, context, args: List[str]):
+        """ناوبری بین درس‌ها از داخل درس"""
+        key = await self.resolve_lesson_button(query, args)
+        if key is not None:
+            await self.start_lesson_by_numbers(query, context, *key, edit=self.config.lesson_edit_in_place)
+    
+    async def resolve_lesson_button(self, query, args: List[str]) -> Optional[LessonKey]:
+        """موقعیت فعلی درس دکمه؛ برای درس حذف‌شده پاسخ «منو قدیمی است» و None"""
+        parsed = CallbackData.parse_lesson(args)
+        if parsed is None:
+            logger.warning(f"داده دکمه درس نامعتبر: {args!r}")
+            return None
+        key = self.curriculum_manager.resolve_lesson(*parsed)
+        if key is None:
+            await query.answer(MENU_OUTDATED_TEXT, show_alert=True)
+        return key
+    
+    async def back_callback(self, query, context, args: List[str]):
+        """بازگشت به منوی فصل‌ها"""
+        await self.back_to_chapters_menu(query, context)
+    
+    async def show_chapter_lessons(self, query, context, chapter_num):
+        """نمایش درس‌های یک فصل"""
+        lessons_text = self.curriculum_manager.get_lessons_text(chapter_num)
+        
+        if lessons_text is not None:
+            reply_markup = self.curriculum_manager.get_lessons_markup(chapter_num)
+            await query.edit_message_text(lessons_text, reply_markup=reply_markup)
+    
+    async def back_to_chapters_menu(self, query, context):
+        """بازگشت به منوی فصل‌ها"""
+        reply_markup = self.curriculum_manager.get_chapters_markup()
+        if reply_markup is not None:
+            await query.edit_message_text(self.curriculum_manager.get_chapters_list(), reply_markup=reply_markup)
+        else:
+            await query.edit_message_text("❌ خطایی در بارگذاری فصل‌ها رخ داده است.")
+    
+    def lesson_version(self, chapter_num: int, lesson_num: int, chapter_title: str, lesson_title: str) -> str:
+        """نسخه محتوای مورد انتظار یک درس برای کلید کش"""
+        if chapter_num == 1 and lesson_num in [1, 2, 3, 4]:
+            content = self.content_provider.get_default_content(chapter_num, lesson_num, chapter_title, lesson_title)
+            return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        return self.ai_client.content_version(chapter_title, lesson_title)
+    
+    def curriculum_lessons(self, chapter: Optional[int] = None) -> List[Tuple[int, int, str, str]]:
+        """همه دروس برنامه آموزشی به صورت (فصل، درس، عنوان فصل، عنوان درس)"""
+        lessons = []
+        for chapter_num, chapter_info in enumerate(self.curriculum_manager.curriculum.get("chapters", []), 1):
+            if chapter is not None and chapter_num != chapter:
+                continue
+            for lesson_num, lesson in enumerate(chapter_info.get("lessons", []), 1):
+                lessons.append((chapter_num, lesson_num, chapter_info["title"], lesson["title"]))
+        return lessons
+    
+    async def invalidate_stale_lessons(self, removed: List[LessonKey] = ()) -> List[Tuple[int, int]]:
+        """حذف دروس کش‌شده‌ای که با پرامپت، مدل یا عنوان فعلی تولید نشده‌اند
+        
+        دروس موقعیت‌های removed (که دیگر در برنامه نیستند) هم حذف می‌شوند.
+        دروس حذف‌شده در درخواست بعدی دوباره تولید می‌شوند.
+        """
+        expected = [
+            (chapter_num, lesson_num, self.lesson_version(chapter_num, lesson_num, chapter_title, lesson_title))
+            for chapter_num, lesson_num, chapter_title, lesson_title in self.curriculum_lessons()
+        ]
+        # نسخه خالی با هیچ نسخه ذخیره‌شده‌ای برابر نیست
+        expected.extend((chapter_num, lesson_num, "") for chapter_num, lesson_num in removed)
+        stale = await self.db_manager.delete_stale_lessons(expected)
+        if stale:
+            logger.info(f"{len(stale)} درس با نسخه قدیمی از کش حذف شد: {sorted(tuple(key) for key in stale)}")
+        self.storage_stats = await self.db_manager.lesson_storage_stats()
+        logger.info(f"آمار ذخیره‌سازی دروس: {self.storage_stats}")
+        return stale
+    
+    async def reload_curriculum(self) -> Optional[CurriculumDiff]:
+        """بارگذاری دوباره chapters.json و حذف فقط دروس تغییرکرده یا حذف‌شده از کش
         
-        if data.startswith("chapter_"):
-            chapter_num = int(data.split("_")[1])
-            await self.show_chapter_lessons(query, context, chapter_num)
+        دروس بدون تغییر در کش (و در حافظه) باقی می‌مانند. دکمه‌های پیام‌های
+        قبلی نسخه درس را دارند، پس کاربری که وسط درس تغییرکرده است با دکمه
+        بعدی همان درس را (حتی اگر جابه‌جا شده باشد) از ابتدا با محتوای جدید می‌بیند.
+        """
+        async with self.curriculum_lock:
+            diff = self.curriculum_manager.reload()
+            if diff is None:
+                self.curriculum_stats["failed_reloads"] += 1
+                return None
+            self.curriculum_stats["reloads"] += 1
+            self._callback_versions.clear()
+            if diff.changed or diff.removed:
+                stale = await self.invalidate_stale_lessons(diff.removed)
+                self.curriculum_stats["invalidated"] += len(stale)
+            return diff
+    
+    async def watch_curriculum(self, interval: Optional[float] = None):
+        """بررسی دوره‌ای تغییر فایل برنامه آموزشی و بارگذاری دوباره آن"""
+        interval = self.config.curriculum_reload_interval if interval is None else interval
+        while True:
+            await asyncio.sleep(interval)
+            if self.curriculum_manager.changed_on_disk():
+                try:
+                    await self.reload_curriculum()
+                except Exception as e:
+                    logger.error(f"خطا در بارگذاری دوباره برنامه آموزشی: {e}")
+    
+    async def reload_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """دستور مدیریتی /reload برای بارگذاری دوباره برنامه آموزشی"""
+        with self.metrics.handler_latency.time(handler="reload"):
+            if update.effective_user.id not in self.config.admin_user_ids:
+                await update.message.reply_text("❓ دستور نامعتبر. از منوی اصلی استفاده کنید.")
+                return
+            diff = await self.reload_curriculum()
+            if diff is None:
+                await update.message.reply_text("❌ خطا در خواندن chapters.json؛ برنامه قبلی حفظ شد.")
+                return
+            await update.message.reply_text(
+                f"✅ برنامه آموزشی به‌روزرسانی شد.\n"
+                f"تغییرکرده: {len(diff.changed)}، جدید: {len(diff.added)}، حذف‌شده: {len(diff.removed)}"
+            )
+    
+    async def generate_and_cache_lesson(self, chapter_num: int, lesson_num: int, chapter_title: str, lesson_title: str,
+                                        stream: Optional[LessonStream] = None, allow_fallback: bool = True,
+                                        priority: int = GENERATION_PRIORITY_INTERACTIVE) -> Optional[str]:
+        """تولید محتوای درس و ذخیره آن در کش
         
-        elif data.startswith("lesson_"):
-            parts = data.split("_")
-            chapter_num = int(parts[1])
-            lesson_num = int(parts[2])
+        بخش‌ها به محض آماده شدن در stream قرار می‌گیرند و stream در هر حالت
+        در پایان بسته می‌شود. اگر تولید با AI ناموفق شود محتوای جایگزین فقط
+        نمایش داده می‌شود و هرگز در کش ذخیره نمی‌شود؛ با allow_fallback
+        غیرفعال به جای آن None برمی‌گردد. اگر تولید جریانی پس از رسیدن بخشی از
+        متن به کاربر قطع شود، همان بخش‌ها به همراه پیام تلاش دوباره باقی می‌مانند
+        و None برمی‌گردد. درخواست API با اولویت priority در
+        زمان‌بند تولید قرار می‌گیرد و فقط تولیدهای تعاملی جریانی هستند.
+        """
+        stream = stream or LessonStream()
+        sections: List[str] = []
+        leased = False
+        try:
+            # ممکن است درخواست دیگری در این فاصله درس را ذخیره کرده باشد
+            cached_content = await self.db_manager.get_lesson_content(chapter_num, lesson_num)
+            if cached_content:
+                sections = self.message_splitter.split_message(cached_content)
+                stream.cached = True
+                return cached_content
             
-            # اجرای درس
-            await self.start_lesson_by_numbers(query, context, chapter_num, lesson_num)
+            # برای درس‌های اولیه از محتوای پیش‌فرض استفاده می‌کنیم
+            if chapter_num == 1 and lesson_num in [1, 2, 3, 4]:
+                lesson_content = self.content_provider.get_default_content(
+                    chapter_num, lesson_num, chapter_title, lesson_title
+                )
+                logger.info(f"استفاده از محتوای پیش‌فرض برای درس {chapter_num}-{lesson_num}")
+            else:
+                # اگر نمونه دیگری همین درس را تولید می‌کند منتظر نتیجه آن می‌مانیم
+                filled = await self.wait_for_generation_lease(chapter_num, lesson_num)
+                if filled is not None:
+                    lesson_content, sections = filled
+                    stream.cached = True
+                    return lesson_content
+                leased = True
+                
+                # برای سایر درس‌ها سعی می‌کنیم از AI استفاده کنیم
+                if self.config.deepseek_streaming and priority == GENERATION_PRIORITY_INTERACTIVE:
+                    splitter = IncrementalSplitter()
+                    result = await self.generation_scheduler.run(
+                        lambda: self.ai_client.generate_lesson_streaming(
+                            chapter_title, lesson_title,
+                            lambda delta: stream.add_sections(splitter.feed(delta))
+                        ),
+                        priority, (chapter_num, lesson_num)
+                    )
+                    if result.ok:
+                        sections = stream.sections + splitter.finish()
+                else:
+                    # کارهای پس‌زمینه ممکن است متوقف و از ابتدا تکرار شوند، پس جریانی نیستند
+                    result = await self.generation_scheduler.run(
+                        lambda: self.ai_client.generate_lesson(chapter_title, lesson_title),
+                        priority, (chapter_num, lesson_num)
+                    )
+                
+                logger.info(
+                    f"تولید درس {chapter_num}-{lesson_num}: ok={result.ok} status={result.status_code} "
+                    f"latency={result.latency:.2f}s attempts={result.attempts} tokens={result.total_tokens}"
+                )
+                lesson_content = result.content
+                
+                # اگر AI موفق نبود، از محتوای پیش‌فرض استفاده می‌کنیم
+                if not result.ok:
+                    if stream.sections:
+                        # بخشی از متن AI به کاربر رسیده است؛ جایگزینی با محتوای پیش‌فرض شماره بخش‌ها
+                        # را به هم می‌ریزد، پس بخش‌های ارسال‌شده حفظ و درس با پیام تلاش دوباره بسته می‌شود
+                        logger.error(f"تولید جریانی درس {chapter_num}-{lesson_num} پس از {len(stream.sections)} بخش "
+                                     f"ناموفق بود: {result.error_kind} - {result.error_message}")
+                        sections = stream.sections + [LESSON_STREAM_FAILED_TEXT]
+                        return None
+                    if not allow_fallback:
+                        logger.error(f"تولید درس {chapter_num}-{lesson_num} ناموفق بود: {result.error_kind} - {result.error_message}")
+                        return None
+                    lesson_content = self.content_provider.get_default_content(
+                        chapter_num, lesson_num, chapter_title, lesson_title
+                    )
+                    sections = self.message_splitter.split_message(lesson_content)
+                    logger.info(f"استفاده از محتوای پیش‌فرض به دلیل خطا در AI برای درس {chapter_num}-{lesson_num} (بدون ذخیره در کش)")
+                    return lesson_content
+            
+            if not sections:
+                sections = self.message_splitter.split_message(lesson_content)
+            if not sections:
+                # درس بدون بخش هرگز ذخیره نمی‌شود تا در درخواست بعدی دوباره تولید شود
+                logger.error(f"درس {chapter_num}-{lesson_num} پس از تقسیم هیچ بخشی نداشت؛ بدون ذخیره در کش")
+                return None
+            
+            # اگر برنامه آموزشی در حین تولید عوض شده باشد محتوا فقط نمایش داده می‌شود
+            current_chapter = self.curriculum_manager.get_chapter_info(chapter_num) or {}
+            if (current_chapter.get("title") != chapter_title
+                    or self.curriculum_manager.get_lesson_title(chapter_num, lesson_num) != lesson_title):
+                logger.info(f"عنوان درس {chapter_num}-{lesson_num} در حین تولید تغییر کرد؛ بدون ذخیره در کش")
+                return lesson_content
+            
+            # ذخیره در کش به همراه نسخه محتوا
+            await self.db_manager.save_lesson_content(
+                chapter_num, lesson_num, lesson_content, sections,
+                self.lesson_version(chapter_num, lesson_num, chapter_title, lesson_title)
+            )
+            stream.cached = True
+            logger.info(f"ذخیره کش برای درس {chapter_num}-{lesson_num}")
+            return lesson_content
+        finally:
+            stream.finish(sections)
+            if leased:
+                await self.db_manager.release_generation(chapter_num, lesson_num, self.instance_id)
+    
+    async def wait_for_generation_lease(self, chapter_num: int, lesson_num: int) -> Optional[Tuple[str, List[str]]]:
+        """گرفتن قفل تولید درس در ذخیره‌ساز مشترک
         
-        elif data == "back_to_chapters":
-            await self.back_to_chapters_menu(query, context)
+        اگر قفل گرفته شود None برمی‌گردد و این نمونه درس را تولید می‌کند. در غیر
+        این صورت تا ذخیره شدن درس توسط نمونه دیگر (یا انقضای قفل آن) صبر
+        می‌کند و محتوا و بخش‌های ذخیره‌شده را برمی‌گرداند.
+        """
+        while not await self.db_manager.claim_generation(chapter_num, lesson_num, self.instance_id,
+                                                         self.config.generation_lease_ttl):
+            await asyncio.sleep(self.config.generation_lease_poll)
+            content = await self.db_manager.get_lesson_content(chapter_num, lesson_num)
+            if content:
+                logger.info(f"درس {chapter_num}-{lesson_num} توسط نمونه دیگری تولید شد")
+                loaded = await self.db_manager.get_lesson_sections(chapter_num, lesson_num)
+                return content, loaded[0] if loaded else self.message_splitter.split_message(content)
+        
+        # ممکن است درس پیش از گرفتن قفل ذخیره شده باشد
+        content = await self.db_manager.get_lesson_content(chapter_num, lesson_num)
+        if content:
+            await self.db_manager.release_generation(chapter_num, lesson_num, self.instance_id)
+            loaded = await self.db_manager.get_lesson_sections(chapter_num, lesson_num)
+            return content, loaded[0] if loaded else self.message_splitter.split_message(content)
+        return None
+    
+    def start_lesson_generation(self, chapter_num: int, lesson_num: int, chapter_title: str, lesson_title: str,
+                                stream: Optional[LessonStream] = None) -> LessonStream:
+        """شروع تولید درس در پس‌زمینه یا پیوستن به تولید در جریان
         
-        elif data == "next_section":
-            await self.next_section_callback(query, context)
+        اگر تولید مشترکی که به آن پیوسته‌ایم (مثلاً پیش‌واکشی بدون محتوای
+        جایگزین) نتیجه‌ای نداشته باشد، درخواست یک بار دیگر برای همین stream و
+        با محتوای جایگزین اجرا می‌شود تا کاربر تعاملی پیام خطا نبیند.
+        """
+        key = (chapter_num, lesson_num)
+        retry = stream is None
+        stream = stream or self.lesson_streams.get(key)
+        if stream is None or stream.done:
+            stream = LessonStream()
+        self.lesson_streams[key] = stream
+        # تلاش تازه جای نسخه کش‌نشده قبلی این درس را می‌گیرد
+        self.uncached_lessons.pop(key, None)
         
-        elif data == "prev_section":
-            await self.prev_section_callback(query, context)
+        # درخواست‌های همزمان برای یک درس فقط یک بار تولید می‌شوند
+        generation = asyncio.ensure_future(self.lesson_flights.do(
+            (chapter_num, lesson_num, PROMPT_VERSION),
+            lambda: self.generate_and_cache_lesson(chapter_num, lesson_num, chapter_title, lesson_title, stream)
+        ))
+        # اگر همین درس در پس‌زمینه تولید می‌شود، کاربر اکنون منتظر آن است
+        self.generation_scheduler.promote((chapter_num, lesson_num))
         
-        elif data == "show_exercises":
-            await self.show_exercises_callback(query, context)
+        def on_done(task: asyncio.Task):
+            if self.lesson_streams.get(key) is stream:
+                del self.lesson_streams[key]
+                if stream.done and not stream.cached and stream.sections:
+                    self.keep_uncached_lesson(key, stream)
+            if not task.cancelled() and task.exception():
+                logger.error(f"خطا در تولید درس {chapter_num}-{lesson_num}: {task.exception()}")
+            if not stream.done:
+                # به تولید پس‌زمینه‌ای پیوستیم که stream دیگری داشت
+                content = task.result() if not task.cancelled() and not task.exception() else None
+                if content:
+                    stream.finish(self.message_splitter.split_message(content))
+                    # ممکن است محتوای جایگزینِ کش‌نشده باشد؛ get_section ابتدا کش را می‌خواند
+                    self.keep_uncached_lesson(key, stream)
+                elif retry and not task.cancelled():
+                    logger.info(f"تولید مشترک درس {chapter_num}-{lesson_num} بی‌نتیجه بود؛ تکرار با محتوای جایگزین")
+                    self.start_lesson_generation(chapter_num, lesson_num, chapter_title, lesson_title, stream)
+                else:
+                    stream.finish([])
         
-        elif data.startswith("nav_lesson_"):
-            # ناوبری بین درس‌ها
-            parts = data.split("_")
-            chapter_num = int(parts[2])
-            lesson_num = int(parts[3])
-            await self.start_lesson_by_numbers(query, context, chapter_num, lesson_num)
+        generation.add_done_callback(on_done)
+        return stream
     
-    async def show_chapter_lessons(self, query, context, chapter_num):
-        """نمایش درس‌های یک فصل"""
-        chapter_info = self.curriculum_manager.get_chapter_info(chapter_num)
+    def maybe_prefetch_next(self, chapter: int, lesson: int, section_index: int, section: LessonSection):
+        """شروع پیش‌واکشی درس بعدی وقتی کاربر به میانه درس فعلی رسیده است"""
+        if not self.config.prefetch_enabled or not section.complete:
+            return
+        if section_index + 1 < max(1, math.ceil(section.total * self.config.prefetch_section_threshold)):
+            return
+        _, next_lesson = self.curriculum_manager.get_adjacent_lessons(chapter, lesson)
+        if next_lesson is None or next_lesson in self.prefetched:
+            return
         
-        if chapter_info:
-            lessons_text = f"فصل {chapter_num}: {chapter_info['title']}\n\n"
-            lessons_text += "درس‌های این فصل:\n"
-            for i, lesson in enumerate(chapter_info["lessons"], 1):
-                lessons_text += f"{i}. {lesson['title']}\n"
-            
-            lessons_buttons = self.curriculum_manager.get_lessons_buttons(chapter_num)
-            if lessons_buttons:
-                reply_markup = InlineKeyboardMarkup(lessons_buttons)
-                await query.edit_message_text(lessons_text, reply_markup=reply_markup)
-            else:
-                await query.edit_message_text("❌ خطایی در بارگذاری دروس رخ داده است.")
+        if len(self.prefetched) >= PREFETCH_TRACK_MAX:
+            del self.prefetched[next(iter(self.prefetched))]
+        self.prefetched[next_lesson] = False
+        self.prefetch_stats["requested"] += 1
+        task = asyncio.create_task(self.prefetch_lesson(*next_lesson))
+        self.prefetch_tasks.add(task)
+        task.add_done_callback(self.prefetch_tasks.discard)
     
-    async def back_to_chapters_menu(self, query, context):
-        """بازگشت به منوی فصل‌ها"""
-        chapters_text = self.curriculum_manager.get_chapters_list()
-        chapters_buttons = self.curriculum_manager.get_chapters_buttons()
-        if chapters_buttons:
-            reply_markup = InlineKeyboardMarkup(chapters_buttons)
-            await query.edit_message_text(chapters_text, reply_markup=reply_markup)
-        else:
-            await query.edit_message_text("❌ خطایی در بارگذاری فصل‌ها رخ داده است.")
+    async def prefetch_lesson(self, chapter_num: int, lesson_num: int):
+        """گرم کردن کش درون‌حافظه‌ای یا تولید درس کش‌نشده با اولویت پایین"""
+        try:
+            if await self.db_manager.get_lesson_section(chapter_num, lesson_num, 0) is not None:
+                self.prefetch_stats["warmed"] += 1
+                return
+            chapter_info = self.curriculum_manager.get_chapter_info(chapter_num)
+            lesson_title = self.curriculum_manager.get_lesson_title(chapter_num, lesson_num)
+            self.prefetch_stats["generated"] += 1
+            content = await self.lesson_flights.do(
+                (chapter_num, lesson_num, PROMPT_VERSION),
+                lambda: self.generate_and_cache_lesson(
+                    chapter_num, lesson_num, chapter_info["title"], lesson_title, allow_fallback=False,
+                    priority=GENERATION_PRIORITY_PREFETCH
+                )
+            )
+            if not content:
+                self.prefetch_stats["failed"] += 1
+                self.prefetched.pop((chapter_num, lesson_num), None)
+        except Exception as e:
+            self.prefetch_stats["failed"] += 1
+            self.prefetched.pop((chapter_num, lesson_num), None)
+            logger.error(f"خطا در پیش‌واکشی درس {chapter_num}-{lesson_num}: {e}")
+    
+    def record_prefetch_use(self, chapter_num: int, lesson_num: int, cached: bool):
+        """ثبت باز شدن درس پیش‌واکشی‌شده؛ late یعنی هنوز در حال تولید بود"""
+        if self.prefetched.pop((chapter_num, lesson_num), None) is None:
+            return
+        self.prefetch_stats["hits" if cached else "late"] += 1
+    
+    def prefetch_report(self) -> Dict[str, Any]:
+        """آمار پیش‌واکشی به همراه نرخ استفاده و فراخوانی‌های API صرف‌شده"""
+        stats: Dict[str, Any] = dict(self.prefetch_stats)
+        stats["hit_rate"] = stats["hits"] / stats["requested"] if stats["requested"] else 0.0
+        stats["llm_calls"] = self.generation_scheduler.completed.get("prefetch", 0)
+        stats["in_flight"] = len(self.prefetch_tasks)
+        return stats
+    
+    def keep_uncached_lesson(self, key: Tuple[int, int], stream: LessonStream):
+        """نگه‌داری درس نمایش‌داده‌شده‌ای که در کش ذخیره نشد تا دکمه‌های پیام آن کار کنند"""
+        now = time.monotonic()
+        for old_key in [k for k, (expires, _) in self.uncached_lessons.items() if expires <= now]:
+            del self.uncached_lessons[old_key]
+        self.uncached_lessons.pop(key, None)
+        if len(self.uncached_lessons) >= UNCACHED_LESSONS_MAX:
+            del self.uncached_lessons[next(iter(self.uncached_lessons))]
+        self.uncached_lessons[key] = (now + UNCACHED_LESSON_TTL, stream)
+    
+    async def get_section(self, chapter: int, lesson: int, section_index: int) -> Optional[LessonSection]:
+        """دریافت یک بخش از کش، از درسی که در حال تولید است یا از درس کش‌نشده نمایش‌داده‌شده
+        
+        درسی که تولید جریانی آن پس از چند بخش قطع شده یا با محتوای جایگزین
+        نمایش داده شده در کش نیست؛ بخش‌های آن تا UNCACHED_LESSON_TTL یا تلاش
+        تازه برای همان درس از حافظه خوانده می‌شوند.
+        """
+        key = (chapter, lesson)
+        stream = self.lesson_streams.get(key)
+        if stream is not None and (not stream.done or not stream.cached):
+            return await stream.wait_for_section(section_index)
+        section = await self.db_manager.get_lesson_section(chapter, lesson, section_index)
+        if section is not None:
+            return section
+        entry = self.uncached_lessons.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.uncached_lessons[key]
+            return None
+        return await entry[1].wait_for_section(section_index)
+    
+    async def show_lesson_message(self, query, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None,
+                                  edit: Optional[bool] = None) -> Optional[int]:
+        """نمایش متن درس با ویرایش همان پیام (حالت مطالعه) یا ارسال پیام جدید
+        
+        edit=None یعنی تنظیم lesson_edit_in_place ربات. اگر متن و کیبورد پیام
+        فعلی با مقدار جدید یکی باشد هیچ درخواستی به تلگرام ارسال نمی‌شود. اگر
+        پیام قابل ویرایش نباشد پیام جدید ارسال می‌شود.
+        برگشت: شناسه پیامی که درس در آن نمایش داده شده است.
+        """
+        if edit is None:
+            edit = self.config.lesson_edit_in_place
+        message = query.message
+        if edit and message is not None:
+            if message.text == text and message.reply_markup == reply_markup:
+                self.edit_stats["skipped"] += 1
+                return message.message_id
+            try:
+                await query.edit_message_text(text, reply_markup=reply_markup)
+                self.edit_stats["edited"] += 1
+                return message.message_id
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self.edit_stats["skipped"] += 1
+                    return message.message_id
+                logger.warning(f"ویرایش پیام درس ممکن نبود، پیام جدید ارسال می‌شود: {e}")
+        
+        self.edit_stats["sent"] += 1
+        sent = await message.reply_text(text, reply_markup=reply_markup)
+        return sent.message_id if sent is not None else None
+    
+    async def get_session(self, user_id: int) -> UserSession:
+        """جلسه کاربر؛ در صورت نبود یا انقضا از پیشرفت ذخیره‌شده ساخته می‌شود"""
+        session = self.sessions.get(user_id)
+        if session is None:
+            chapter, lesson, section_index = await self.db_manager.get_user_progress(user_id)
+            session = UserSession(user_id, chapter, lesson, section_index)
+            self.sessions.put(session)
+        return session
+    
+    async def update_session(self, user_id: int, chapter: int, lesson: int, section_index: int,
+                             section: Optional[LessonSection] = None) -> UserSession:
+        """ثبت موقعیت جدید کاربر در جلسه و در بافر پیشرفت
+        
+        بافر پیشرفت نوشتن در دیتابیس را در پس‌زمینه و به صورت دسته‌ای انجام
+        می‌دهد؛ پس از حذف جلسه، موقعیت کاربر از همان‌جا بازیابی می‌شود.
+        """
+        session = self.sessions.get(user_id)
+        if session is None:
+            session = UserSession(user_id)
+        if (session.chapter, session.lesson) != (chapter, lesson):
+            session.message_id = None
+            session.section_count = 0
+        session.chapter = chapter
+        session.lesson = lesson
+        session.section = section_index
+        if section is not None and section.complete:
+            session.section_count = section.total
+        self.sessions.put(session)
+        await self.db_manager.update_user_progress(user_id, chapter, lesson, section_index)
+        return session
+    
+    @staticmethod
+    def section_total_label(section: LessonSection) -> str:
+        """تعداد بخش‌ها برای سربرگ پیام (نامعلوم در حین تولید)"""
+        return str(section.total) if section.complete else "…"
     
-    async def start_lesson_by_numbers(self, query, context, chapter_num, lesson_num):
-        """شروع درس با شماره فصل و درس"""
+    async def start_lesson_by_numbers(self, query, context, chapter_num, lesson_num, edit: bool = False):
+        """شروع درس با شماره فصل و درس
+        
+        با edit=True (رفتن به درس قبلی/بعدی از داخل درس) همان پیام درس ویرایش می‌شود.
+        """
         user_id = query.from_user.id
         
         # اعتبارسنجی درخواست
@@ -687,183 +3898,198 @@ class PythonMentorBot:
             return
         
         # چک کردن کش درس
-        cached_content = self.db_manager.get_lesson_content(chapter_num, lesson_num)
-        
-        if cached_content:
+        cached = await self.db_manager.has_lesson(chapter_num, lesson_num)
+        self.record_prefetch_use(chapter_num, lesson_num, cached)
+        if cached:
             # استفاده از محتوای کش شده
-            lesson_content = cached_content
             logger.info(f"استفاده از کش برای درس {chapter_num}-{lesson_num}")
+            section = await self.get_section(chapter_num, lesson_num, 0)
         else:
             # تولید محتوای جدید از طریق AI
-            await query.message.reply_text("🔄 در حال تولید محتوای درس...")
-            
-            # برای درس‌های اولیه از محتوای پیش‌فرض استفاده می‌کنیم
-            if chapter_num == 1 and lesson_num in [1, 2, 3, 4]:
-                lesson_content = self.content_provider.get_default_content(
-                    chapter_num, lesson_num, chapter_info["title"], lesson_title
-                )
-                logger.info(f"استفاده از محتوای پیش‌فرض برای درس {chapter_num}-{lesson_num}")
-            else:
-                # برای سایر درس‌ها سعی می‌کنیم از AI استفاده کنیم
-                lesson_content = await self.ai_client.generate_lesson(
-                    chapter_info["title"],
-                    lesson_title
-                )
-                
-                # اگر AI موفق نبود، از محتوای پیش‌فرض استفاده می‌کنیم
-                if "❌" in lesson_content:
-                    lesson_content = self.content_provider.get_default_content(
-                        chapter_num, lesson_num, chapter_info["title"], lesson_title
-                    )
-                    logger.info(f"استفاده از محتوای پیش‌فرض به دلیل خطا در AI برای درس {chapter_num}-{lesson_num}")
+            await self.show_lesson_message(query, "🔄 در حال تولید محتوای درس...", edit=edit)
             
-            # ذخیره در کش
-            self.db_manager.save_lesson_content(chapter_num, lesson_num, lesson_content)
-            logger.info(f"ذخیره کش برای درس {chapter_num}-{lesson_num}")
+            # بخش اول به محض آماده شدن ارسال می‌شود
+            stream = self.start_lesson_generation(chapter_num, lesson_num, chapter_info["title"], lesson_title)
+            section = await stream.wait_for_section(0)
         
-        # تبدیل محتوای درس به بخش‌های کوچک
-        sections = self.message_splitter.split_message(lesson_content)
-        if not sections:
+        if not section or section.text is None:
             await query.message.reply_text("❌ خطا در پردازش محتوای درس.")
             return
-            
-        lesson_obj = LessonContent(title=lesson_title, sections=sections)
         
         # ذخیره پیشرفت کاربر
-        self.db_manager.update_user_progress(user_id, chapter_num, lesson_num, 0)
+        session = await self.update_session(user_id, chapter_num, lesson_num, 0, section)
         
         # ارسال بخش اول درس
-        first_section = lesson_obj.sections[0]
-        header = f"📝 پیام ۱ از {len(lesson_obj.sections)} – فصل {chapter_num} درس {lesson_num} – {lesson_obj.title}\n\n"
+        header = f"📝 پیام ۱ از {self.section_total_label(section)} – فصل {chapter_num} درس {lesson_num} – {lesson_title}\n\n"
         
         # دکمه‌های کنترل با توجه به تعداد بخش‌ها
         control_buttons = []
         
         # دکمه بعدی (فقط اگر بخش بعدی وجود داشته باشد)
-        if len(lesson_obj.sections) > 1:
+        if section.total > 1 or not section.complete:
             control_buttons.append([
-                InlineKeyboardButton("➡️ بعدی", callback_data="next_section")
+                InlineKeyboardButton("➡️ بعدی", callback_data=self.section_callback(CB_NEXT, chapter_num, lesson_num, 0))
             ])
         # دکمه تمرینات
         control_buttons.append([
-            InlineKeyboardButton("🎯 تمرینات", callback_data="show_exercises")
+            InlineKeyboardButton("🎯 تمرینات", callback_data=self.section_callback(CB_EXERCISES, chapter_num, lesson_num, 0))
         ])
         reply_markup = InlineKeyboardMarkup(control_buttons)
         
-        await query.message.reply_text(header + first_section, reply_markup=reply_markup)
+        session.message_id = await self.show_lesson_message(query, header + section.text, reply_markup, edit=edit)
+    
+    def callback_version(self, chapter: int, lesson: int) -> Optional[str]:
+        """نسخه کوتاه درس برای داده دکمه‌ها؛ برای درس نامعتبر None
+        
+        همان content_version ذخیره‌شده با درس (lesson_version) است، یعنی هش
+        پرامپت، مدل و عنوان‌ها و نه هش متن. پس فقط تغییر پرامپت یا عنوان‌ها
+        (که درس کش‌شده را هم باطل می‌کند) تشخیص داده می‌شود؛ تولید دوباره همان
+        درس با همان پرامپت و عنوان‌ها (مثلاً پس از تولید ناموفق) نسخه را عوض
+        نمی‌کند و دکمه‌های پیام قبلی به بخش‌های متن تازه اشاره می‌کنند.
+        """
+        chapter_info = self.curriculum_manager.get_chapter_info(chapter)
+        lesson_title = self.curriculum_manager.get_lesson_title(chapter, lesson)
+        if not chapter_info or not lesson_title:
+            return None
+        key = (chapter, lesson, chapter_info["title"], lesson_title)
+        version = self._callback_versions.get(key)
+        if version is None:
+            version = self._callback_versions[key] = self.lesson_version(*key)[:6]
+        return version
+    
+    def section_callback(self, action: str, chapter: int, lesson: int, section_index: int) -> str:
+        """داده دکمه‌های بخش درس به همراه موقعیت، نسخه درس و شناسه درس"""
+        return CallbackData.encode(action, chapter, lesson, section_index, self.callback_version(chapter, lesson),
+                                   self.curriculum_manager.index.lesson_refs.get((chapter, lesson)))
+    
+    async def resolve_section_position(self, query, args: List[str]) -> Optional[Tuple[int, int, int]]:
+        """موقعیت (فصل، درس، بخش) پیامی که دکمه آن زده شده است
+        
+        دکمه‌های قالب جدید موقعیت را با خود دارند و به خواندن پیشرفت کاربر
+        نیازی نیست. درسی که پس از ساخت دکمه جابه‌جا شده با شناسه آن در موقعیت
+        جدید پیدا می‌شود و برای درس حذف‌شده «منو قدیمی است» پاسخ داده می‌شود.
+        اگر درس جابه‌جا شده یا پرامپت یا عنوان‌های آن عوض شده باشد (نسخه
+        متفاوت، ر.ک. callback_version)، شماره بخش‌ها معتبر نیست و همان درس از
+        ابتدا نمایش داده می‌شود.
+        """
+        position = CallbackData.parse_section(args)
+        if position is None:
+            session = await self.get_session(query.from_user.id)
+            chapter, lesson, section_index = session.chapter, session.lesson, session.section
+            if chapter == 0 or lesson == 0:
+                await query.answer("ابتدا یک درس را شروع کنید!", show_alert=True)
+                return None
+            return chapter, lesson, section_index
+        
+        chapter, lesson, section_index, version, ref = position
+        key = self.curriculum_manager.resolve_lesson(chapter, lesson, ref)
+        if key is None:
+            await query.answer(MENU_OUTDATED_TEXT, show_alert=True)
+            return None
+        # کش بر اساس موقعیت است، پس درس جابه‌جاشده هم مانند درس با نسخه تازه از ابتدا نمایش داده می‌شود
+        if key != (chapter, lesson) or version != self.callback_version(*key):
+            if ref is None:
+                # دکمه قدیمی بدون شناسه: معلوم نیست درسی که اکنون در این موقعیت است همان درس باشد
+                await query.answer(MENU_OUTDATED_TEXT, show_alert=True)
+                return None
+            logger.info(f"دکمه با نسخه قدیمی درس {chapter}-{lesson}؛ نمایش درس {key[0]}-{key[1]} از ابتدا")
+            await self.start_lesson_by_numbers(query, None, *key, edit=self.config.lesson_edit_in_place)
+            return None
+        return key[0], key[1], section_index
     
-    async def next_section_callback(self, query, context):
+    async def next_section_callback(self, query, context, args: List[str] = ()):
         """بخش بعدی درس"""
         user_id = query.from_user.id
         
-        # دریافت پیشرفت فعلی کاربر
-        chapter, lesson, section_index = self.db_manager.get_user_progress(user_id)
-        
-        # چک کردن وجود درس فعال
-        if chapter == 0 or lesson == 0:
-            await query.answer("ابتدا یک درس را شروع کنید!", show_alert=True)
+        # موقعیت از داده دکمه (یا برای دکمه‌های قدیمی از پیشرفت کاربر)
+        position = await self.resolve_section_position(query, args)
+        if position is None:
             return
+        chapter, lesson, section_index = position
         
-        # دریافت محتوای درس از کش
-        cached_content = self.db_manager.get_lesson_content(chapter, lesson)
-        if not cached_content:
+        # دریافت فقط بخش بعدی از کش
+        new_section_index = section_index + 1
+        section = await self.get_section(chapter, lesson, new_section_index)
+        if not section:
             await query.message.reply_text("❌ محتوای درس یافت نشد.")
             return
         
-        # تقسیم محتوا به بخش‌ها
-        sections = self.message_splitter.split_message(cached_content)
         lesson_title = self.curriculum_manager.get_lesson_title(chapter, lesson)
         if not lesson_title:
             await query.message.reply_text("❌ عنوان درس یافت نشد.")
             return
-            
-        lesson_obj = LessonContent(title=lesson_title, sections=sections)
         
         # چک کردن پایان درس
-        if section_index >= len(lesson_obj.sections) - 1:
+        if section.text is None:
             # پایان درس - نمایش پیام و فقط دکمه تمرینات
             await query.answer("درس به پایان رسید! تمرینات را ببینید.", show_alert=True)
             return
         
         # به‌روزرسانی پیشرفت کاربر و ارسال بخش بعدی
-        new_section_index = section_index + 1
-        self.db_manager.update_user_progress(user_id, chapter, lesson, new_section_index)
+        session = await self.update_session(user_id, chapter, lesson, new_section_index, section)
+        self.maybe_prefetch_next(chapter, lesson, new_section_index, section)
         
-        next_section = lesson_obj.sections[new_section_index]
-        header = f"📝 پیام {new_section_index + 1} از {len(lesson_obj.sections)} – فصل {chapter} درس {lesson} – {lesson_obj.title}\n\n"
+        header = f"📝 پیام {new_section_index + 1} از {self.section_total_label(section)} – فصل {chapter} درس {lesson} – {lesson_title}\n\n"
         
         # دکمه‌های ناوبری درس
         control_buttons = []
         
         # دکمه قبلی
         control_buttons.append([
-            InlineKeyboardButton("⬅️ قبلی", callback_data="prev_section")
+            InlineKeyboardButton("⬅️ قبلی", callback_data=self.section_callback(CB_PREV, chapter, lesson, new_section_index))
         ])
         
         # دکمه بعدی (فقط اگر بخش بعدی وجود داشته باشد)
-        if new_section_index < len(lesson_obj.sections) - 1:
+        if new_section_index < section.total - 1 or not section.complete:
             control_buttons.append([
-                InlineKeyboardButton("➡️ بعدی", callback_data="next_section")
+                InlineKeyboardButton("➡️ بعدی", callback_data=self.section_callback(CB_NEXT, chapter, lesson, new_section_index))
             ])
         
         # دکمه تمرینات
         control_buttons.append([
-            InlineKeyboardButton("🎯 تمرینات", callback_data="show_exercises")
+            InlineKeyboardButton("🎯 تمرینات", callback_data=self.section_callback(CB_EXERCISES, chapter, lesson, new_section_index))
         ])
         
         # دکمه‌های ناوبری درس (قبلی/بعدی درس)
-        prev_lesson, next_lesson = self.curriculum_manager.get_adjacent_lessons(chapter, lesson)
-        nav_lesson_buttons = []
-        if prev_lesson:
-            nav_lesson_buttons.append(InlineKeyboardButton("⏮ درس قبلی", callback_data=f"nav_lesson_{prev_lesson[0]}_{prev_lesson[1]}"))
-        if next_lesson:
-            nav_lesson_buttons.append(InlineKeyboardButton("درس بعدی ⏭", callback_data=f"nav_lesson_{next_lesson[0]}_{next_lesson[1]}"))
-        
+        nav_lesson_buttons = self.curriculum_manager.get_nav_buttons(chapter, lesson)
         if nav_lesson_buttons:
             control_buttons.append(nav_lesson_buttons)
         
         reply_markup = InlineKeyboardMarkup(control_buttons)
         
-        await query.message.reply_text(header + next_section, reply_markup=reply_markup)
+        session.message_id = await self.show_lesson_message(query, header + section.text, reply_markup)
     
-    async def prev_section_callback(self, query, context):
+    async def prev_section_callback(self, query, context, args: List[str] = ()):
         """بخش قبلی درس"""
         user_id = query.from_user.id
         
-        # دریافت پیشرفت فعلی کاربر
-        chapter, lesson, section_index = self.db_manager.get_user_progress(user_id)
+        # موقعیت از داده دکمه (یا برای دکمه‌های قدیمی از پیشرفت کاربر)
+        position = await self.resolve_section_position(query, args)
+        if position is None:
+            return
+        chapter, lesson, section_index = position
         
-        # چک کردن وجود درس فعال
-        if chapter == 0 or lesson == 0:
-            await query.answer("ابتدا یک درس را شروع کنید!", show_alert=True)
+        # چک کردن ابتدای درس
+        if section_index <= 0:
+            await query.answer("شما در ابتدای درس هستید!", show_alert=True)
             return
         
-        # دریافت محتوای درس از کش
-        cached_content = self.db_manager.get_lesson_content(chapter, lesson)
-        if not cached_content:
+        # دریافت فقط بخش قبلی از کش
+        new_section_index = section_index - 1
+        section = await self.get_section(chapter, lesson, new_section_index)
+        if not section or section.text is None:
             await query.message.reply_text("❌ محتوای درس یافت نشد.")
             return
         
-        # تقسیم محتوا به بخش‌ها
-        sections = self.message_splitter.split_message(cached_content)
         lesson_title = self.curriculum_manager.get_lesson_title(chapter, lesson)
         if not lesson_title:
             await query.message.reply_text("❌ عنوان درس یافت نشد.")
             return
-            
-        lesson_obj = LessonContent(title=lesson_title, sections=sections)
-        
-        # چک کردن ابتدای درس
-        if section_index <= 0:
-            await query.answer("شما در ابتدای درس هستید!", show_alert=True)
-            return
         
         # به‌روزرسانی پیشرفت کاربر و ارسال بخش قبلی
-        new_section_index = section_index - 1
-        self.db_manager.update_user_progress(user_id, chapter, lesson, new_section_index)
+        session = await self.update_session(user_id, chapter, lesson, new_section_index, section)
         
-        prev_section = lesson_obj.sections[new_section_index]
-        header = f"📝 پیام {new_section_index + 1} از {len(lesson_obj.sections)} – فصل {chapter} درس {lesson} – {lesson_obj.title}\n\n"
+        header = f"📝 پیام {new_section_index + 1} از {self.section_total_label(section)} – فصل {chapter} درس {lesson} – {lesson_title}\n\n"
         
         # دکمه‌های ناوبری درس
         control_buttons = []
@@ -871,70 +4097,81 @@ class PythonMentorBot:
         # دکمه قبلی (فقط اگر بخش قبلی وجود داشته باشد)
         if new_section_index > 0:
             control_buttons.append([
-                InlineKeyboardButton("⬅️ قبلی", callback_data="prev_section")
+                InlineKeyboardButton("⬅️ قبلی", callback_data=self.section_callback(CB_PREV, chapter, lesson, new_section_index))
             ])
         
         # دکمه بعدی
         control_buttons.append([
-            InlineKeyboardButton("➡️ بعدی", callback_data="next_section")
+            InlineKeyboardButton("➡️ بعدی", callback_data=self.section_callback(CB_NEXT, chapter, lesson, new_section_index))
         ])
         
         # دکمه تمرینات
         control_buttons.append([
-            InlineKeyboardButton("🎯 تمرینات", callback_data="show_exercises")
+            InlineKeyboardButton("🎯 تمرینات", callback_data=self.section_callback(CB_EXERCISES, chapter, lesson, new_section_index))
         ])
         
         # دکمه‌های ناوبری درس (قبلی/بعدی درس)
-        prev_lesson, next_lesson = self.curriculum_manager.get_adjacent_lessons(chapter, lesson)
-        nav_lesson_buttons = []
-        if prev_lesson:
-            nav_lesson_buttons.append(InlineKeyboardButton("⏮ درس قبلی", callback_data=f"nav_lesson_{prev_lesson[0]}_{prev_lesson[1]}"))
-        if next_lesson:
-            nav_lesson_buttons.append(InlineKeyboardButton("درس بعدی ⏭", callback_data=f"nav_lesson_{next_lesson[0]}_{next_lesson[1]}"))
-        
+        nav_lesson_buttons = self.curriculum_manager.get_nav_buttons(chapter, lesson)
         if nav_lesson_buttons:
             control_buttons.append(nav_lesson_buttons)
         
         reply_markup = InlineKeyboardMarkup(control_buttons)
         
-        await query.message.reply_text(header + prev_section, reply_markup=reply_markup)
+        session.message_id = await self.show_lesson_message(query, header + section.text, reply_markup)
     
-    async def show_exercises_callback(self, query, context):
+    async def show_exercises_callback(self, query, context, args: List[str] = ()):
         """نمایش تمرینات"""
-        user_id = query.from_user.id
-        
-        # دریافت پیشرفت فعلی کاربر
-        chapter, lesson, section_index = self.db_manager.get_user_progress(user_id)
-        
-        # چک کردن وجود درس فعال
-        if chapter == 0 or lesson == 0:
-            await query.answer("ابتدا یک درس را شروع کنید!", show_alert=True)
+        # موقعیت از داده دکمه (یا برای دکمه‌های قدیمی از پیشرفت کاربر)
+        position = await self.resolve_section_position(query, args)
+        if position is None:
             return
+        chapter, lesson, section_index = position
+        
+        # تمرینات در انتهای درس هستند؛ اگر درس در حال تولید است منتظر پایان آن می‌مانیم
+        stream = self.lesson_streams.get((chapter, lesson))
+        if stream is not None:
+            await stream.wait_until_done()
         
-        # دریافت محتوای درس از کش
-        cached_content = self.db_manager.get_lesson_content(chapter, lesson)
-        if not cached_content:
+        # دریافت اطلاعات فهرست بخش‌ها برای یافتن بخش تمرینات (محتوای جایگزین کش‌نشده هم از حافظه)
+        section = await self.get_section(chapter, lesson, section_index)
+        if not section:
             await query.message.reply_text("❌ محتوای درس یافت نشد.")
             return
         
-        # پیدا کردن بخش تمرینات (آخرین بخش)
-        sections = self.message_splitter.split_message(cached_content)
-        if sections:
-            exercise_section = sections[-1]
-            if "تمرین" in exercise_section or "exercise" in exercise_section.lower():
-                header = f"🎯 تمرینات – فصل {chapter} درس {lesson} – {self.curriculum_manager.get_lesson_title(chapter, lesson)}\n\n"
-                await query.message.reply_text(header + exercise_section)
-            else:
-                await query.message.reply_text("❌ تمرینی برای این درس تعریف نشده است.")
-        else:
+        if section.total == 0:
             await query.message.reply_text("❌ خطایی در خواندن تمرینات رخ داده است.")
+            return
+        
+        if section.exercise_index is None:
+            await query.message.reply_text("❌ تمرینی برای این درس تعریف نشده است.")
+            return
+        
+        if section.exercise_index != section_index:
+            section = await self.get_section(chapter, lesson, section.exercise_index)
+            if not section or section.text is None:
+                await query.message.reply_text("❌ خطایی در خواندن تمرینات رخ داده است.")
+                return
+        
+        header = f"🎯 تمرینات – فصل {chapter} درس {lesson} – {self.curriculum_manager.get_lesson_title(chapter, lesson)}\n\n"
+        await query.message.reply_text(header + section.text)
+    
+    async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE):
+        """گزارش خطای هندلرها؛ در قطعی ذخیره‌ساز به کاربر اطلاع داده می‌شود"""
+        error = context.error
+        if not isinstance(error, StorageUnavailable):
+            logger.error(f"خطا در پردازش آپدیت: {error}", exc_info=error)
+            return
+        logger.warning(f"ذخیره‌ساز در دسترس نیست: {error}")
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("⚠️ سرویس موقتاً در دسترس نیست. لطفاً چند لحظه دیگر دوباره تلاش کنید.")
     
     async def progress_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """نمایش پیشرفت کاربر"""
         user_id = update.effective_user.id
         
-        # دریافت پیشرفت کاربر
-        chapter, lesson, section_index = self.db_manager.get_user_progress(user_id)
+        # دریافت پیشرفت کاربر از جلسه (یا دیتابیس برای کاربران غیرفعال)
+        session = await self.get_session(user_id)
+        chapter, lesson, section_index = session.chapter, session.lesson, session.section
         
         if chapter == 0 or lesson == 0:
             progress_text = "📊 شما هنوز هیچ درسی را شروع نکرده‌اید.\nابتدا یک درس را شروع کنید."
@@ -976,6 +4213,11 @@ class PythonMentorBot:
     
     async def text_message_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """مدیریت پیام‌های متنی"""
+        with self.metrics.handler_latency.time(handler="text_message"):
+            await self.handle_text_message(update, context)
+    
+    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """اجرای دستور متناظر با متن پیام"""
         text = update.message.text
         
         if text == "فصل‌ها 📚":
@@ -989,27 +4231,245 @@ class PythonMentorBot:
         else:
             await update.message.reply_text("❓ دستور نامعتبر. از منوی اصلی استفاده کنید.")
     
-    def run(self):
-        """اجرای ربات"""
+    async def pregenerate_lessons(self, concurrency: int = 4, chapter: Optional[int] = None) -> int:
+        """تولید آفلاین همه دروس کش‌نشده برنامه آموزشی
+        
+        هر درس بلافاصله پس از تولید ذخیره می‌شود، بنابراین اجرای دوباره پس از
+        قطع شدن فقط دروس باقی‌مانده را تولید می‌کند. تعداد دروس ناموفق برگردانده می‌شود.
+        """
+        # دروس با نسخه قدیمی ابتدا حذف می‌شوند تا دوباره تولید شوند
+        await self.invalidate_stale_lessons()
+        lessons = self.curriculum_lessons(chapter)
+        
+        missing = [item for item in lessons if not await self.db_manager.has_lesson(item[0], item[1])]
+        logger.info(f"{len(lessons) - len(missing)} درس از {len(lessons)} درس در کش موجود است؛ {len(missing)} درس تولید می‌شود")
+        
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        failures: List[Tuple[int, int, str]] = []
+        done = 0
+        
+        async def generate(chapter_num: int, lesson_num: int, chapter_title: str, lesson_title: str):
+            nonlocal done
+            async with semaphore:
+                content = await self.lesson_flights.do(
+                    (chapter_num, lesson_num, PROMPT_VERSION),
+                    lambda: self.generate_and_cache_lesson(
+                        chapter_num, lesson_num, chapter_title, lesson_title, allow_fallback=False,
+                        priority=GENERATION_PRIORITY_BULK
+                    )
+                )
+            done += 1
+            status = "✅" if content else "❌"
+            if not content:
+                failures.append((chapter_num, lesson_num, lesson_title))
+            print(f"[{done}/{len(missing)}] {status} فصل {chapter_num} درس {lesson_num} – {lesson_title}", flush=True)
+        
+        try:
+            await asyncio.gather(*(generate(*item) for item in missing))
+        finally:
+            await self.ai_client.client.aclose()
+            self.db_manager.close()
+        
+        if failures:
+            print(f"\n{len(failures)} درس تولید نشد (اجرای دوباره فقط همین‌ها را تولید می‌کند):")
+            for chapter_num, lesson_num, lesson_title in failures:
+                print(f"  فصل {chapter_num} درس {lesson_num} – {lesson_title}")
+        else:
+            print("\n✅ همه دروس در کش موجود هستند.")
+        return len(failures)
+    
+    async def on_startup(self, app: Application):
+        """راه‌اندازی سرور متریک‌ها و پاک‌سازی پس‌زمینه دروس قدیمی پس از آماده شدن برنامه"""
+        # اجزای تنبل پیش از دریافت اولین آپدیت ساخته می‌شوند تا هزینه آن‌ها به کاربر نرسد
+        self.build_components()
+        if self.metrics_server is not None:
+            await self.metrics_server.start()
+        # تا پایان پاک‌سازی ممکن است نسخه قدیمی یک درس برای مدت کوتاهی نمایش داده شود
+        self.invalidation_task = asyncio.create_task(self.invalidate_stale_lessons())
+        if self.config.curriculum_reload_interval > 0:
+            self.curriculum_watch_task = asyncio.create_task(self.watch_curriculum())
+    
+    async def on_shutdown(self, app: Application):
+        """آزادسازی منابع هنگام خاموش شدن ربات"""
+        background = list(self.prefetch_tasks)
+        for task in (self.invalidation_task, self.curriculum_watch_task):
+            if task is not None:
+                background.append(task)
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+        logger.info(f"آمار صف تولید درس: {self.generation_scheduler.stats()}")
+        logger.info(f"آمار پیش‌واکشی دروس: {self.prefetch_report()}")
+        logger.info(f"آمار نمایش بخش‌های درس: {self.edit_stats}")
+        logger.info(f"آمار جلسه‌های کاربران: {self.sessions.stats()}")
+        logger.info(f"آمار صف ارسال تلگرام: {self.rate_limiter.stats()}")
+        if self.built("ai_client"):
+            logger.info(f"آمار تولید درس: {self.ai_client.stats()}")
+            await self.ai_client.client.aclose()
+        if self.built("db_manager"):
+            self.db_manager.close()
+    
+    def build_application(self) -> Application:
+        """ساخت Application تلگرام و ثبت هندلرها"""
+        builder = (
+            Application.builder()
+            .token(self.config.telegram_bot_token)
+            .concurrent_updates(PerUserUpdateProcessor(self.config.update_workers))
+            .rate_limiter(self.rate_limiter)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+        )
+        if self.config.bot_mode == "webhook":
+            # آپدیت‌ها از سرور وب‌هوک خودمان به صف برنامه اضافه می‌شوند
+            builder = builder.updater(None)
+        app = builder.build()
+        
+        # ثبت دستورات
+        app.add_handler(CommandHandler("start", self.start_command))
+        app.add_handler(CommandHandler("reload", self.reload_command))
+        
+        # ثبت هندلرهای دکمه‌ای
+        app.add_handler(CallbackQueryHandler(self.button_handler))
+        
+        # ثبت هندلر پیام‌های متنی
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.text_message_handler))
+        app.add_error_handler(self.error_handler)
+        return app
+    
+    async def run_webhook(self, app: Application):
+        """اجرای ربات در حالت وب‌هوک تا دریافت SIGINT یا SIGTERM"""
+        async def enqueue(data: Dict[str, Any]):
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        
+        config = self.config
+        server = WebhookServer(enqueue, config.webhook_listen, config.webhook_port, config.webhook_path,
+                               config.webhook_secret_token, config.webhook_max_connections)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        
+        await app.initialize()
         try:
-            app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-            
-            # ثبت دستورات
-            app.add_handler(CommandHandler("start", self.start_command))
-            
-            # ثبت هندلرهای دکمه‌ای
-            app.add_handler(CallbackQueryHandler(self.button_handler))
-            
-            # ثبت هندلر پیام‌های متنی
-            app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.text_message_handler))
+            await self.on_startup(app)
+            await app.bot.set_webhook(
+                url=config.webhook_url,
+                secret_token=config.webhook_secret_token,
+                max_connections=config.webhook_max_connections,
+                allowed_updates=Update.ALL_TYPES
+            )
+            await server.start()
+            await app.start()
+            logger.info("ربات در حالت وب‌هوک در حال اجرا است...")
+            await stop.wait()
+        finally:
+            # ابتدا ورودی جدید قطع می‌شود، سپس آپدیت‌های صف پردازش و منابع آزاد می‌شوند
+            await server.stop()
+            if app.running:
+                await app.stop()
+            await app.shutdown()
+            await self.on_shutdown(app)
+    
+    def run(self) -> int:
+        """اجرای ربات؛ برگشت: کد خروج (۱ اگر راه‌اندازی یا اجرا با خطا متوقف شود)"""
+        try:
+            app = self.build_application()
+            if self.config.bot_mode == "webhook":
+                if not self.config.webhook_url:
+                    raise ValueError("برای حالت وب‌هوک متغیر WEBHOOK_URL لازم است")
+                if not self.config.webhook_secret_token:
+                    raise ValueError("برای حالت وب‌هوک متغیر WEBHOOK_SECRET_TOKEN لازم است")
+                asyncio.run(self.run_webhook(app))
+                return 0
             
             logger.info("ربات در حال اجرا است...")
             app.run_polling()
+            return 0
         except Exception as e:
             logger.error(f"خطا در اجرای ربات: {e}")
             print(f"خطا در اجرای ربات: {e}")
+            return 1
 
-if __name__ == "__main__":
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """خواندن آرگومان‌های خط فرمان"""
+    parser = argparse.ArgumentParser(description="ربات مربی پایتون")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="اجرای ربات (پیش‌فرض)")
+    
+    pregenerate = subparsers.add_parser("pregenerate", help="تولید آفلاین همه دروس کش‌نشده")
+    pregenerate.add_argument("--concurrency", type=int, default=4, help="حداکثر تعداد تولید همزمان")
+    pregenerate.add_argument("--chapter", type=int, default=None, help="فقط دروس این فصل")
+    
+    storage = subparsers.add_parser("storage-server", help="اجرای سرور ذخیره‌ساز مشترک برای چند نمونه ربات")
+    storage.add_argument("--listen", default="127.0.0.1", help="آدرس شنود")
+    storage.add_argument("--port", type=int, default=8700, help="پورت شنود")
+    storage.add_argument("--db", default=None, help="فایل SQLite پشت سرور (پیش‌فرض DB_PATH)")
+    
+    cache_stats = subparsers.add_parser("cache-stats", help="گزارش تعداد و حجم دروس ذخیره‌شده (فقط خواندنی)")
+    cache_stats.add_argument("--prune", action="store_true",
+                             help="پیش از گزارش، دروس با نسخه قدیمی از کش حذف شوند")
+    return parser.parse_args(argv)
+
+async def run_storage_server(config: BotConfig, listen: str, port: int):
+    """اجرای سرور ذخیره‌ساز روی config.db_path با توکن config.storage_token تا دریافت SIGINT یا SIGTERM"""
+    server = StorageServer(DatabaseManager(config.db_path, config.lesson_compression_level), listen, port,
+                           token=config.storage_token)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await server.start()
+    try:
+        await stop.wait()
+    finally:
+        await server.stop()
+
+def main(argv: Optional[List[str]] = None, config: Optional[BotConfig] = None) -> int:
+    """نقطه ورود خط فرمان؛ برگشت: کد خروج
+    
+    فایل .env فقط این‌جا خوانده می‌شود (مقادیر موجود در محیط بازنویسی نمی‌شوند).
+    """
+    args = parse_args(argv)
+    configure_logging()
+    if config is None:
+        load_dotenv()
+        try:
+            config = BotConfig.from_env()
+        except ConfigError as e:
+            print(f"خطا: {e}")
+            return 1
+    if args.command == "storage-server":
+        if args.db:
+            config = replace(config, db_path=args.db)
+        asyncio.run(run_storage_server(config, args.listen, args.port))
+        return 0
+    
+    required = {"pregenerate": ("deepseek_api_key",), "cache-stats": ()}.get(
+        args.command, ("telegram_bot_token", "deepseek_api_key"))
+    missing = config.missing(*required)
+    if missing:
+        print(f"خطا: متغیرهای محیطی یافت نشدند: {', '.join(missing)}")
+        return 1
+    
     # ایجاد شیء ربات و اجرای آن
-    bot = PythonMentorBot()
-    bot.run()
\ No newline at end of file
+    bot = PythonMentorBot(config)
+    if args.command == "pregenerate":
+        return 1 if asyncio.run(bot.pregenerate_lessons(args.concurrency, args.chapter)) else 0
+    if args.command == "cache-stats":
+        if args.prune:
+            stale = asyncio.run(bot.invalidate_stale_lessons())
+            print(f"دروس حذف‌شده با نسخه قدیمی: {len(stale)}")
+            stats = bot.storage_stats
+        else:
+            stats = asyncio.run(bot.db_manager.lesson_storage_stats())
+        print(f"دروس: {stats.get('lessons', 0)} (دارای نسخه: {stats.get('versioned', 0)})")
+        print(f"حجم خام: {stats.get('raw_bytes', 0)} بایت، ذخیره‌شده: {stats.get('stored_bytes', 0)} بایت، "
+              f"صرفه‌جویی: {stats.get('saved_bytes', 0)} بایت (نسبت {stats.get('ratio', 1.0):.2f})")
+        bot.db_manager.close()
+        return 0
+    return bot.run()
+
+if __name__ == "__main__":
+    sys.exit(main())
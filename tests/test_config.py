@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+آزمون‌های خواندن تنظیمات با BotConfig.from_env و جدا بودن متریک‌های هر ربات
+
+محیط به صورت دیکشنری به from_env داده می‌شود و os.environ تغییر نمی‌کند.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+KEYS = {"TELEGRAM_BOT_TOKEN": "123456:test", "DEEPSEEK_API_KEY": "test"}
+
+
+def test_from_env_parses_typed_values():
+    config = main.BotConfig.from_env({**KEYS, "DEEPSEEK_STREAMING": "off", "METRICS_PORT": "0",
+                                      "ADMIN_USER_IDS": "1, 2 3", "SEND_CHAT_RATE": "0.5"})
+    assert config.deepseek_streaming is False
+    assert config.metrics_port == 0
+    assert config.admin_user_ids == frozenset({1, 2, 3})
+    assert config.send_chat_rate == 0.5
+
+
+def test_empty_values_fall_back_to_defaults_and_overrides_win():
+    config = main.BotConfig.from_env({**KEYS, "METRICS_PORT": "", "DB_PATH": "env.db"}, db_path="override.db")
+    assert config.metrics_port == main.METRICS_PORT
+    assert config.db_path == "override.db"
+
+
+def test_invalid_values_are_reported_together():
+    with pytest.raises(main.ConfigError) as error:
+        main.BotConfig.from_env({**KEYS, "ADMIN_USER_IDS": "alice", "DEEPSEEK_STREAMING": "maybe"})
+    assert "ADMIN_USER_IDS" in str(error.value)
+    assert "DEEPSEEK_STREAMING" in str(error.value)
+
+
+def test_bots_do_not_share_metrics():
+    config = main.BotConfig(telegram_bot_token="123456:test", deepseek_api_key="test", metrics_port=0)
+    first, second = main.PythonMentorBot(config), main.PythonMentorBot(config)
+    first.metrics.handler_latency.observe(0.1, handler="start")
+    assert first.metrics is not second.metrics
+    assert second.metrics.handler_latency.count() == 0
+
+
+def test_main_reports_startup_failure():
+    config = main.BotConfig(telegram_bot_token="123456:test", deepseek_api_key="test", metrics_port=0,
+                            bot_mode="webhook", webhook_url="")
+    assert main.main(["run"], config) == 1
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+آزمون‌های تلاش مجدد، Retry-After و قطع‌کن مدار DeepSeekClient با سرور جعلی
+
+پاسخ‌ها با httpx.MockTransport ساخته می‌شوند و هیچ درخواست شبکه‌ای ارسال نمی‌شود.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FaultyAPI:
+    """سرور جعلی که پاسخ‌های از پیش تعیین‌شده را به ترتیب برمی‌گرداند"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if callable(response):
+            return await response(request)
+        return response
+
+
+def lesson_response(text: str = "📘 درس\nمتن درس") -> httpx.Response:
+    return httpx.Response(200, json={"choices": [{"message": {"content": text}}],
+                                     "usage": {"prompt_tokens": 3, "completion_tokens": 5}})
+
+
+def sse_response(chunks, done: bool = True) -> httpx.Response:
+    body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks)
+    if done:
+        body += "data: [DONE]\n\n"
+    return httpx.Response(200, content=body.encode(), headers={"Content-Type": "text/event-stream"})
+
+
+def make_client(api: FaultyAPI, **kwargs) -> main.DeepSeekClient:
+    options = {"max_retries": 3, "backoff_base": 0.001, "backoff_max": 0.01, "retry_budget": 5.0,
+               "breaker": main.CircuitBreaker(5, 30.0)}
+    options.update(kwargs)
+    return main.DeepSeekClient("test-key", "http://deepseek.test", transport=httpx.MockTransport(api), **options)
+
+
+def generate(client: main.DeepSeekClient) -> main.GenerationResult:
+    async def run():
+        try:
+            return await client.generate_lesson("فصل", "درس")
+        finally:
+            await client.client.aclose()
+    return asyncio.run(run())
+
+
+def test_retry_after_is_waited_in_full():
+    api = FaultyAPI(httpx.Response(429, headers={"Retry-After": "0.2"}), lesson_response())
+    client = make_client(api, backoff_max=0.01)
+    started = time.perf_counter()
+    result = generate(client)
+    assert result.ok
+    assert result.attempts == 2
+    assert time.perf_counter() - started >= 0.2
+
+
+def test_retry_after_beyond_budget_returns_rate_limited():
+    api = FaultyAPI(httpx.Response(429, headers={"Retry-After": "60"}), lesson_response())
+    client = make_client(api, retry_budget=1.0)
+    started = time.perf_counter()
+    result = generate(client)
+    assert not result.ok
+    assert result.error_kind == main.ERROR_RATE_LIMITED
+    assert result.retry_after == 60
+    assert api.calls == 1
+    assert time.perf_counter() - started < 1.0
+
+
+def test_server_errors_are_retried():
+    api = FaultyAPI(httpx.Response(503), httpx.Response(502), lesson_response())
+    client = make_client(api)
+    result = generate(client)
+    assert result.ok
+    assert result.attempts == 3
+    assert client.breaker.failures == 0
+    assert client.breaker.state == "closed"
+
+
+def test_non_retryable_error_leaves_breaker_alone():
+    client = make_client(FaultyAPI(httpx.Response(503)), max_retries=1)
+    assert generate(client).error_kind == main.ERROR_HTTP
+    assert client.breaker.failures == 2
+
+    api = FaultyAPI(httpx.Response(400))
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(api))
+    result = generate(client)
+    assert result.status_code == 400
+    assert result.attempts == 1
+    assert api.calls == 1
+    assert client.breaker.failures == 2
+
+
+def test_breaker_opens_then_half_open_probe_closes_it():
+    api = FaultyAPI(httpx.Response(503))
+    client = make_client(api, max_retries=1, breaker=main.CircuitBreaker(2, 0.1))
+    assert generate(client).error_kind == main.ERROR_HTTP
+    assert client.breaker.state == "open"
+
+    calls = api.calls
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(api))
+    assert generate(client).error_kind == main.ERROR_CIRCUIT_OPEN
+    assert api.calls == calls
+
+    time.sleep(0.15)
+    assert client.breaker.state == "half_open"
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(FaultyAPI(lesson_response())))
+    assert generate(client).ok
+    assert client.breaker.state == "closed"
+
+
+def test_failed_half_open_probe_reopens_breaker():
+    api = FaultyAPI(httpx.Response(503))
+    client = make_client(api, max_retries=1, breaker=main.CircuitBreaker(2, 0.1))
+    generate(client)
+    time.sleep(0.15)
+    client.client = httpx.AsyncClient(transport=httpx.MockTransport(api))
+    result = generate(client)
+    assert result.error_kind == main.ERROR_HTTP
+    assert result.attempts == 1
+    assert client.breaker.state == "open"
+
+
+def test_retries_stop_when_time_budget_is_spent():
+    async def slow_timeout(request):
+        await asyncio.sleep(0.15)
+        raise httpx.ReadTimeout("timeout", request=request)
+
+    api = FaultyAPI(slow_timeout)
+    client = make_client(api, max_retries=5, retry_budget=0.2)
+    result = generate(client)
+    assert result.error_kind == main.ERROR_TIMEOUT
+    assert api.calls == 2
+    assert client.breaker._probe_in_flight is False
+
+
+def test_truncated_stream_is_not_ok():
+    api = FaultyAPI(sse_response([{"choices": [{"delta": {"content": "بخش اول\n"}}]}], done=False))
+    client = make_client(api)
+    deltas = []
+
+    async def run():
+        try:
+            return await client.generate_lesson_streaming("فصل", "درس", deltas.append)
+        finally:
+            await client.client.aclose()
+
+    result = asyncio.run(run())
+    assert not result.ok
+    assert result.error_kind == main.ERROR_STREAM_TRUNCATED
+    assert deltas == ["بخش اول\n"]
+
+
+def test_finish_reason_completes_stream():
+    api = FaultyAPI(sse_response([{"choices": [{"delta": {"content": "درس"}, "finish_reason": "stop"}]}],
+                                 done=False))
+    client = make_client(api)
+
+    async def run():
+        try:
+            return await client.generate_lesson_streaming("فصل", "درس", lambda delta: None)
+        finally:
+            await client.client.aclose()
+
+    result = asyncio.run(run())
+    assert result.ok
+    assert result.content == "درس"
+
+
+def test_length_finish_reason_is_not_cached():
+    api = FaultyAPI(sse_response([{"choices": [{"delta": {"content": "درس"}, "finish_reason": "length"}]}]))
+    client = make_client(api)
+
+    async def run():
+        try:
+            return await client.generate_lesson_streaming("فصل", "درس", lambda delta: None)
+        finally:
+            await client.client.aclose()
+
+    result = asyncio.run(run())
+    assert not result.ok
+    assert result.error_kind == main.ERROR_MAX_TOKENS
+    assert client.breaker.failures == 0
+
+    api = FaultyAPI(httpx.Response(200, json={"choices": [{"message": {"content": "درس"},
+                                                           "finish_reason": "length"}]}))
+    result = generate(make_client(api))
+    assert result.error_kind == main.ERROR_MAX_TOKENS
+    assert api.calls == 1
+
+
+def test_empty_content_is_retried():
+    api = FaultyAPI(lesson_response("   "), lesson_response())
+    client = make_client(api)
+    result = generate(client)
+    assert result.ok
+    assert result.attempts == 2
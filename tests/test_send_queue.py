@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+آزمون‌های صف ارسال OutboundRateLimiter با یک ExtBot و شبکه جعلی Bot API
+
+هر پیام ارسال‌شده با زمان حلقه رویداد ثبت می‌شود و هیچ درخواست شبکه‌ای ارسال نمی‌شود.
+"""
+
+import os
+import sys
+import json
+import asyncio
+
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeTelegramRequest(BaseRequest):
+    """شبکه جعلی Bot API که پیام‌های ارسال‌شده را به ترتیب ثبت می‌کند"""
+
+    def __init__(self):
+        self.sent = []
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        else:
+            self.sent.append((asyncio.get_running_loop().time(), params["chat_id"], params["text"]))
+            result = {"message_id": len(self.sent), "date": 0, "chat": {"id": params["chat_id"], "type": "private"},
+                      "text": params["text"]}
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+async def run_with_bot(limiter: main.OutboundRateLimiter, scenario):
+    request = FakeTelegramRequest()
+    bot = ExtBot("123456:test", request=request, get_updates_request=FakeTelegramRequest(), rate_limiter=limiter)
+    await bot.initialize()
+    try:
+        await scenario(bot)
+    finally:
+        await bot.shutdown()
+    return request.sent
+
+
+def test_messages_keep_their_order_within_each_chat():
+    limiter = main.OutboundRateLimiter(global_rate=1000, global_burst=1000, chat_rate=100, chat_burst=1)
+
+    async def scenario(bot):
+        await asyncio.gather(*(bot.send_message(chat_id, f"{chat_id}:{i}")
+                               for i in range(5) for chat_id in (1, 2, 3)))
+
+    sent = asyncio.run(run_with_bot(limiter, scenario))
+    for chat_id in (1, 2, 3):
+        assert [text for _, chat, text in sent if chat == chat_id] == [f"{chat_id}:{i}" for i in range(5)]
+    assert limiter.stats()["queue_depth"] == 0
+
+
+def test_interactive_sends_overtake_bulk_sends():
+    limiter = main.OutboundRateLimiter(global_rate=20, global_burst=1, chat_rate=1000, chat_burst=1000)
+
+    async def scenario(bot):
+        bulk = [asyncio.create_task(bot.send_message(chat_id, "bulk", rate_limit_args=main.SEND_PRIORITY_BULK))
+                for chat_id in range(1, 6)]
+        await asyncio.sleep(0.01)
+        await asyncio.gather(bot.send_message(99, "interactive"), *bulk)
+
+    sent = asyncio.run(run_with_bot(limiter, scenario))
+    # اولین ارسال انبوه توکن انفجاری را گرفته بود؛ پاسخ تعاملی نفر بعدی است
+    assert [text for _, _, text in sent][:2] == ["bulk", "interactive"]
+
+
+def test_global_rate_is_respected():
+    rate, burst, count = 50, 5, 30
+    limiter = main.OutboundRateLimiter(global_rate=rate, global_burst=burst, chat_rate=1000, chat_burst=1000)
+
+    async def scenario(bot):
+        await asyncio.gather(*(bot.send_message(chat_id, "x") for chat_id in range(count)))
+
+    sent = asyncio.run(run_with_bot(limiter, scenario))
+    times = [at for at, _, _ in sent]
+    assert len(times) == count
+    # در هر بازه، حداکثر burst پیام به علاوه نرخ سراسری ارسال می‌شود
+    for i in range(count):
+        for j in range(i + burst, count):
+            assert j - i + 1 <= burst + (times[j] - times[i]) * rate + 1
+    assert times[-1] - times[0] >= (count - burst) / rate * 0.9
+
+
+def test_idle_chat_buckets_expire_in_lru_order():
+    async def run():
+        limiter = main.OutboundRateLimiter(global_rate=1000, global_burst=1000, chat_rate=20, chat_burst=1)
+        await limiter.initialize()
+        try:
+            await limiter._acquire(1, main.SEND_PRIORITY_INTERACTIVE)
+            await limiter._acquire(2, main.SEND_PRIORITY_INTERACTIVE)
+            # سطل‌های نیمه‌خالی با ساخت سطل تازه حذف نمی‌شوند
+            await limiter._acquire(3, main.SEND_PRIORITY_INTERACTIVE)
+            assert list(limiter._chats) == [1, 2, 3]
+            # پس از پر شدن توکن‌ها، سطل‌های بیکار از ابتدای ترتیب استفاده حذف می‌شوند
+            await asyncio.sleep(0.1)
+            await limiter._acquire(1, main.SEND_PRIORITY_INTERACTIVE)
+            assert list(limiter._chats) == [2, 3, 1]
+            await limiter._acquire(4, main.SEND_PRIORITY_INTERACTIVE)
+            assert list(limiter._chats) == [1, 4]
+        finally:
+            await limiter.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+آزمون‌های StorageServer و RemoteStorage با MemoryStorage
+
+سرور روی پورت 0 در یک نخ و حلقه رویداد جداگانه اجرا می‌شود (کلاینت
+RemoteStorage همگام است) و همه چیز محلی است.
+"""
+
+import os
+import sys
+import asyncio
+import threading
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+LESSON_TEXT = "📘 درس نمونه\nمتن درس\n📝 تمرینات:\n1. تمرین"
+
+
+class ServerThread:
+    """اجرای StorageServer در نخ و حلقه رویداد جداگانه"""
+
+    def __init__(self, backend: main.StorageBackend, token: str = ""):
+        self.server = main.StorageServer(backend, "127.0.0.1", 0, token=token)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.port}"
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+
+    def stop(self):
+        if not self.thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class BrokenStorage(main.MemoryStorage):
+    """ذخیره‌سازی که خواندن پیشرفت در آن خطا می‌دهد"""
+
+    def get_user_progress(self, user_id: int):
+        raise RuntimeError("disk I/O error")
+
+
+@pytest.fixture
+def server():
+    thread = ServerThread(main.MemoryStorage(), token="secret")
+    thread.start()
+    yield thread
+    thread.stop()
+
+
+@pytest.fixture
+def remote(server):
+    storage = main.RemoteStorage(server.url, "secret", timeout=2.0)
+    yield storage
+    storage.close()
+
+
+def test_backends_are_abstract():
+    with pytest.raises(TypeError):
+        main.StorageBackend()
+    with pytest.raises(TypeError):
+        main.AsyncHTTPServer("127.0.0.1", 0, 1)
+
+
+def test_lessons_round_trip(remote):
+    assert remote.get_lesson_content(2, 1) is None
+    assert not remote.has_lesson(2, 1)
+    remote.save_lesson_content(2, 1, LESSON_TEXT, ["بخش اول", "📝 تمرینات:\n1. تمرین"], "v1")
+    assert remote.get_lesson_content(2, 1) == LESSON_TEXT
+    assert remote.has_lesson(2, 1)
+    assert remote.get_lesson_sections(2, 1) == (["بخش اول", "📝 تمرینات:\n1. تمرین"], 1)
+    section = remote.get_lesson_section(2, 1, 1)
+    assert section.text.startswith("📝") and section.total == 2 and section.exercise_index == 1
+    assert remote.delete_stale_lessons([(2, 1, "v2")]) == [(2, 1)]
+    assert remote.get_lesson_content(2, 1) is None
+    assert remote.lesson_storage_stats()["lessons"] == 0
+
+
+def test_progress_round_trip(remote):
+    assert remote.get_user_progress(7) == (0, 0, 0)
+    remote.update_user_progress(7, 3, 2, 4)
+    assert remote.get_user_progress(7) == (3, 2, 4)
+
+
+def test_generation_lease_is_shared(remote):
+    assert remote.claim_generation(2, 1, "a", 60)
+    assert not remote.claim_generation(2, 1, "b", 60)
+    remote.release_generation(2, 1, "a")
+    assert remote.claim_generation(2, 1, "b", 60)
+
+
+def test_rejects_bad_requests(server):
+    with httpx.Client(base_url=server.url) as client:
+        assert client.post("/rpc", json={"method": "has_lesson", "args": [1, 1]}).status_code == 403
+        auth = {"Authorization": "Bearer secret"}
+        assert client.post("/rpc", json={"method": "close"}, headers=auth).status_code == 404
+        assert client.post("/rpc", content=b"{", headers=auth).status_code == 400
+        assert client.get("/rpc", headers=auth).status_code == 405
+
+
+def test_backend_error_returns_500_and_keeps_connection():
+    thread = ServerThread(BrokenStorage())
+    thread.start()
+    try:
+        with httpx.Client(base_url=thread.url) as client:
+            response = client.post("/rpc", json={"method": "get_user_progress", "args": [1]})
+            assert response.status_code == 500
+            assert "disk I/O error" in response.json()["error"]
+            assert client.post("/rpc", json={"method": "has_lesson", "args": [1, 1]}).json() == {"result": False}
+
+        remote = main.RemoteStorage(thread.url, timeout=2.0)
+        with pytest.raises(main.StorageUnavailable):
+            remote.get_user_progress(1)
+        remote.close()
+    finally:
+        thread.stop()
+
+
+def test_outage_raises_instead_of_returning_defaults(server):
+    remote = main.RemoteStorage(server.url, "secret", timeout=0.5)
+    remote.update_user_progress(7, 3, 2, 4)
+    server.stop()
+    try:
+        with pytest.raises(main.StorageUnavailable):
+            remote.get_user_progress(7)
+        with pytest.raises(main.StorageUnavailable):
+            remote.get_lesson_content(2, 1)
+        # تولید محلی ادامه می‌یابد و قفل آزادنشده خودبه‌خود منقضی می‌شود
+        assert remote.claim_generation(2, 1, "a", 60)
+        remote.release_generation(2, 1, "a")
+    finally:
+        remote.close()
+
+
+def test_buffered_progress_survives_outage():
+    class FlakyStorage(main.MemoryStorage):
+        down = True
+
+        def update_user_progress_many(self, rows):
+            if self.down:
+                raise main.StorageUnavailable("down")
+            super().update_user_progress_many(rows)
+
+    storage = FlakyStorage()
+    db = main.AsyncDatabaseManager(storage, flush_interval=60)
+
+    async def run():
+        await db.update_user_progress(7, 3, 2, 4)
+        await db.flush_progress()
+        assert await db.get_user_progress(7) == (3, 2, 4)
+        await db.update_user_progress(7, 3, 2, 5)
+        storage.down = False
+        await db.flush_progress()
+
+    asyncio.run(run())
+    db.close()
+    assert storage.get_user_progress(7) == (3, 2, 5)
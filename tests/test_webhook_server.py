@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+آزمون‌های WebhookServer با یک آپدیت ضبط‌شده تلگرام
+
+سرور روی پورت 0 در همان حلقه رویداد آزمون اجرا می‌شود و همه چیز محلی است.
+"""
+
+import os
+import sys
+import asyncio
+
+import httpx
+import pytest
+from telegram import Update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+SECRET = "secret"
+RECORDED_UPDATE = {
+    "update_id": 10001,
+    "message": {
+        "message_id": 7,
+        "date": 1700000000,
+        "chat": {"id": 42, "type": "private", "first_name": "Test"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+        "text": "/start",
+    },
+}
+
+
+async def start_server(received: list) -> main.WebhookServer:
+    async def on_update(data):
+        received.append(Update.de_json(data, None))
+
+    server = main.WebhookServer(on_update, "127.0.0.1", 0, "/telegram", SECRET)
+    await server.start()
+    return server
+
+
+def test_recorded_update_is_dispatched():
+    received = []
+
+    async def run():
+        server = await start_server(received)
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{server.port}") as client:
+                response = await client.post("/telegram", json=RECORDED_UPDATE,
+                                             headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                assert response.status_code == 200
+                forged = await client.post("/telegram", json=RECORDED_UPDATE,
+                                           headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                assert forged.status_code == 403
+                assert (await client.post("/telegram", json=RECORDED_UPDATE)).status_code == 403
+                assert (await client.get("/telegram")).status_code == 405
+        finally:
+            await server.stop()
+        return server
+
+    server = asyncio.run(run())
+    assert [update.update_id for update in received] == [10001]
+    assert received[0].message.text == "/start"
+    assert (server.accepted, server.rejected) == (1, 2)
+
+
+def test_secret_token_is_required():
+    with pytest.raises(ValueError):
+        main.WebhookServer(lambda data: None, "127.0.0.1", 0, "/telegram", "")
+
+
+def test_short_body_does_not_hold_the_connection(monkeypatch):
+    monkeypatch.setattr(main, "WEBHOOK_READ_TIMEOUT", 0.1)
+
+    async def run():
+        server = await start_server([])
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"POST /telegram HTTP/1.1\r\nContent-Length: 100\r\n"
+                         b"X-Telegram-Bot-Api-Secret-Token: secret\r\n\r\n{")
+            await writer.drain()
+            # سرور پس از WEBHOOK_READ_TIMEOUT اتصال را می‌بندد
+            assert await asyncio.wait_for(reader.read(), 2.0) == b""
+            writer.close()
+        finally:
+            await server.stop()
+
+    asyncio.run(run())